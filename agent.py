@@ -3,15 +3,24 @@
 # ===============================
 
 # 📦 Imports
-from pydantic import BaseModel
+import json
+import re
+from typing import Literal
+
+import pandas as pd
+from pydantic import BaseModel, ValidationError
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from langchain_community.chat_models import ChatOllama
-from langchain_community.chat_models import ChatOllama
-from langchain_ollama import ChatOllama
 
-from tools import plot_bar_chart, plot_line_chart, plot_pie_chart, plot_table
+from kpi_tables import load_table_ref, search_tables
+from ollama_client import get_ollama_client
+from resources import DEFAULT_LLM, context_window, get_llm, get_or_create
+from tools import (
+    find_kpi_tables, plot_bar_chart, plot_line_chart, plot_pie_chart, plot_table,
+    agenerate_bar_chart, agenerate_line_chart, agenerate_pie_chart, agenerate_table, run_tools
+)
+from tracing import ollama_attrs, span
 
 # ============================================
 # 🧠 STEP 1: Define the Output Schema using Pydantic
@@ -46,6 +55,7 @@ prompt = ChatPromptTemplate.from_messages(
             Proceed with the generation using relevant information retrieved from the database.
             Make sure to include all necessary insights and calculations.
             Use available tools to create graphs and tables using the user's selected color palette.
+            Prefer the figures of the tables extracted from the documents (find_kpi_tables) over numbers read from the text.
             Wrap the output using the following format:\n{format_instructions}
             """,
         ),
@@ -56,46 +66,246 @@ prompt = ChatPromptTemplate.from_messages(
 ).partial(format_instructions=parser.get_format_instructions())
 
 # ============================================
-# ⚙️ STEP 4: Initialize the Local Ollama Chat Model
+# 🛠️ STEP 4: Define Available Tools for the Agent
 # ============================================
 
-
-
-try:
-    llm = ChatOllama(model="mistral")  # ✅ ora supporta bind_tools()
-except Exception as e:
-    print("💥 Ollama init failed:", e)
-    raise RuntimeError("❌ Could not initialize the Ollama model. Make sure Ollama is running and the model is available.") from e
+tools = [find_kpi_tables, plot_bar_chart, plot_line_chart, plot_pie_chart, plot_table]
 
 # ============================================
-# 🛠️ STEP 5: Define Available Tools for the Agent
+# 🤖 STEP 5: Build the Agent Executor on First Use
 # ============================================
 
-tools = [plot_bar_chart, plot_line_chart, plot_pie_chart, plot_table]
+def get_agent_executor(model: str = DEFAULT_LLM) -> AgentExecutor:
+    """
+    Returns the tool-calling AgentExecutor for the given Ollama model.
+    The local ChatOllama model and the executor are created lazily through
+    the shared resource registry, so importing this module stays cheap.
+    """
+    def factory():
+        agent = create_tool_calling_agent(
+            llm=get_llm(model),
+            prompt=prompt,
+            tools=tools
+        )
+        return AgentExecutor(
+            agent=agent,
+            tools=tools,
+            verbose=True,
+            return_intermediate_steps=True
+        )
+
+    return get_or_create(("agent_executor", model), factory)
 
 # ============================================
-# 🤖 STEP 6: Create the Tool-Calling Agent
+# ⚡ STEP 6: Fast Path — One JSON Generation, Visuals Rendered Locally
 # ============================================
+# The agent loop costs one LLM round-trip per tool call (tens of seconds each on CPU).
+# The fast path asks Ollama for the whole section in one call, constrained to a JSON schema
+# in which charts and tables are declared as specs; the specs are then rendered locally.
 
-agent = create_tool_calling_agent(
-    llm=llm,
-    prompt=prompt,
-    tools=tools
-)
+# Extra generations allowed to repair invalid JSON (only the broken output is sent back, not the context)
+MAX_JSON_REPAIRS = 1
 
-# ============================================
-# 🚀 STEP 7: Create the Agent Executor
-# ============================================
+# Tokens generated for the section plan (paragraph + specs)
+PLAN_MAX_TOKENS = 1024
 
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=True,
-    return_intermediate_steps=True
-)
+# KPI tables offered to the model as chart/table data, with their first rows
+PLAN_TABLES = 3
+PLAN_TABLE_ROWS = 5
+
+# Palette used when the caller does not pass brand colors
+DEFAULT_COLORS = ["#2E7D32", "#66BB6A", "#A5D6A7"]
+
+
+class ChartSpec(BaseModel):
+    """
+    A chart declared by the model: data is a KPI table reference ("document:page:table")
+    or inline rows ([{"Anno": 2023, "Emissioni": 1200}, ...]).
+    """
+    kind: Literal["bar", "line", "pie"]
+    title: str
+    data: str | list[dict] = []
+    x_col: str = ""
+    y_cols: list[str] = []
+    labels: list[str] = []
+    values: list[float] = []
+
+
+class TableSpec(BaseModel):
+    """
+    A table declared by the model (same data forms as ChartSpec).
+    """
+    title: str
+    data: str | list[dict]
+
+
+class SectionPlan(BaseModel):
+    """
+    Output schema of the fast path, enforced through Ollama's structured output.
+    """
+    paragraph_title: str
+    paragraph: str
+    charts: list[ChartSpec] = []
+    tables: list[TableSpec] = []
+    sources: list[str] = []
+
+
+PLAN_PROMPT = """You are a helpful assistant that generates sections of environmental, social, and governance (ESG) reports.
+Write the section requested by the user using only the document context below.
+Make sure to include all necessary insights and calculations.
+Declare at most 2 charts and 2 tables that support the text. For their data, prefer a reference from
+"KPI tables" (e.g. "Report_2023:12:0", with x_col/y_cols among its columns); otherwise give the rows inline.
+List the documents you used in sources.
+
+Document context:
+{context}
+
+KPI tables:
+{kpi_tables}
+
+User request: {query}
+
+Answer with a JSON object only."""
+
+REPAIR_PROMPT = """The following JSON is invalid ({error}).
+Return the corrected JSON object only, with the same content.
+
+{output}"""
+
+
+def kpi_table_hints(query, n_tables=PLAN_TABLES, n_rows=PLAN_TABLE_ROWS, collections=None):
+    """
+    Short description of the stored KPI tables most relevant to the query, for the plan prompt
+    (replaces the find_kpi_tables round-trip of the agent). collections: indexes to search (None = default).
+    """
+    hints = []
+    for table in search_tables(query, n_results=n_tables, collections=collections).itertuples():
+        rows = load_table_ref(table.ref).head(n_rows).to_dict(orient="records")
+        hints.append(f"- {table.ref} (page {table.pagina}) columns={list(table.columns)} "
+                     f"rows={json.dumps(rows, ensure_ascii=False, default=str)}")
+    return "\n".join(hints) or "(none)"
+
+
+def repair_json(text):
+    """
+    Fixes the usual defects of LLM JSON: code fences, text around the object, trailing commas.
+    """
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return re.sub(r",\s*([}\]])", r"\1", text)
+
+
+def parse_plan(text):
+    """
+    Validates the model output against SectionPlan, after repair_json if needed.
+    """
+    try:
+        return SectionPlan.model_validate_json(text)
+    except ValidationError:
+        return SectionPlan.model_validate_json(repair_json(text))
+
+
+def generate_plan(query, context, model=DEFAULT_LLM, temperature=0.3, max_tokens=PLAN_MAX_TOKENS, collections=None):
+    """
+    Generates the section plan in a single Ollama call constrained to the SectionPlan schema.
+    Invalid JSON is repaired locally, then (up to MAX_JSON_REPAIRS times) by a short repair generation.
+    The KPI tables offered as chart data come from `collections` (the indexes the context was retrieved from).
+
+    Returns:
+    - SectionPlan
+    """
+    client = get_ollama_client()
+    schema = SectionPlan.model_json_schema()
+    options = {"num_ctx": context_window(model)}
+
+    prompt = PLAN_PROMPT.format(context=context, kpi_tables=kpi_table_hints(query, collections=collections),
+                                query=query)
+    for attempt in range(MAX_JSON_REPAIRS + 1):
+        with span("ollama_generate", model=model, structured=True, attempt=attempt) as attrs:
+            message = client.generate(prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+                                      options=options, format=schema)
+            attrs.update(ollama_attrs(message))
+        output = message["response"]
+        try:
+            return parse_plan(output)
+        except ValidationError as e:
+            error = e
+            prompt = REPAIR_PROMPT.format(error=str(e).splitlines()[0], output=output)
+    raise ValueError(f"❌ Failed to parse structured output:\n{error}\nRaw output:\n{output}")
+
+
+def _spec_frame(data):
+    return load_table_ref(data) if isinstance(data, str) else pd.DataFrame(data)
+
+
+def _chart_call(spec, colors):
+    """
+    Tool call (coroutine function, kwargs) rendering a ChartSpec.
+    """
+    if spec.kind == "pie":
+        labels, values = spec.labels, spec.values
+        if not values:
+            frame = _spec_frame(spec.data)
+            labels, values = frame[spec.x_col].astype(str).tolist(), frame[spec.y_cols[0]].tolist()
+        return agenerate_pie_chart, {"labels": labels, "values": values, "title": spec.title, "colors": colors}
+    func, y_col = (agenerate_bar_chart, spec.y_cols[0]) if spec.kind == "bar" else (agenerate_line_chart, spec.y_cols)
+    return func, {"data": _spec_frame(spec.data), "x_col": spec.x_col, "y_col": y_col, "title": spec.title,
+                  "colors": colors}
+
+
+def _table_call(spec):
+    return agenerate_table, {"data": _spec_frame(spec.data), "title": spec.title}
+
+
+async def _failed(error):
+    raise error
+
+
+def _safe_call(build, spec, *args):
+    """
+    A bad spec (unknown column, missing table) costs its visual, not the section.
+    """
+    try:
+        return build(spec, *args)
+    except Exception as e:
+        return _failed, {"error": e}
+
+
+def render_plan(plan, colors=None):
+    """
+    Renders the charts and tables of a plan concurrently (charts in the render process pool,
+    each with its tool timeout) and returns the section as a modelResponse, visuals as HTML
+    in declaration order.
+    """
+    colors = colors or DEFAULT_COLORS
+    specs = [*plan.charts, *plan.tables]
+    calls = [_safe_call(_chart_call, spec, colors) for spec in plan.charts]
+    calls += [_safe_call(_table_call, spec) for spec in plan.tables]
+
+    with span("render_visuals", charts=len(plan.charts), tables=len(plan.tables)):
+        results = run_tools(calls)
+
+    rendered = []
+    for spec, result in zip(specs, results):
+        if isinstance(result, BaseException):
+            print(f"⚠️ Visual '{spec.title}' not rendered: {type(result).__name__} {result}")
+            result = ""
+        elif isinstance(spec, ChartSpec):
+            result = f'<figure><img src="data:image/png;base64,{result}"/><figcaption>{spec.title}</figcaption></figure>'
+        rendered.append(result)
+
+    return modelResponse(
+        paragraph_title=plan.paragraph_title,
+        paragraph=plan.paragraph,
+        graphs="\n".join(html for html in rendered[:len(plan.charts)] if html),
+        tables="\n".join(html for html in rendered[len(plan.charts):] if html),
+        sources=plan.sources
+    )
 
 # ============================================
-# 🧩 STEP 8: Expose Agent Components for Import
+# 🧩 STEP 7: Expose Agent Components for Import
 # ============================================
 
-__all__ = ["agent_executor", "parser", "modelResponse"]
\ No newline at end of file
+__all__ = ["get_agent_executor", "parser", "modelResponse", "SectionPlan", "generate_plan", "render_plan"]
@@ -6,9 +6,17 @@ import streamlit as st
 import os
 import shutil
 
-from parser import parse_pdf
-from vectorial_db import store_in_chromadb  # ✅ indexing of parsed chunks
-from generator_ai import generate_section_from_documents  # ✅ RAG pipeline (retrieval + generation)
+from vectorial_db import is_already_indexed, build_where
+from ingestion_jobs import (  # ✅ background parse -> chunk -> embed -> store
+    ACTIVE_STATUSES, submit_job, list_jobs, cancel_job, retry_job, clear_finished_jobs, start_workers, start_store_thread
+)
+from ingestion_manifest import hash_bytes, get_entry, list_entries
+from kpi_tables import list_tables, load_table  # ✅ tables extracted from the PDFs
+from index_manager import index_name, create_index, list_indexes, reset_index, compact_index, drop_index
+from generator_ai import stream_section_from_documents  # ✅ RAG pipeline (retrieval + streamed generation)
+from batch_report import generate_report_sections, DEFAULT_CONCURRENCY, DEFAULT_SECTION_DEADLINE
+from resources import warm_up, COLLECTION_NAME  # ✅ shared embedder / ChromaDB, loaded once per process
+from tracing import trace, stage_table, start_metrics_server, METRICS_PORT  # ✅ per-stage timings
 
 
 # ============================================
@@ -17,6 +25,16 @@ from generator_ai import generate_section_from_documents  # ✅ RAG pipeline (re
 st.set_page_config(page_title="ESG Report AI Agent", layout="wide")
 st.title("🧠 AI Agent for Sustainability Reporting")
 
+# Start loading the embedder and ChromaDB in the background (no-op after the first run)
+warm_up()
+
+# Prometheus endpoint, if METRICS_PORT is set (no-op after the first run)
+start_metrics_server()
+
+# Ingestion worker processes and the thread that writes their results to ChromaDB (no-op after the first run)
+start_workers()
+start_store_thread()
+
 
 # ============================================
 # 📑 SIDEBAR MENU: BRAND COLORS + RESET BUTTONS
@@ -31,20 +49,44 @@ with st.sidebar:
     color_3 = st.color_picker("Accent color", "#F59E0B")  # yellow
     brand_colors = [color_1, color_2, color_3]
 
-    st.subheader("🧹 Memory Management")
+    st.subheader("🗄️ Document Indexes")
+
+    # --- Active index (per client / per year collection) ---
+    index_names = sorted({COLLECTION_NAME, *(index["name"] for index in list_indexes())})
+    active_index = st.selectbox("Active index (uploads go here)", options=index_names,
+                                index=index_names.index(COLLECTION_NAME))
+    search_indexes = st.multiselect("Search in", options=index_names, default=[active_index])
 
-    # --- Reset ChromaDB ---
-    confirm_reset_chroma = st.checkbox("I confirm I want to delete the ChromaDB database")
+    with st.expander("➕ New index", expanded=False):
+        new_client = st.text_input("Client")
+        new_year = st.number_input("Reporting year (0 = all years)", min_value=0, value=0)
+        if st.button("Create index") and new_client.strip():
+            name = index_name(new_client, new_year or None)
+            create_index(name)
+            st.success(f"✅ Index `{name}` created.")
+            st.rerun()
 
-    CHROMA_DB_PATH = "chroma/chroma.sqlite3"
+    st.subheader("🧹 Memory Management")
+
+    # --- Reset the active index through the Chroma API ---
+    confirm_reset_chroma = st.checkbox(f"I confirm I want to empty the index `{active_index}`")
 
     if st.button("🧠 Reset Agent memory (ChromaDB)"):
         if confirm_reset_chroma:
-            if os.path.exists(CHROMA_DB_PATH):
-                os.remove(CHROMA_DB_PATH)
-                st.success("✅ Agent memory has been successfully deleted.")
-            else:
-                st.warning("⚠️ No memory found.")
+            reset_index(active_index)
+            st.success(f"✅ Index `{active_index}` has been successfully emptied.")
+        else:
+            st.warning("Please confirm the action by checking the box above.")
+
+    if st.button("🗜️ Compact index"):
+        copied = compact_index(active_index)
+        st.success(f"✅ Index `{active_index}` rebuilt ({copied} chunks).")
+
+    if active_index != COLLECTION_NAME and st.button("🗑️ Drop index"):
+        if confirm_reset_chroma:
+            drop_index(active_index)
+            st.success(f"✅ Index `{active_index}` deleted.")
+            st.rerun()
         else:
             st.warning("Please confirm the action by checking the box above.")
 
@@ -80,31 +122,90 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
-# Parses each uploaded file
+# Queues each uploaded file: parsing and embedding run in background worker processes,
+# so the page stays responsive and the work survives a closed tab or an app restart
 if uploaded_files:
     for uploaded_file in uploaded_files:
-        file_path = os.path.join(UPLOAD_FOLDER, uploaded_file.name)
-
-        # Save uploaded file locally
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(uploaded_file, f)
+        file_hash = hash_bytes(uploaded_file.getvalue())
+        nome, estensione = os.path.splitext(uploaded_file.name)
 
-        # Extract text and metadata from the PDF
-        nome, estensione, testo, pagine = parse_pdf(file_path)
+        # ⏭️ Unchanged file already indexed: nothing to queue
+        if not is_already_indexed(nome, file_hash, collection_name=active_index):
+            # Save uploaded file locally (one folder per content hash: a queued file is never overwritten)
+            file_path = os.path.join(UPLOAD_FOLDER, file_hash[:16], uploaded_file.name)
+            if not os.path.exists(file_path):
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "wb") as f:
+                    f.write(uploaded_file.getvalue())
 
-        # ✅ Save extracted content in ChromaDB vector store
-        store_in_chromadb(nome, estensione, testo)
+            submit_job(file_path, file_hash=file_hash, collection_name=active_index)
+            continue
 
         # Expandable preview of document content
-        with st.expander(f"📘 {nome}{estensione} ({len(pagine)} pages)", expanded=False):
+        entry = get_entry(nome, collection_name=active_index)
+        preview = entry["preview"]
+        with st.expander(f"📘 {nome}{estensione} ({entry.get('n_pagine', '?')} pages, {len(entry['chunks'])} chunks)", expanded=False):
             st.markdown(f"**File name:** `{nome}`")
             st.markdown("**Text preview:**")
-            st.write(testo[:1000] + "..." if len(testo) > 1000 else testo)
+            if preview:
+                st.write(preview + "..." if len(preview) >= 1000 else preview)
+            else:
+                st.caption("⚠️ No text could be extracted from this document (scanned pages without OCR?).")
+
+            tables = list_tables(active_index, origine=nome)
+            if not tables.empty:
+                st.markdown(f"**Extracted tables ({len(tables)}):**")
+                for table in tables.itertuples():
+                    st.caption(f"Page {table.pagina}, table {table.tabella} — `{table.ref}`")
+                    st.dataframe(load_table(nome, table.pagina, table.tabella, active_index), hide_index=True)
 
 else:
     st.info("Please upload at least one file to proceed.")
 
 
+@st.fragment(run_every=2)
+def ingestion_jobs_panel():
+    """
+    Status of the ingestion jobs of the active index, polled every 2 seconds.
+    """
+    jobs = list_jobs(collection_name=active_index, limit=20)
+    if not jobs:
+        return
+
+    # A job just finished: rerun the whole page so its preview and the search scope include it
+    done_ids = {job["id"] for job in jobs if job["status"] == "done"}
+    if done_ids - st.session_state.setdefault("done_jobs", done_ids):
+        st.session_state["done_jobs"] = done_ids
+        st.rerun()
+
+    st.subheader("🏭 Ingestion jobs")
+    for job in jobs:
+        label = f"{job['nome']}{job['estensione']} — {job['status']}"
+        if job["status"] in ("parsing", "embedding", "storing") and job["progress_total"]:
+            st.progress(job["progress_done"] / job["progress_total"],
+                        text=f"{label} ({job['progress_done']}/{job['progress_total']} pages)")
+        else:
+            st.markdown(f"**{label}**" + (f" (attempt {job['attempts'] + 1})" if job["attempts"] and job["status"] in ACTIVE_STATUSES else ""))
+        if job["error"]:
+            st.caption(f"⚠️ {job['error']}")
+
+        if job["status"] in ACTIVE_STATUSES and not job["cancel_requested"]:
+            if st.button("🛑 Cancel", key=f"cancel_{job['id']}"):
+                cancel_job(job["id"])
+                st.rerun(scope="fragment")
+        elif job["status"] in ("failed", "cancelled"):
+            if st.button("🔁 Retry", key=f"retry_{job['id']}"):
+                retry_job(job["id"])
+                st.rerun(scope="fragment")
+
+    if st.button("🧹 Clear finished jobs"):
+        clear_finished_jobs()
+        st.rerun(scope="fragment")
+
+
+ingestion_jobs_panel()
+
+
 # ============================================
 # ✍️ REPORT PARAGRAPH GENERATION FORM
 # ============================================
@@ -119,22 +220,131 @@ with st.form("form_generation"):
         placeholder="e.g., Describe the environmental impact of the company"
     )
     modello = st.selectbox("Choose the LLM", options=["mistral", "deepseek-coder"])
+
+    # Optional scope: pre-filter chunks by document, reporting year and page range
+    indexed_files = {}
+    for searched_index in search_indexes:
+        indexed_files.update(list_entries(searched_index))
+    with st.expander("🔎 Restrict the search scope", expanded=False):
+        scope_documents = st.multiselect("Documents", options=sorted(indexed_files))
+        scope_years = st.multiselect(
+            "Reporting years",
+            options=sorted({e["anno"] for e in indexed_files.values() if e.get("anno")}, reverse=True)
+        )
+        scope_page_from = st.number_input("From page", min_value=0, value=0, help="0 = no limit")
+        scope_page_to = st.number_input("To page", min_value=0, value=0, help="0 = no limit")
+    sub_questions = st.text_area(
+        label="Sub-questions (optional, one per line)",
+        height=100,
+        placeholder="e.g., Scope 1 and 2 emissions\nRenewable energy share\nWaste and recycling",
+        help="Retrieved together with the prompt in one batch; their chunks are merged without duplicates"
+    )
+    use_rerank = st.checkbox("Re-rank retrieved chunks (cross-encoder, slower but more precise)")
+
     genera = st.form_submit_button("🧠 Generate section")
 
 # If user submits the form
 if genera and prompt.strip() != "":
-    st.info("Generating your section... ⏳")
+    status = st.info("Retrieving relevant documents... ⏳")
     try:
-        # Use RAG pipeline to generate text from indexed documents
-        output = generate_section_from_documents(
-            prompt=prompt,
-            model=modello,
-            n_results=6  # fixed max_chunks
-        )
+        with trace("generate_section", model=modello, rerank=use_rerank):
+            # Use RAG pipeline to retrieve context, then stream the generation from the local LLM
+            stream = stream_section_from_documents(
+                prompt=prompt,
+                model=modello,
+                n_results=4,  # fixed max_chunks (hybrid retrieval needs fewer chunks than pure vector search)
+                retrieval_mode="hybrid",
+                where=build_where(
+                    origine=scope_documents or None,
+                    anno=scope_years or None,
+                    pagina_da=scope_page_from or None,
+                    pagina_a=scope_page_to or None
+                ),
+                collections=search_indexes or [active_index],
+                rerank=use_rerank,
+                sub_queries=[line.strip() for line in sub_questions.splitlines() if line.strip()]
+            )
+
+            status.info("Generating your section... ⏳")
+            st.markdown("### 📝 Result")
+            result_box = st.empty()
+
+            output = ""
+            for token in stream:
+                output += token
+                result_box.markdown(output + "▌")
+            result_box.markdown(output)
+
+            if stream.cached:
+                status.success("✅ Section served from cache (same documents, equivalent prompt).")
+            else:
+                status.success(
+                    f"✅ Section generated successfully! "
+                    f"(first token after {stream.time_to_first_token or 0:.1f}s, total {stream.total_time:.1f}s)"
+                )
+
+    except Exception as e:
+        st.error(f"Text generation failed: {str(e)}")
+
+
+# ============================================
+# 📚 BATCH REPORT GENERATION (MULTIPLE SECTIONS)
+# ============================================
 
-        st.success("✅ Section generated successfully!")
-        st.markdown("### 📝 Result")
-        st.write(output)
+st.header("📚 Draft a full report")
+
+with st.form("form_batch_generation"):
+    batch_prompts = st.text_area(
+        label="Enter one section prompt per line",
+        height=200,
+        placeholder="Describe the company's Scope 1, 2 and 3 emissions\nDescribe water consumption and management\nDescribe workforce diversity"
+    )
+    batch_model = st.selectbox("Choose the LLM", options=["mistral", "deepseek-coder"], key="batch_model")
+    batch_concurrency = st.slider("Parallel generations", min_value=1, max_value=8, value=DEFAULT_CONCURRENCY)
+    batch_deadline = st.number_input("Max seconds per section", min_value=30, value=DEFAULT_SECTION_DEADLINE, step=30)
+    batch_rerank = st.checkbox("Re-rank retrieved chunks (cross-encoder)", key="batch_rerank")
+    genera_batch = st.form_submit_button("📚 Generate all sections")
+
+if genera_batch and batch_prompts.strip() != "":
+    section_prompts = [line.strip() for line in batch_prompts.splitlines() if line.strip()]
+
+    try:
+        with trace("batch_report", model=batch_model, sections=len(section_prompts)):
+            # Retrieval is batched; generations run concurrently through the scheduler
+            # (worker threads cannot touch Streamlit widgets, so progress is shown as a spinner)
+            with st.spinner(f"Drafting {len(section_prompts)} sections... ⏳"):
+                sections = generate_report_sections(
+                    section_prompts,
+                    model=batch_model,
+                    concurrency=batch_concurrency,
+                    section_deadline=batch_deadline,
+                    collections=search_indexes or [active_index],
+                    rerank=batch_rerank
+                )
+
+            for section in sections:
+                with st.expander(f"📝 {section.prompt} ({section.status}, {section.elapsed:.0f}s)", expanded=False):
+                    if section.text:
+                        st.write(section.text)
+                    if section.error:
+                        st.warning(section.error)
 
     except Exception as e:
-        st.error(f"Text generation failed: {str(e)}")
\ No newline at end of file
+        st.error(f"Batch generation failed: {str(e)}")
+
+
+# ============================================
+# ⏱️ SIDEBAR: TIMINGS OF THE LAST REQUESTS
+# ============================================
+
+# Rendered last, so the request handled in this run is already included
+with st.sidebar:
+    st.subheader("⏱️ Timings")
+    n_recent = st.slider("Last requests", min_value=1, max_value=50, value=10)
+    timings = stage_table(n_recent)
+    if timings:
+        st.dataframe(timings, hide_index=True)
+        st.caption("Seconds per stage (sum over the request). Full traces are appended to cache/metrics.jsonl"
+                   + (f"; Prometheus metrics on port {METRICS_PORT}." if METRICS_PORT else "."))
+    else:
+        st.caption("No request traced yet.")
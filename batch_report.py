@@ -0,0 +1,250 @@
+# ========================================
+# 📚 MODULE: batch_report.py
+# Drafts many report sections at once: batched retrieval + concurrent generation
+# ========================================
+
+import argparse
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from queue import Empty, Queue
+
+from generator_ai import build_contextual_prompt, stream_text_section
+from ollama_client import READ_TIMEOUT
+from vectorial_db import build_where, query_chromadb_many
+
+
+# ========================================
+# ⚙️ SCHEDULER DEFAULTS
+# ========================================
+
+# Simultaneous generations sent to Ollama (match OLLAMA_NUM_PARALLEL on the server)
+DEFAULT_CONCURRENCY = 2
+
+# Seconds allowed per section, measured from the start of its generation
+DEFAULT_SECTION_DEADLINE = 600
+
+
+@dataclass
+class SectionResult:
+    """
+    Outcome of one section of a batch.
+
+    - status: "ok", "timeout" (partial text kept), "skipped" (batch deadline hit before start),
+      "no_context" (retrieval returned nothing) or "error"
+    """
+    prompt: str
+    text: str = ""
+    status: str = "ok"
+    error: str = ""
+    elapsed: float = 0.0
+    time_to_first_token: float | None = None
+
+
+# ========================================
+# ⏱️ GENERATION WITH DEADLINE
+# ========================================
+
+# Seconds between two checks of the batch stop event while waiting for a token
+TOKEN_POLL_INTERVAL = 0.5
+
+
+def _pump_tokens(stream, tokens, cancelled):
+    """
+    Reads a TextStream on a helper thread and hands its tokens over through a queue.
+    """
+    try:
+        for token in stream:
+            tokens.put(("token", token))
+            if cancelled.is_set():
+                return
+        tokens.put(("done", None))
+    except Exception as e:
+        tokens.put(("error", e))
+
+
+def _generate_section(prompt, contextual_prompt, model, deadline, batch_deadline, stop_event):
+    """
+    Streams one generation and stops as soon as its deadline passes.
+    The stream is read on a helper thread and its tokens are awaited with the time left as timeout,
+    so the section returns at its deadline even when Ollama stalls before or between tokens.
+    The abandoned request ends on its own at the next token or at its read timeout
+    (capped by the time left when the section started).
+    """
+    started = time.monotonic()
+    if stop_event.is_set() or (batch_deadline is not None and started >= batch_deadline):
+        return SectionResult(prompt=prompt, status="skipped")
+
+    section_deadline = started + deadline if deadline else None
+    if batch_deadline is not None:
+        section_deadline = min(section_deadline or batch_deadline, batch_deadline)
+
+    read_timeout = None
+    if section_deadline is not None:
+        read_timeout = max(0.1, min(section_deadline - started, READ_TIMEOUT))
+
+    stream = stream_text_section(contextual_prompt, model=model, read_timeout=read_timeout)
+    tokens = Queue()
+    cancelled = threading.Event()
+    # The reader thread records the generation span in this section's trace
+    threading.Thread(target=contextvars.copy_context().run, args=(_pump_tokens, stream, tokens, cancelled),
+                     daemon=True).start()
+
+    parts = []
+    status = "ok"
+    try:
+        while True:
+            timeout = TOKEN_POLL_INTERVAL
+            if section_deadline is not None:
+                timeout = min(timeout, section_deadline - time.monotonic())
+            if stop_event.is_set() or timeout <= 0:
+                status = "timeout"
+                break
+            try:
+                kind, value = tokens.get(timeout=timeout)
+            except Empty:
+                continue
+            if kind == "token":
+                parts.append(value)
+            elif kind == "done":
+                break
+            else:
+                return SectionResult(prompt=prompt, text="".join(parts), status="error", error=str(value),
+                                     elapsed=time.monotonic() - started)
+    finally:
+        cancelled.set()
+
+    return SectionResult(prompt=prompt, text="".join(parts), status=status,
+                         elapsed=time.monotonic() - started,
+                         time_to_first_token=stream.time_to_first_token)
+
+
+# ========================================
+# 🗓️ BATCH SCHEDULER
+# ========================================
+
+def generate_report_sections(prompts, model="mistral", n_results=4, retrieval_mode="hybrid",
+                             concurrency=DEFAULT_CONCURRENCY, section_deadline=DEFAULT_SECTION_DEADLINE,
+                             batch_deadline=None, progress_callback=None, where=None,
+                             collections=None, rerank=False):
+    """
+    Drafts several report sections in one go.
+
+    Retrieval for all prompts runs as one vectorised embedding call and one batched Chroma query;
+    generations are then dispatched to Ollama by a scheduler that keeps at most `concurrency`
+    requests in flight.
+
+    Parameters:
+    - prompts (list[str]): one prompt per section
+    - model (str): Ollama model name
+    - n_results (int): chunks retrieved per section
+    - retrieval_mode (str): "hybrid" or "vector"
+    - concurrency (int): maximum simultaneous generations
+    - section_deadline (float): seconds allowed per section generation (None = unlimited)
+    - batch_deadline (float): seconds allowed for the whole batch (None = unlimited);
+      sections not started in time are skipped, running ones are cut off
+    - progress_callback (callable): called as callback(index, SectionResult) when a section finishes
+    - where (dict): Chroma metadata filter applied to every section (see vectorial_db.build_where)
+    - collections (list[str]): collections (per-client/per-year indexes) to retrieve from
+    - rerank (bool): re-order each section's candidates with the local cross-encoder
+
+    Returns:
+    - List[SectionResult]: one result per prompt, in input order
+    """
+    prompts = [p for p in prompts if p.strip()]
+    if not prompts:
+        return []
+
+    batch_end = time.monotonic() + batch_deadline if batch_deadline else None
+
+    # 1. Batched retrieval for every section
+    contexts = query_chromadb_many(prompts, n_results=n_results, mode=retrieval_mode, with_details=True,
+                                   where=where, collections=collections, rerank=rerank)
+
+    results = [None] * len(prompts)
+    stop_event = threading.Event()
+
+    def run(index):
+        prompt = prompts[index]
+        _, chunk_list, metadatas = contexts[index]
+        if not chunk_list:
+            result = SectionResult(prompt=prompt, status="no_context",
+                                   error="⚠️ No relevant documents found in ChromaDB.")
+        else:
+            contextual_prompt = build_contextual_prompt(prompt, chunk_list, metadatas, model=model)
+            result = _generate_section(prompt, contextual_prompt, model, section_deadline, batch_end, stop_event)
+        results[index] = result
+        if progress_callback:
+            progress_callback(index, result)
+
+    # 2. Concurrent generation, bounded by the scheduler's pool size
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="section") as pool:
+        try:
+            # Each section runs in a copy of the caller's context, so its spans join the caller's trace
+            for future in [pool.submit(contextvars.copy_context().run, run, i) for i in range(len(prompts))]:
+                future.result()
+        except BaseException:
+            stop_event.set()
+            raise
+
+    return results
+
+
+# ========================================
+# 🖥️ COMMAND LINE ENTRY POINT
+# ========================================
+
+def read_prompts(path):
+    """
+    Reads one section prompt per line; blank lines and lines starting with '#' are ignored.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Draft a full ESG report, one section per prompt.")
+    arg_parser.add_argument("prompts_file", help="text file with one section prompt per line")
+    arg_parser.add_argument("--model", default="mistral")
+    arg_parser.add_argument("--n-results", type=int, default=4)
+    arg_parser.add_argument("--retrieval-mode", choices=["hybrid", "vector"], default="hybrid")
+    arg_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    arg_parser.add_argument("--section-deadline", type=float, default=DEFAULT_SECTION_DEADLINE)
+    arg_parser.add_argument("--batch-deadline", type=float, default=None)
+    arg_parser.add_argument("--document", action="append", help="restrict retrieval to this document (repeatable)")
+    arg_parser.add_argument("--year", type=int, action="append", help="restrict retrieval to this reporting year (repeatable)")
+    arg_parser.add_argument("--collection", action="append", help="collection to retrieve from (repeatable)")
+    arg_parser.add_argument("--rerank", action="store_true", help="re-rank retrieved chunks with a cross-encoder")
+    arg_parser.add_argument("--output", default="report_draft.md", help="Markdown file for the drafted sections")
+    args = arg_parser.parse_args(argv)
+
+    prompts = read_prompts(args.prompts_file)
+    print(f"📚 Drafting {len(prompts)} sections with {args.model} (concurrency {args.concurrency})")
+
+    results = generate_report_sections(
+        prompts,
+        model=args.model,
+        n_results=args.n_results,
+        retrieval_mode=args.retrieval_mode,
+        concurrency=args.concurrency,
+        section_deadline=args.section_deadline,
+        batch_deadline=args.batch_deadline,
+        where=build_where(origine=args.document, anno=args.year),
+        collections=args.collection,
+        rerank=args.rerank,
+        progress_callback=lambda i, r: print(f"[{i + 1}/{len(prompts)}] {r.status} in {r.elapsed:.1f}s — {r.prompt[:60]}")
+    )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(f"## {result.prompt}\n\n")
+            f.write(result.text if result.text else f"_{result.status}: {result.error}_")
+            f.write("\n\n")
+
+    print(f"✅ Report draft written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
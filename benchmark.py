@@ -0,0 +1,427 @@
+# ========================================
+# ⏱️ MODULE: benchmark.py
+# Reproducible benchmarks: ingestion, retrieval at scale, end-to-end generation
+# ========================================
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from index_manager import create_index, drop_index
+from parser import parse_pdf
+from resources import get_chroma_client, get_embedder
+from vector_store import VECTOR_BACKEND, get_vector_store
+from vectorial_db import _max_write_batch, query_chromadb, store_in_chromadb
+
+
+# ========================================
+# ⚙️ BENCHMARK DEFAULTS
+# ========================================
+
+RESULTS_DIR = "./benchmarks"
+
+PDF_SIZES = [10, 100, 500]                     # pages per synthetic PDF
+QUERY_SCALES = [10_000, 100_000, 1_000_000]    # chunks in the retrieval collection
+N_QUERIES = 50
+N_SECTIONS = 10
+
+# Mock Ollama: tokens streamed per answer and delay between tokens (seconds)
+MOCK_TOKENS = 200
+MOCK_TOKEN_DELAY = 0.01
+
+# Benchmark collections are created next to the real ones and dropped at the end
+INGEST_COLLECTION = "benchmark_ingest"
+QUERY_COLLECTION = "benchmark_query"
+
+_VOCABULARY = (
+    "emissioni scope 1 2 3 tCO2e energia rinnovabile consumi idrici rifiuti riciclo fornitori "
+    "dipendenti formazione ore sicurezza infortuni diversità parità genere governance consiglio "
+    "amministrazione rischio climatico tassonomia GRI 305-1 302-1 403-9 biodiversità acqua "
+    "obiettivi target riduzione percentuale rispetto anno precedente stakeholder materialità "
+    "catena valore impatto sociale comunità locali certificazione ISO 14001 45001 rendicontazione"
+).split()
+
+QUERY_PROMPTS = [
+    "Describe the company's Scope 1, 2 and 3 emissions",
+    "What renewable energy share did the company reach?",
+    "Describe water consumption and management",
+    "How is waste recycled and reduced?",
+    "Describe workforce diversity and gender equality",
+    "What training hours were provided to employees?",
+    "Describe health and safety performance and injury rates",
+    "How does the board oversee climate-related risks?",
+    "Describe the materiality assessment and stakeholder engagement",
+    "Which GRI indicators are reported for energy?"
+]
+
+
+# ========================================
+# 📄 SYNTHETIC DATA
+# ========================================
+
+def synthetic_text(rng, n_words):
+    """
+    Pseudo-ESG text: random words from a fixed vocabulary, with numbers and sentence breaks.
+    """
+    words = []
+    for i in range(n_words):
+        word = rng.choice(_VOCABULARY) if rng.random() > 0.1 else f"{rng.uniform(0, 1000):.1f}"
+        words.append(word + ("." if i % 15 == 14 else ""))
+    return " ".join(words)
+
+
+def make_synthetic_pdf(path, n_pages, seed=0, nonce=""):
+    """
+    Writes an A4 PDF of `n_pages` pages of text (~2,500 characters per page).
+    `nonce` is written on every page, so each run embeds new text (cold embedding cache).
+    """
+    rng = random.Random(seed)
+    with fitz.open() as doc:
+        for n in range(n_pages):
+            page = doc.new_page(width=595, height=842)
+            text = f"Pagina {n + 1} {nonce}\n\n" + "\n\n".join(synthetic_text(rng, 120) for _ in range(3))
+            page.insert_textbox(fitz.Rect(50, 50, 545, 800), text, fontsize=9)
+        doc.save(path)
+    return path
+
+
+# ========================================
+# 📊 MEASUREMENT HELPERS
+# ========================================
+
+def latency_stats(samples):
+    """
+    p50 / p95 / mean / max of a list of durations, in milliseconds.
+    """
+    values = np.asarray(samples, dtype=float) * 1000
+    return {
+        "n": int(values.size),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max())
+    }
+
+
+def run_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "vector_backend": VECTOR_BACKEND
+    }
+
+
+# ========================================
+# 📥 INGESTION: parse_pdf + store_in_chromadb
+# ========================================
+
+def bench_ingestion(pdf_sizes=PDF_SIZES, seed=0, workdir=None):
+    """
+    Pages/sec of parse_pdf and chunks/sec of store_in_chromadb on synthetic PDFs of several sizes.
+    Every document goes into the INGEST_COLLECTION collection, which end_to_end reuses.
+    """
+    nonce = uuid.uuid4().hex[:8]
+    create_index(INGEST_COLLECTION)
+    collection = get_vector_store(INGEST_COLLECTION)
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for n_pages in pdf_sizes:
+            path = make_synthetic_pdf(os.path.join(tmp, f"bench_{n_pages}p.pdf"), n_pages, seed=seed, nonce=nonce)
+
+            started = time.perf_counter()
+            nome, estensione, _, testo_per_pagina = parse_pdf(path)
+            parse_time = time.perf_counter() - started
+
+            before = collection.count()
+            started = time.perf_counter()
+            store_in_chromadb(nome, estensione, testo_per_pagina, collection_name=INGEST_COLLECTION)
+            store_time = time.perf_counter() - started
+            n_chunks = collection.count() - before
+
+            results.append({
+                "pages": n_pages,
+                "parse_s": parse_time,
+                "pages_per_s": n_pages / parse_time,
+                "chunks": n_chunks,
+                "store_s": store_time,
+                "chunks_per_s": n_chunks / store_time if store_time else 0.0
+            })
+            print(f"📥 {n_pages} pages: {n_pages / parse_time:.1f} pages/s parse, "
+                  f"{results[-1]['chunks_per_s']:.1f} chunks/s store")
+    return results
+
+
+# ========================================
+# 🔍 RETRIEVAL AT SCALE: query_chromadb
+# ========================================
+
+def _fill_collection(collection, start, stop, dim, seed, write_batch):
+    """
+    Adds records [start, stop) with random unit vectors and synthetic documents
+    (embedding a million real chunks on CPU would take hours and measure the encoder, not the index).
+    """
+    for offset in range(start, stop, write_batch):
+        end = min(offset + write_batch, stop)
+        rng = np.random.default_rng(seed + offset)
+        vectors = rng.standard_normal((end - offset, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        text_rng = random.Random(seed + offset)
+        collection.upsert(
+            ids=[f"bench_{i}" for i in range(offset, end)],
+            embeddings=vectors.tolist(),
+            documents=[synthetic_text(text_rng, 60) for _ in range(offset, end)],
+            metadatas=[{"origine": f"bench_{i // 1000}", "pagina": i % 1000 + 1, "chunk": i}
+                       for i in range(offset, end)]
+        )
+
+
+def bench_queries(scales=QUERY_SCALES, n_queries=N_QUERIES, n_results=5, seed=0):
+    """
+    p50/p95 latency of query_chromadb (vector mode) as the collection grows through `scales`.
+    The first query of each scale warms the HNSW index and is excluded.
+    """
+    create_index(QUERY_COLLECTION)
+    collection = get_vector_store(QUERY_COLLECTION)
+    dim = get_embedder().get_sentence_embedding_dimension()
+    write_batch = _max_write_batch(get_chroma_client())
+
+    results = []
+    filled = collection.count()
+    for scale in sorted(scales):
+        if filled < scale:
+            started = time.perf_counter()
+            _fill_collection(collection, filled, scale, dim, seed, write_batch)
+            print(f"🧱 Filled {QUERY_COLLECTION} to {scale} chunks in {time.perf_counter() - started:.0f}s")
+            filled = scale
+
+        prompts = [f"{QUERY_PROMPTS[i % len(QUERY_PROMPTS)]} ({2015 + i // len(QUERY_PROMPTS)})"
+                   for i in range(n_queries + 1)]
+        samples = []
+        for prompt in prompts:
+            started = time.perf_counter()
+            query_chromadb(prompt, n_results=n_results, mode="vector", collections=[QUERY_COLLECTION])
+            samples.append(time.perf_counter() - started)
+
+        stats = {"chunks": scale, **latency_stats(samples[1:])}
+        results.append(stats)
+        print(f"🔍 {scale} chunks: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms")
+    return results
+
+
+# ========================================
+# 🦙 MOCK OLLAMA SERVER
+# ========================================
+
+class _MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Answers /api/generate like Ollama, streaming a fixed number of tokens at a fixed pace,
+    so end-to-end timings measure this project's overhead rather than the model.
+    """
+
+    protocol_version = "HTTP/1.1"
+    n_tokens = MOCK_TOKENS
+    token_delay = MOCK_TOKEN_DELAY
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, message):
+        body = json.dumps(message).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not payload.get("prompt"):
+            # Preload request
+            self._send_json({"model": payload.get("model"), "done": True})
+            return
+
+        limit = payload.get("options", {}).get("num_predict") or self.n_tokens
+        n_tokens = min(self.n_tokens, limit)
+        final = {
+            "model": payload.get("model"), "done": True,
+            "prompt_eval_count": len(payload["prompt"]) // 4,
+            "eval_count": n_tokens, "eval_duration": int(n_tokens * self.token_delay * 1e9)
+        }
+
+        if not payload.get("stream", True):
+            time.sleep(n_tokens * self.token_delay)
+            self._send_json({**final, "response": "token " * n_tokens})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in [{"response": "token ", "done": False}] * n_tokens + [{**final, "response": ""}]:
+            time.sleep(self.token_delay if not message["done"] else 0)
+            line = json.dumps(message).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(line):X}\r\n".encode() + line + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_ollama(n_tokens=MOCK_TOKENS, token_delay=MOCK_TOKEN_DELAY):
+    """
+    Starts the mock Ollama server on a free local port (daemon thread).
+
+    Returns:
+    - (ThreadingHTTPServer, base URL)
+    """
+    handler = type("MockOllamaHandler", (_MockOllamaHandler,), {"n_tokens": n_tokens, "token_delay": token_delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-ollama").start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ========================================
+# 🧪 END-TO-END SECTION LATENCY
+# ========================================
+
+def bench_end_to_end(n_sections=N_SECTIONS, n_tokens=MOCK_TOKENS, token_delay=MOCK_TOKEN_DELAY):
+    """
+    Latency of stream_section_from_documents against the mock Ollama server, over the
+    documents indexed by bench_ingestion: retrieval + prompt assembly, time to first token, total.
+    """
+    server, url = start_mock_ollama(n_tokens, token_delay)
+    # The Ollama URL is read when ollama_client is first imported
+    os.environ["OLLAMA_HOST"] = url
+    import ollama_client
+    if ollama_client.OLLAMA_URL != url:
+        server.shutdown()
+        raise RuntimeError("ollama_client was imported before the mock server started: run the benchmark in a fresh process.")
+    from generator_ai import stream_section_from_documents
+
+    retrieval, first_token, total = [], [], []
+    try:
+        for i in range(n_sections):
+            prompt = QUERY_PROMPTS[i % len(QUERY_PROMPTS)]
+            started = time.perf_counter()
+            stream = stream_section_from_documents(prompt, n_results=4, collections=[INGEST_COLLECTION],
+                                                   use_cache=False)
+            retrieval.append(time.perf_counter() - started)
+            for _ in stream:
+                pass
+            first_token.append(retrieval[-1] + (stream.time_to_first_token or 0))
+            total.append(retrieval[-1] + stream.total_time)
+    finally:
+        server.shutdown()
+
+    results = {
+        "mock_tokens": n_tokens,
+        "mock_token_delay_s": token_delay,
+        "retrieval_and_prompt": latency_stats(retrieval),
+        "time_to_first_token": latency_stats(first_token),
+        "total": latency_stats(total)
+    }
+    print(f"🧪 End-to-end: p50 {results['total']['p50_ms']:.0f} ms, "
+          f"TTFT p50 {results['time_to_first_token']['p50_ms']:.0f} ms")
+    return results
+
+
+# ========================================
+# 📈 RESULTS AND COMPARISON
+# ========================================
+
+def _flatten(results, prefix=""):
+    """
+    Flattens the numeric values of a results document into {"section.key": value}.
+    Lists are keyed by their size field (pages or chunks).
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        elif isinstance(value, list):
+            for item in value:
+                label = item.get("pages", item.get("chunks"))
+                flat.update(_flatten(item, f"{name}[{label}]."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_results(current, baseline):
+    """
+    Prints the relative change of every metric present in both results documents.
+    """
+    now, before = _flatten(current), _flatten(baseline)
+    print(f"\n📈 Compared with {baseline.get('run', {}).get('commit', '?')}:")
+    for key in sorted(now.keys() & before.keys()):
+        if key.startswith("run.") or not before[key]:
+            continue
+        change = (now[key] - before[key]) / before[key] * 100
+        print(f"  {key:60s} {before[key]:12.2f} -> {now[key]:12.2f} ({change:+.1f}%)")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark ingestion, retrieval and generation.")
+    arg_parser.add_argument("--skip", action="append", default=[], choices=["ingestion", "queries", "end_to_end"],
+                            help="benchmark to skip (repeatable)")
+    arg_parser.add_argument("--pdf-pages", type=int, nargs="+", default=PDF_SIZES)
+    arg_parser.add_argument("--scales", type=int, nargs="+", default=QUERY_SCALES)
+    arg_parser.add_argument("--queries", type=int, default=N_QUERIES)
+    arg_parser.add_argument("--sections", type=int, default=N_SECTIONS)
+    arg_parser.add_argument("--mock-tokens", type=int, default=MOCK_TOKENS)
+    arg_parser.add_argument("--mock-token-delay", type=float, default=MOCK_TOKEN_DELAY)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--keep", action="store_true", help="keep the benchmark collections")
+    arg_parser.add_argument("--output", help=f"results file (default: {RESULTS_DIR}/<commit>_<timestamp>.json)")
+    arg_parser.add_argument("--compare", help="previous results file to compare against")
+    args = arg_parser.parse_args(argv)
+
+    results = {"run": run_metadata()}
+    try:
+        if "ingestion" not in args.skip:
+            results["ingestion"] = bench_ingestion(args.pdf_pages, seed=args.seed)
+        if "queries" not in args.skip:
+            results["queries"] = bench_queries(args.scales, n_queries=args.queries, seed=args.seed)
+        if "end_to_end" not in args.skip:
+            # Retrieves from the documents indexed by the ingestion benchmark (or kept by a previous --keep run)
+            results["end_to_end"] = bench_end_to_end(args.sections, args.mock_tokens, args.mock_token_delay)
+    finally:
+        if not args.keep:
+            drop_index(INGEST_COLLECTION)
+            drop_index(QUERY_COLLECTION)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = results["run"]["timestamp"].replace(":", "").replace("-", "")
+        output = os.path.join(RESULTS_DIR, f"{results['run']['commit']}_{stamp}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"✅ Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# ========================================
+# 🔤 MODULE: bm25_index.py
+# Persistent inverted index for BM25 keyword retrieval
+# ========================================
+
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+from resources import CHROMA_PATH, COLLECTION_NAME, get_or_create, forget
+
+
+# ========================================
+# ⚙️ INDEX CONFIGURATION
+# ========================================
+
+# Stored next to the ChromaDB files it mirrors (one per collection)
+INDEX_PATH = os.path.join(CHROMA_PATH, "bm25_index.sqlite3")
+
+
+def index_path(collection_name=COLLECTION_NAME):
+    """
+    Keyword index file of a collection (the default collection keeps the historical file name).
+    """
+    if collection_name == COLLECTION_NAME:
+        return INDEX_PATH
+    return os.path.join(CHROMA_PATH, f"bm25_index_{collection_name}.sqlite3")
+
+
+# Standard BM25 parameters
+K1 = 1.5
+B = 0.75
+
+# Query terms found in more than this share of the chunks are skipped: their IDF is close to zero,
+# but their postings cover most of the table
+MAX_DF_RATIO = 0.5
+
+# Keeps ESG codes together: "GRI 305-1" -> ["gri", "305-1"], "tCO2e" -> ["tco2e"], "Scope 3" -> ["scope", "3"]
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+
+# Italian and English function words, never indexed nor searched
+STOPWORDS = frozenset("""
+a ad al alla alle agli ai all anche che chi ci come con da dal dalla dalle dagli dai degli dei del della delle
+dello di e ed è gli ha hanno i il in la le lo l ma ne nei nel nella nelle non o per più quale quali questa
+questo questi queste se si sono su sua sue suo suoi sul sulla tra fra un una uno
+an and are as at be been by for from has have in is it its of on or that the their this to was were which
+will with
+""".split())
+
+
+def tokenize(text):
+    """
+    Lower-cases and splits a text into BM25 terms, without stopwords.
+    """
+    return [term for term in _TOKEN_RE.findall(text.lower()) if term not in STOPWORDS]
+
+
+# ========================================
+# 📚 SQLITE-BACKED INVERTED INDEX
+# ========================================
+
+class BM25Index:
+    """
+    Inverted index (term -> chunk_id, term frequency) with per-chunk lengths,
+    kept in sync with the Chroma collection by store_in_chromadb.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Ingestion worker processes share the file: wait for their write locks instead of failing
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (chunk_id TEXT PRIMARY KEY, length INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings (chunk_id);
+            """
+        )
+        self.conn.commit()
+
+    def _delete(self, ids):
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            self.conn.execute(f"DELETE FROM postings WHERE chunk_id IN ({placeholders})", batch)
+            self.conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({placeholders})", batch)
+
+    def add_documents(self, ids, documents):
+        """
+        Indexes (or re-indexes) chunks by ID.
+        """
+        ids = list(ids)
+        with self.lock:
+            self._delete(ids)
+            for chunk_id, document in zip(ids, documents):
+                terms = Counter(tokenize(document))
+                self.conn.execute("INSERT INTO chunks (chunk_id, length) VALUES (?, ?)", (chunk_id, sum(terms.values())))
+                self.conn.executemany(
+                    "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                    [(term, chunk_id, tf) for term, tf in terms.items()]
+                )
+            self.conn.commit()
+
+    def delete(self, ids):
+        """
+        Removes chunks from the index.
+        """
+        with self.lock:
+            self._delete(list(ids))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM postings")
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, query, n_results=20):
+        """
+        Ranks chunks by BM25 score against the query.
+
+        Parameters:
+        - query (str): user prompt/question
+        - n_results (int): number of chunk IDs to return
+
+        Returns:
+        - List[tuple[str, float]]: (chunk_id, score), best first
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self.lock:
+            n_chunks, total_length = self.conn.execute("SELECT COUNT(*), SUM(length) FROM chunks").fetchone()
+            if not n_chunks:
+                return []
+            avg_length = total_length / n_chunks
+
+            # Document frequencies first (answered from the primary key), then only the postings of selective terms
+            placeholders = ",".join("?" * len(terms))
+            dfs = dict(self.conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term", [*terms]
+            ).fetchall())
+            if not dfs:
+                return []
+            selective = [term for term, df in dfs.items() if df <= MAX_DF_RATIO * n_chunks] or [min(dfs, key=dfs.get)]
+
+            placeholders = ",".join("?" * len(selective))
+            rows = self.conn.execute(
+                f"""
+                SELECT p.term, p.chunk_id, p.tf, c.length
+                FROM postings p
+                JOIN chunks c ON c.chunk_id = p.chunk_id
+                WHERE p.term IN ({placeholders})
+                """,
+                selective
+            ).fetchall()
+
+        scores = Counter()
+        for term, chunk_id, tf, length in rows:
+            df = dfs[term]
+            idf = math.log(1 + (n_chunks - df + 0.5) / (df + 0.5))
+            scores[chunk_id] += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+
+        return scores.most_common(n_results)
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def rebuild_from_collection(self, collection, page_size=1000):
+        """
+        Re-creates the index from every chunk stored in a Chroma collection (or vector store)
+        (e.g. for documents indexed before the keyword index existed).
+        """
+        self.clear()
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            self.add_documents(page["ids"], page["documents"])
+            offset += len(page["ids"])
+
+
+def get_bm25_index(collection_name=COLLECTION_NAME):
+    """
+    Shared BM25Index instance of a collection.
+    """
+    path = index_path(collection_name)
+    return get_or_create(("bm25_index", path), lambda: BM25Index(path))
+
+
+# Keyword index files already checked against their collection in this process
+_covered = set()
+_covered_lock = threading.Lock()
+
+
+def ensure_bm25_index(collection_name, collection):
+    """
+    Keyword index of a collection, built from the collection's chunks if it is missing or empty
+    while the collection is not (collections indexed before hybrid search existed). Checked once per process.
+    """
+    index = get_bm25_index(collection_name)
+    with _covered_lock:
+        if index.path in _covered:
+            return index
+        if index.is_empty() and collection.count():
+            print(f"🔤 Building the keyword index of {collection_name} from {collection.count()} stored chunks...")
+            index.rebuild_from_collection(collection)
+        _covered.add(index.path)
+    return index
+
+
+def drop_bm25_index(collection_name=COLLECTION_NAME):
+    """
+    Deletes the keyword index file of a collection.
+    """
+    path = index_path(collection_name)
+    with _covered_lock:
+        _covered.discard(path)
+    index = get_bm25_index(collection_name)
+    with index.lock:
+        index.conn.close()
+    forget("bm25_index", path)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# ========================================
+# 🔀 RECIPROCAL-RANK FUSION
+# ========================================
+
+def reciprocal_rank_fusion(rankings, k=60, with_scores=False):
+    """
+    Fuses several ranked lists of IDs: score(id) = sum(1 / (k + rank)).
+
+    Parameters:
+    - rankings (list[list[str]]): ranked ID lists, best first
+    - k (int): damping constant (60 is the value from the original RRF paper)
+    - with_scores (bool): return (id, fused score) pairs
+
+    Returns:
+    - List[str]: fused IDs, best first
+    """
+    scores = Counter()
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1.0 / (k + rank)
+    if with_scores:
+        return scores.most_common()
+    return [chunk_id for chunk_id, _ in scores.most_common()]
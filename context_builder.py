@@ -0,0 +1,215 @@
+# ========================================
+# 🧱 MODULE: context_builder.py
+# Token-budgeted RAG context: overlap removal, near-duplicate filtering, document order
+# ========================================
+
+import re
+
+from resources import DEFAULT_LLM, context_window, get_or_create
+from vectorial_db import format_source
+
+
+# ========================================
+# ⚙️ CONTEXT CONFIGURATION
+# ========================================
+
+# tiktoken encoding used to count tokens; the local models use their own SentencePiece
+# vocabularies, which split Italian/ESG text into more pieces, hence the safety factor
+TOKEN_ENCODING = "cl100k_base"
+TOKEN_SAFETY_FACTOR = 1.2
+
+# Characters per token assumed when the tiktoken encoding cannot be loaded
+# (its BPE file is downloaded on first use, which fails on an offline machine)
+CHARS_PER_TOKEN = 4
+
+# Word-shingle Jaccard similarity above which two chunks count as near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+
+# Longest text overlap searched between consecutive chunks without character offsets
+# (the splitter overlap is 50 characters)
+MAX_TEXT_OVERLAP = 200
+
+# Tokens kept free for the agent's own prompt (format instructions, tool descriptions)
+AGENT_PROMPT_RESERVE = 1500
+
+
+# ========================================
+# 🔢 TOKEN COUNTING
+# ========================================
+
+class _CharEncoding:
+    """
+    Offline stand-in for a tiktoken encoding: one "token" every CHARS_PER_TOKEN characters.
+    """
+
+    def encode(self, text):
+        return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def _get_encoding():
+    def factory():
+        try:
+            import tiktoken
+            return tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception as e:
+            print(f"⚠️ tiktoken encoding {TOKEN_ENCODING} unavailable ({e}): "
+                  f"estimating {CHARS_PER_TOKEN} characters per token.")
+            return _CharEncoding()
+
+    return get_or_create(("tiktoken", TOKEN_ENCODING), factory)
+
+
+def count_tokens(text):
+    """
+    Estimated number of model tokens in a text (tiktoken count x TOKEN_SAFETY_FACTOR).
+    """
+    return int(len(_get_encoding().encode(text)) * TOKEN_SAFETY_FACTOR) + 1
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts a text to at most `max_tokens` estimated tokens.
+    """
+    encoding = _get_encoding()
+    tokens = encoding.encode(text)
+    limit = max(0, int(max_tokens / TOKEN_SAFETY_FACTOR) - 1)
+    if len(tokens) <= limit:
+        return text
+    return encoding.decode(tokens[:limit])
+
+
+def context_budget(model=DEFAULT_LLM, fixed_prompt="", max_tokens=512, reserve=0):
+    """
+    Tokens left for retrieved context in a model's window, after the fixed part
+    of the prompt, the generated answer and any extra reserve.
+    """
+    return context_window(model) - max_tokens - reserve - (count_tokens(fixed_prompt) if fixed_prompt else 0)
+
+
+# ========================================
+# 🧹 DEDUPLICATION
+# ========================================
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _shingles(text):
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _is_near_duplicate(shingles, kept):
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= NEAR_DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+
+def _text_overlap(previous, current):
+    """
+    Length of the longest suffix of `previous` that is also a prefix of `current`.
+    """
+    for size in range(min(len(previous), len(current), MAX_TEXT_OVERLAP), 0, -1):
+        if previous.endswith(current[:size]):
+            return size
+    return 0
+
+
+def _position(meta):
+    return (
+        meta.get("collection") or "",
+        meta.get("origine") or "",
+        meta.get("pagina") if meta.get("pagina") is not None else -1,
+        meta.get("char_start") if meta.get("char_start") is not None else -1,
+        meta.get("chunk") if meta.get("chunk") is not None else -1
+    )
+
+
+def _same_page(previous, current):
+    return (previous.get("pagina") is not None
+            and _position(previous)[:3] == _position(current)[:3])
+
+
+# ========================================
+# 🧱 CONTEXT ASSEMBLY
+# ========================================
+
+def select_chunks(chunk_list, metadatas=None, budget=None):
+    """
+    Picks the chunks that go into the prompt.
+
+    Chunks are taken in relevance (retrieval) order, skipping near-duplicates of chunks
+    already taken, until the token budget is used up; the selection is then sorted by
+    position in its source document and the text shared by overlapping neighbours is removed.
+
+    Parameters:
+    - chunk_list (list[str]): retrieved chunks, most relevant first
+    - metadatas (list[dict]): their metadata (origine, pagina, char_start, char_end, chunk)
+    - budget (int): maximum estimated tokens of the assembled blocks (None = unlimited)
+
+    Returns:
+    - List[tuple[str, dict]]: (text, metadata) blocks in document order; contiguous chunks
+      of the same page are merged into one block
+    """
+    metadatas = metadatas or [{} for _ in chunk_list]
+
+    selected = []
+    kept_shingles = []
+    used = 0
+    for chunk, meta in zip(chunk_list, metadatas):
+        shingles = _shingles(chunk)
+        if _is_near_duplicate(shingles, kept_shingles):
+            continue
+
+        cost = count_tokens(chunk) + (count_tokens(format_source(meta)) if meta else 0)
+        if budget is not None and used + cost > budget:
+            if selected:
+                continue
+            # Not even the best chunk fits: keep as much of it as possible
+            chunk = truncate_to_tokens(chunk, budget - (cost - count_tokens(chunk)))
+            if not chunk:
+                break
+            cost = budget
+
+        selected.append((chunk, meta))
+        kept_shingles.append(shingles)
+        used += cost
+
+    selected.sort(key=lambda item: _position(item[1]))
+
+    blocks = []
+    for chunk, meta in selected:
+        if blocks and _same_page(blocks[-1][1], meta):
+            previous_text, previous_meta = blocks[-1]
+            previous_end = previous_meta.get("char_end")
+            start = meta.get("char_start")
+            if previous_end is not None and start is not None and start >= 0:
+                overlap = max(0, previous_end - start)
+                contiguous = start <= previous_end
+            else:
+                overlap = _text_overlap(previous_text, chunk)
+                contiguous = overlap > 0
+            if contiguous:
+                merged_meta = {**previous_meta, "char_end": max(previous_end or 0, meta.get("char_end") or 0)}
+                blocks[-1] = (previous_text + chunk[overlap:], merged_meta)
+                continue
+        blocks.append((chunk, meta))
+    return blocks
+
+
+def build_context(chunk_list, metadatas=None, budget=None):
+    """
+    Assembles the retrieved chunks into a deduplicated, token-budgeted context.
+    With metadata, each block is labelled with its source and page so the model can cite it.
+    """
+    blocks = select_chunks(chunk_list, metadatas, budget)
+    if not metadatas:
+        return "\n\n".join(text for text, _ in blocks)
+    return "\n\n".join(f"[Source: {format_source(meta)}]\n{text}" for text, meta in blocks)
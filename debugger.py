@@ -2,18 +2,18 @@
 # ✅ FILE DI TEST AUTOMATICO PER CHROMADB
 # ========================================
 
-import chromadb
-from sentence_transformers import SentenceTransformer
+from embedding_cache import encode_cached
+from resources import CHROMA_PATH, get_collection
 
-# Modello di embedding (lo stesso usato per l'indicizzazione)
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+# Il modello di embedding (lo stesso usato per l'indicizzazione) viene condiviso tramite resources.py
+# e gli embedding passano dalla cache persistente di embedding_cache.py
 
 # ========================================
 # 🔧 PARAMETRI DEL TEST
 # ========================================
 
 COLLECTION_NAME = "report_sostenibilita"
-DB_PATH = "./"
+DB_PATH = CHROMA_PATH  # stessa cartella usata da app.py e vectorial_db.py
 TEST_QUERY = "Descrivi l'impatto ambientale dell’azienda"
 N_RESULTS = 3
 
@@ -26,8 +26,7 @@ def test_chromadb():
     try:
         # 1. Connessione al database
         print("🔗 Connessione a ChromaDB...")
-        client = chromadb.PersistentClient(path=DB_PATH)
-        collection = client.get_or_create_collection(name=COLLECTION_NAME)
+        collection = get_collection(name=COLLECTION_NAME, path=DB_PATH)
         print("✅ Connessione riuscita")
 
         # 2. Verifica della presenza di documenti indicizzati
@@ -40,7 +39,7 @@ def test_chromadb():
 
         # 3. Query di test
         print("\n🧠 Esecuzione di una query di esempio...")
-        query_embedding = embedder.encode([TEST_QUERY]).tolist()[0]
+        query_embedding = encode_cached([TEST_QUERY]).tolist()[0]
         results = collection.query(query_embeddings=[query_embedding], n_results=N_RESULTS)
 
         documents = results.get("documents", [[]])[0]
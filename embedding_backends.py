@@ -0,0 +1,265 @@
+# ========================================
+# 🧮 MODULE: embedding_backends.py
+# Pluggable embedding backends: PyTorch (sentence-transformers), ONNX Runtime fp32 / int8
+# ========================================
+
+import argparse
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+
+# ========================================
+# ⚙️ BACKEND CONFIGURATION
+# ========================================
+
+# "torch" (sentence-transformers, full precision), "onnx" (ONNX Runtime, fp32) or
+# "onnx-int8" (ONNX Runtime, dynamically quantized weights): the ONNX backends do not import PyTorch
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+
+# Intra-op threads of the backend (0 = library default, usually one per core)
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))
+
+# Texts encoded per forward pass
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+
+# Same truncation as sentence-transformers for MiniLM
+MAX_SEQ_LENGTH = 256
+
+# ONNX exports published in the model's Hugging Face repository
+ONNX_FP32_FILE = "onnx/model.onnx"
+ONNX_INT8_FILE = os.environ.get(
+    "EMBEDDING_ONNX_FILE",
+    "onnx/model_qint8_arm64.onnx" if platform.machine().lower() in ("arm64", "aarch64") else "onnx/model_quint8_avx2.onnx"
+)
+
+# Minimum cosine similarity with the PyTorch model for a backend to be considered interchangeable
+PARITY_THRESHOLD = 0.98
+
+
+def hub_repo(model_name):
+    """
+    Hugging Face repository of a sentence-transformers model name ("all-MiniLM-L6-v2" -> "sentence-transformers/all-MiniLM-L6-v2").
+    """
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+
+def cache_name(model_name, backend=EMBEDDING_BACKEND):
+    """
+    Name under which a backend's vectors are cached. fp32 backends produce the same vectors
+    (to float rounding) and share entries; quantized vectors are kept apart.
+    """
+    return f"{model_name}@int8" if backend == "onnx-int8" else model_name
+
+
+# ========================================
+# 🔌 BACKENDS
+# ========================================
+
+class EmbeddingBackend:
+    """
+    Common interface: encode(texts) -> float32 array of L2-normalised vectors, one row per text.
+    Mirrors the part of SentenceTransformer used by the project, so backends are drop-in.
+    """
+
+    name = "base"
+
+    def __init__(self, model_name, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        self.threads = threads
+        self.batch_size = batch_size
+
+    def encode(self, texts, batch_size=None):
+        raise NotImplementedError
+
+    def get_sentence_embedding_dimension(self):
+        return int(self.encode(["dimension probe"]).shape[1])
+
+
+class TorchBackend(EmbeddingBackend):
+    """
+    sentence-transformers on PyTorch (the original embedder).
+    """
+
+    name = "torch"
+
+    def __init__(self, model_name, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        super().__init__(model_name, threads, batch_size)
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts, batch_size=None):
+        return np.asarray(self.model.encode(list(texts), batch_size=batch_size or self.batch_size), dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    The same model exported to ONNX, run with ONNX Runtime and a Rust tokenizer:
+    mean pooling over the attention mask, then L2 normalisation (as in the sentence-transformers pipeline).
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_name, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE, onnx_file=ONNX_FP32_FILE):
+        super().__init__(model_name, threads, batch_size)
+        try:
+            import onnxruntime as ort
+            from huggingface_hub import hf_hub_download
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError("❌ The ONNX embedding backend needs onnxruntime, tokenizers and huggingface_hub.") from e
+
+        repo = hub_repo(model_name)
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(repo, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]") or 0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(hf_hub_download(repo, onnx_file), sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64)
+        }
+        output = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+
+        if output.ndim == 3:
+            # Token embeddings -> mean over real (non-padding) tokens
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def encode(self, texts, batch_size=None):
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        batch_size = batch_size or self.batch_size
+
+        # Batches of similar length waste less compute on padding
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        vectors = np.empty((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            batch = self._encode_batch([texts[i] for i in indices])
+            if vectors.shape[1] == 0:
+                vectors = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            vectors[indices] = batch
+        return vectors
+
+
+class OnnxInt8Backend(OnnxBackend):
+    """
+    ONNX backend with the int8 dynamically-quantized export of the model.
+    """
+
+    name = "onnx-int8"
+
+    def __init__(self, model_name, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE, onnx_file=ONNX_INT8_FILE):
+        super().__init__(model_name, threads, batch_size, onnx_file=onnx_file)
+
+
+BACKENDS = {backend.name: backend for backend in (TorchBackend, OnnxBackend, OnnxInt8Backend)}
+
+
+def create_backend(model_name, backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    Instantiates an embedding backend by name (see BACKENDS).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend} (choose among {', '.join(BACKENDS)})")
+    return BACKENDS[backend](model_name, threads=threads, batch_size=batch_size)
+
+
+# ========================================
+# 🧪 PARITY CHECK
+# ========================================
+
+PARITY_TEXTS = [
+    "Le emissioni dirette di gas serra (Scope 1) sono diminuite del 12% rispetto al 2022.",
+    "Scope 3 emissions from purchased goods and services account for 78% of the total footprint.",
+    "Il consumo di energia elettrica da fonti rinnovabili ha raggiunto il 64% del totale.",
+    "Total water withdrawal was 1.2 million m³, of which 30% from areas with high water stress.",
+    "Nel 2023 sono state erogate 18.400 ore di formazione, pari a 22 ore per dipendente.",
+    "The board's sustainability committee met six times to review climate-related risks.",
+    "Indice di frequenza infortuni (LTIFR): 1,8 per milione di ore lavorate (GRI 403-9).",
+    "Women represent 41% of the workforce and 33% of management positions.",
+    "Il 92% dei rifiuti prodotti è stato avviato a recupero o riciclo.",
+    "Suppliers covering 80% of procurement spend were assessed on ESG criteria."
+]
+
+
+def parity_check(backend, reference="torch", model_name=None, texts=None):
+    """
+    Cosine similarity between the vectors of two backends on the same texts.
+
+    Returns:
+    - dict: min and mean cosine similarity, and encoding time of each backend
+    """
+    from resources import EMBEDDING_MODEL_NAME
+
+    model_name = model_name or EMBEDDING_MODEL_NAME
+    texts = texts or PARITY_TEXTS
+    results = {"backend": backend, "reference": reference, "texts": len(texts)}
+
+    vectors = {}
+    for name in (reference, backend):
+        encoder = create_backend(model_name, backend=name)
+        encoder.encode(texts[:1])  # warm-up
+        started = time.perf_counter()
+        vectors[name] = encoder.encode(texts)
+        results[f"{name}_s"] = time.perf_counter() - started
+
+    a, b = vectors[reference], vectors[backend]
+    cosines = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    results["min_cosine"] = float(cosines.min())
+    results["mean_cosine"] = float(cosines.mean())
+    return results
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Compare an embedding backend with the PyTorch reference.")
+    arg_parser.add_argument("--backend", default="onnx-int8", choices=list(BACKENDS))
+    arg_parser.add_argument("--reference", default="torch", choices=list(BACKENDS))
+    arg_parser.add_argument("--texts-file", help="one text per line (default: built-in ESG sentences)")
+    arg_parser.add_argument("--threshold", type=float, default=PARITY_THRESHOLD)
+    args = arg_parser.parse_args(argv)
+
+    texts = None
+    if args.texts_file:
+        with open(args.texts_file, "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    results = parity_check(args.backend, reference=args.reference, texts=texts)
+    print(f"🧪 {args.backend} vs {args.reference} on {results['texts']} texts: "
+          f"min cosine {results['min_cosine']:.4f}, mean {results['mean_cosine']:.4f}")
+    print(f"⏱️ {args.reference}: {results[f'{args.reference}_s']:.3f}s, {args.backend}: {results[f'{args.backend}_s']:.3f}s")
+
+    if results["min_cosine"] < args.threshold:
+        print(f"❌ Below the parity threshold ({args.threshold})")
+        return 1
+    print("✅ Parity OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# ========================================
+# 🧠 MODULE: embedding_cache.py
+# Persistent, size-bounded cache of chunk and prompt embeddings
+# ========================================
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from embedding_backends import cache_name
+from resources import EMBEDDING_MODEL_NAME, get_embedder, get_or_create
+from tracing import span
+
+
+# ========================================
+# ⚙️ CACHE CONFIGURATION
+# ========================================
+
+CACHE_PATH = "./cache/embedding_cache.sqlite3"
+
+# Maximum number of cached vectors (~1.6 KB each for MiniLM); older entries are evicted first
+MAX_ENTRIES = 500_000
+
+# When the limit is hit, evict down to this fraction of MAX_ENTRIES in one pass
+EVICT_TO = 0.9
+
+
+def normalise_text(text):
+    """
+    Collapses whitespace so the same paragraph extracted with different line breaks hits the same entry.
+    """
+    return " ".join(text.split())
+
+
+def text_key(text):
+    """
+    Cache key of a text: SHA-256 of its normalised form.
+    """
+    return hashlib.sha256(normalise_text(text).encode("utf-8")).hexdigest()
+
+
+# ========================================
+# 💾 SQLITE-BACKED LRU CACHE
+# ========================================
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by (model name, normalised text hash).
+    Vectors are stored as float32 blobs; every hit refreshes the entry's last-used
+    timestamp, and the least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Ingestion worker processes share the file: wait for their write locks instead of failing
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, key)
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+        # Running row count, so a write does not have to COUNT(*) the table. Other processes insert
+        # too: the exact count is refreshed whenever the estimate passes the limit, and at least
+        # every (1 - EVICT_TO) * max_entries insertions of this process
+        self._recount()
+
+    def get_many(self, model, keys):
+        """
+        Returns {key: vector} for the keys found in the cache.
+        """
+        found = {}
+        keys = list(set(keys))
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                    [model, *batch]
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                    [(now, model, key) for key in found]
+                )
+                self.conn.commit()
+        return found
+
+    def put_many(self, model, items):
+        """
+        Stores {key: vector} entries and evicts the least recently used ones if over capacity.
+        """
+        now = time.time()
+        rows = [(model, key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+        with self.lock:
+            # Insert new keys first: total_changes then tells exactly how many rows were added
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, key, vector, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            added = self.conn.total_changes - before
+            if added < len(rows):
+                self.conn.executemany(
+                    "UPDATE embeddings SET vector = ?, last_used = ? WHERE model = ? AND key = ?",
+                    [(vector, last_used, model, key) for model, key, vector, last_used in rows]
+                )
+            self.size += added
+            self.added_since_count += added
+            if self.size > self.max_entries or self.added_since_count >= self.max_entries * (1 - EVICT_TO):
+                self._evict()
+            self.conn.commit()
+
+    def _recount(self):
+        (self.size,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        self.added_since_count = 0
+
+    def _evict(self):
+        self._recount()
+        if self.size <= self.max_entries:
+            return
+        excess = self.size - int(self.max_entries * EVICT_TO)
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        self.size -= excess
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM embeddings")
+            self.size = self.added_since_count = 0
+            self.conn.commit()
+
+    def encode(self, texts, model_name=EMBEDDING_MODEL_NAME):
+        """
+        Drop-in replacement for embedder.encode(texts): only texts missing from the cache
+        are sent to the model, each distinct text at most once.
+
+        Parameters:
+        - texts (list[str]): texts to embed
+        - model_name (str): embedding model, part of the cache key (with the backend's precision)
+
+        Returns:
+        - np.ndarray: one float32 vector per input text, in input order
+        """
+        keys = [text_key(text) for text in texts]
+        cached_as = cache_name(model_name)
+        vectors = self.get_many(cached_as, keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, normalise_text(text))
+
+        if missing:
+            with span("encode", texts=len(missing), cached=len(keys) - len(missing)):
+                encoded = get_embedder(model_name).encode(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), np.asarray(encoded, dtype=np.float32)))
+            self.put_many(cached_as, new_vectors)
+            vectors.update(new_vectors)
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+
+def get_embedding_cache(path=CACHE_PATH):
+    """
+    Shared EmbeddingCache instance for the given path.
+    """
+    return get_or_create(("embedding_cache", path), lambda: EmbeddingCache(path))
+
+
+def encode_cached(texts, model_name=EMBEDDING_MODEL_NAME):
+    """
+    Embeds texts through the shared persistent cache.
+    """
+    return get_embedding_cache().encode(texts, model_name=model_name)
@@ -2,11 +2,29 @@
 # 📦 IMPORTS
 # ========================================
 
-import requests
-from vectorial_db import query_chromadb
+from __future__ import annotations
 
-# Import agent components (created in agent.py)
-from agent import agent_executor, parser, modelResponse
+import asyncio
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterator
+
+import numpy as np
+
+from embedding_cache import encode_cached
+from context_builder import AGENT_PROMPT_RESERVE, build_context, context_budget
+from ingestion_manifest import get_revision
+from ollama_client import get_ollama_client
+from resources import DEFAULT_LLM, context_window
+from tracing import ollama_attrs, record_span, span
+from vectorial_db import query_chromadb, retrieve
+
+# Agent components (agent.py) pull in LangChain tools and matplotlib:
+# they are imported only when the structured pipeline is actually used.
+if TYPE_CHECKING:
+    from agent import modelResponse
 
 
 # ========================================
@@ -26,28 +44,248 @@ def generate_text_section(prompt: str, model: str = "mistral", temperature: floa
     Returns:
     - A generated text string
     """
-    url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "stream": False
-    }
+    # Pooled session with timeouts, retries and keep-alive (see ollama_client.py);
+    # num_ctx matches the window the prompt was budgeted for
+    with span("ollama_generate", model=model) as attrs:
+        message = get_ollama_client().generate(prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+                                               options={"num_ctx": context_window(model)})
+        attrs.update(ollama_attrs(message))
+    return message["response"]
 
-    response = requests.post(url, json=payload)
 
-    if response.status_code == 200:
-        return response.json()["response"]
-    else:
-        raise Exception(f"Error during generation: {response.text}")
+# ========================================
+# 🌊 STREAMING GENERATION (TOKEN BY TOKEN)
+# ========================================
+
+class TextStream:
+    """
+    Iterable over the tokens of an Ollama generation, as they are produced.
+
+    After iteration:
+    - text (str): the full generated text
+    - time_to_first_token (float): seconds from request to the first token
+    - total_time (float): seconds from request to the end of the generation
+    - stats (dict): Ollama's final message (eval_count, eval_duration, ...)
+    - cached (bool): True if the text came from the answer cache
+    """
+
+    cached = False
+
+    def __init__(self, prompt: str, model: str = "mistral", temperature: float = 0.7, max_tokens: int = 512,
+                 on_complete: Callable[[str], None] | None = None, read_timeout: float | None = None):
+        self.prompt = prompt
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.on_complete = on_complete
+        self.read_timeout = read_timeout
+        self.text = ""
+        self.time_to_first_token = None
+        self.total_time = None
+        self.stats = {}
+
+    def __iter__(self) -> Iterator[str]:
+        started = time.perf_counter()
+        parts = []
+
+        for message in get_ollama_client().stream_generate(
+            self.prompt, model=self.model, temperature=self.temperature, max_tokens=self.max_tokens,
+            options={"num_ctx": context_window(self.model)}, read_timeout=self.read_timeout
+        ):
+            token = message.get("response", "")
+            if token:
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - started
+                parts.append(token)
+                yield token
+
+            if message.get("done"):
+                self.stats = message
+
+        self.text = "".join(parts)
+        self.total_time = time.perf_counter() - started
+        record_span("ollama_generate", self.total_time, model=self.model,
+                    time_to_first_token=self.time_to_first_token, **ollama_attrs(self.stats))
+        if self.on_complete:
+            self.on_complete(self.text)
+
+
+class CachedTextStream(TextStream):
+    """
+    TextStream replaying an answer served by the semantic answer cache.
+    """
+
+    cached = True
+
+    def __init__(self, text: str):
+        super().__init__(prompt="")
+        self.text = text
+        self.time_to_first_token = 0.0
+        self.total_time = 0.0
+
+    def __iter__(self) -> Iterator[str]:
+        yield self.text
+
+
+def stream_text_section(prompt: str, model: str = "mistral", temperature: float = 0.7, max_tokens: int = 512,
+                        read_timeout: float | None = None) -> TextStream:
+    """
+    Streaming variant of generate_text_section: returns a TextStream that yields tokens
+    as Ollama produces them, and exposes the full text and time-to-first-token at the end.
+    read_timeout bounds the wait for each token (None = the client's READ_TIMEOUT).
+    """
+    return TextStream(prompt, model=model, temperature=temperature, max_tokens=max_tokens, read_timeout=read_timeout)
+
+
+async def astream_text_section(prompt: str, model: str = "mistral", temperature: float = 0.7,
+                               max_tokens: int = 512) -> AsyncIterator[str]:
+    """
+    Async variant of stream_text_section, for asyncio callers.
+    The blocking HTTP stream is consumed on a worker thread and tokens are handed over through a queue.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def pump():
+        try:
+            for token in stream_text_section(prompt, model=model, temperature=temperature, max_tokens=max_tokens):
+                loop.call_soon_threadsafe(queue.put_nowait, token)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(pump,), daemon=True).start()
+
+    while (item := await queue.get()) is not done:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+# ========================================
+# ♻️ SEMANTIC ANSWER CACHE
+# ========================================
+
+# Minimum cosine similarity between two prompts for them to share an answer
+ANSWER_CACHE_THRESHOLD = 0.95
+
+# Maximum number of cached answers (least recently used are evicted)
+ANSWER_CACHE_SIZE = 256
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of generated sections.
+
+    An entry is reused only if model, temperature, pipeline kind and the exact list of
+    retrieved chunk IDs match, and the new prompt's embedding has cosine similarity
+    >= threshold with the cached prompt (so paraphrases of the same request hit).
+    The whole cache is dropped whenever the indexed collection changes revision.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (key, entry_id) -> (unit prompt embedding, answer)
+        self.revision = None
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    @staticmethod
+    def _embed(prompt):
+        vector = encode_cached([prompt])[0].astype(np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _check_revision(self):
+        revision = get_revision()
+        if revision != self.revision:
+            self.entries.clear()
+            self.revision = revision
+
+    def get(self, key, prompt):
+        """
+        Returns the cached answer for a similar prompt under the same key, or None.
+        """
+        embedding = self._embed(prompt)
+        with self.lock:
+            self._check_revision()
+            best, best_score = None, self.threshold
+            for entry_key, (cached_embedding, answer) in self.entries.items():
+                if entry_key[0] != key:
+                    continue
+                score = float(np.dot(embedding, cached_embedding))
+                if score >= best_score:
+                    best, best_score = entry_key, score
+            if best is None:
+                return None
+            self.entries.move_to_end(best)
+            return self.entries[best][1]
+
+    def put(self, key, prompt, answer):
+        embedding = self._embed(prompt)
+        with self.lock:
+            self._check_revision()
+            self.entries[(key, self._next_id)] = (embedding, answer)
+            self._next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+answer_cache = SemanticAnswerCache()
+
+
+def _chunk_keys(chunk_ids, metadatas):
+    """
+    Collection-qualified chunk IDs, used in cache keys (IDs are only unique within a collection).
+    """
+    return tuple((meta.get("collection"), chunk_id) for chunk_id, meta in zip(chunk_ids, metadatas))
 
 
 # ========================================
 # 🤖 SIMPLE PIPELINE: RETRIEVAL + RAW LLM
 # ========================================
 
-def generate_section_from_documents(prompt: str, model: str = "mistral", n_results: int = 5) -> str:
+def build_contextual_prompt(prompt: str, chunk_list: list[str], metadatas: list[dict] | None = None,
+                            model: str = DEFAULT_LLM, max_tokens: int = 512) -> str:
+    """
+    Wraps the retrieved chunks and the user question into the RAG prompt.
+    The context is deduplicated, put in document order and fitted to the model's window,
+    leaving room for the question and `max_tokens` of answer (see context_builder.py).
+    """
+    header = "Use the following information to answer the question:\n\n"
+    footer = f"\n\nQuestion: {prompt}\n\nAnswer:"
+    with span("build_context", chunks=len(chunk_list)):
+        budget = context_budget(model, fixed_prompt=header + footer, max_tokens=max_tokens)
+        context = build_context(chunk_list, metadatas, budget=budget)
+
+    return f"{header}{context}{footer}"
+
+
+def _retrieve_context(prompt, sub_queries, n_results, retrieval_mode, where, collections, rerank):
+    """
+    (ids, chunks, metadatas) for a prompt. With sub-queries (e.g. one per ESG pillar), the prompt
+    and its sub-queries are retrieved in one batched call and merged without duplicates.
+    """
+    if not sub_queries:
+        return query_chromadb(prompt, n_results=n_results, mode=retrieval_mode, with_details=True, where=where,
+                              collections=collections, rerank=rerank)
+    queries = [prompt, *sub_queries]
+    merged = retrieve(queries, n_results=n_results, mode=retrieval_mode, where=where, collections=collections,
+                      rerank=rerank, merge=True, max_merged=n_results * len(queries))
+    return merged.ids, merged.documents, merged.metadatas
+
+
+def generate_section_from_documents(prompt: str, model: str = "mistral", n_results: int = 5,
+                                    retrieval_mode: str = "hybrid", temperature: float = 0.7,
+                                    use_cache: bool = True, where: dict | None = None,
+                                    collections: list[str] | None = None, rerank: bool = False,
+                                    sub_queries: list[str] | None = None) -> str:
     """
     Combines document retrieval and LLM generation (without agent, returns plain text).
 
@@ -55,55 +293,139 @@ def generate_section_from_documents(prompt: str, model: str = "mistral", n_resul
     - prompt (str): User question
     - model (str): LLM model name
     - n_results (int): Number of top chunks to retrieve from ChromaDB
+    - retrieval_mode (str): "hybrid" (BM25 + vector, fused) or "vector"
+    - temperature (float): Sampling temperature
+    - use_cache (bool): Reuse the answer of a near-identical prompt over the same chunks
+    - where (dict): Chroma metadata filter (document, year, page range), see vectorial_db.build_where
+    - collections (list[str]): Collections (per-client/per-year indexes) to retrieve from
+    - rerank (bool): Re-order a wider candidate set with the local cross-encoder (see reranker.py)
+    - sub_queries (list[str]): Extra queries (e.g. one per ESG pillar) retrieved in the same batch and merged
 
     Returns:
     - Generated text from LLM, based on retrieved chunks
     """
     # Step 1: Retrieve relevant chunks from vector DB
-    chunk_list = query_chromadb(prompt, n_results=n_results)
+    chunk_ids, chunk_list, metadatas = _retrieve_context(prompt, sub_queries, n_results, retrieval_mode, where,
+                                                          collections, rerank)
 
     if not chunk_list:
         raise ValueError("⚠️ No relevant documents found in ChromaDB.")
 
-    # Step 2: Build context string from retrieved chunks
-    context = "\n\n".join(chunk_list)
+    cache_key = ("text", model, temperature, _chunk_keys(chunk_ids, metadatas))
+    if use_cache and (cached := answer_cache.get(cache_key, prompt)) is not None:
+        return cached
 
-    contextual_prompt = (
-        f"Use the following information to answer the question:\n\n"
-        f"{context}\n\n"
-        f"Question: {prompt}\n\n"
-        f"Answer:"
-    )
+    # Step 2: Build context string from retrieved chunks
+    contextual_prompt = build_contextual_prompt(prompt, chunk_list, metadatas, model=model)
 
     # Step 3: Generate text using local LLM
-    answer = generate_text_section(contextual_prompt, model=model)
+    answer = generate_text_section(contextual_prompt, model=model, temperature=temperature)
+
+    if use_cache:
+        answer_cache.put(cache_key, prompt, answer)
 
     return answer
 
 
+def stream_section_from_documents(prompt: str, model: str = "mistral", n_results: int = 5,
+                                  retrieval_mode: str = "hybrid", temperature: float = 0.7,
+                                  use_cache: bool = True, where: dict | None = None,
+                                  collections: list[str] | None = None, rerank: bool = False,
+                                  sub_queries: list[str] | None = None) -> TextStream:
+    """
+    Streaming variant of generate_section_from_documents: retrieval runs immediately,
+    generation starts when the returned TextStream is iterated.
+
+    Parameters: same as generate_section_from_documents
+
+    Returns:
+    - TextStream yielding the answer token by token (a CachedTextStream on a cache hit)
+    """
+    chunk_ids, chunk_list, metadatas = _retrieve_context(prompt, sub_queries, n_results, retrieval_mode, where,
+                                                          collections, rerank)
+
+    if not chunk_list:
+        raise ValueError("⚠️ No relevant documents found in ChromaDB.")
+
+    cache_key = ("text", model, temperature, _chunk_keys(chunk_ids, metadatas))
+    if use_cache and (cached := answer_cache.get(cache_key, prompt)) is not None:
+        return CachedTextStream(cached)
+
+    return TextStream(
+        build_contextual_prompt(prompt, chunk_list, metadatas, model=model),
+        model=model,
+        temperature=temperature,
+        on_complete=(lambda text: answer_cache.put(cache_key, prompt, text)) if use_cache else None
+    )
+
+
 # ========================================
-# 🧠 ADVANCED PIPELINE: RETRIEVAL + LANGCHAIN AGENT
+# 🧠 ADVANCED PIPELINE: RETRIEVAL + STRUCTURED GENERATION
 # ========================================
 
-def generate_structured_section(query: str, n_results: int = 5) -> modelResponse:
+def generate_structured_section(query: str, n_results: int = 5, retrieval_mode: str = "hybrid",
+                                use_cache: bool = True, where: dict | None = None,
+                                collections: list[str] | None = None, rerank: bool = False,
+                                sub_queries: list[str] | None = None, fast: bool = True,
+                                colors: list[str] | None = None) -> modelResponse:
     """
     Retrieves context from ChromaDB and generates a structured ESG section
-    using the LangChain agent with tools (charts, tables, etc.).
+    with charts and tables.
 
     Parameters:
     - query (str): User question or request (e.g. "What is the environmental impact?")
     - n_results (int): Number of top chunks to retrieve from ChromaDB
+    - retrieval_mode (str): "hybrid" (BM25 + vector, fused) or "vector"
+    - use_cache (bool): Reuse the section generated for a near-identical query over the same chunks
+    - where (dict): Chroma metadata filter (document, year, page range), see vectorial_db.build_where
+    - collections (list[str]): Collections (per-client/per-year indexes) to retrieve from
+    - rerank (bool): Re-order a wider candidate set with the local cross-encoder (see reranker.py)
+    - sub_queries (list[str]): Extra queries (e.g. one per ESG pillar) retrieved in the same batch and merged
+    - fast (bool): One JSON-constrained generation with charts/tables rendered locally (agent.generate_plan);
+      False runs the LangChain tool-calling agent, one LLM round-trip per tool call
+    - colors (list[str]): Brand palette of the charts (fast path)
 
     Returns:
     - modelResponse: Structured output with title, paragraph, graphs, tables, sources
     """
+    from agent import PLAN_MAX_TOKENS, generate_plan, get_agent_executor, parser, render_plan
+
     # Step 1: Retrieve relevant context
-    chunk_list = query_chromadb(query, n_results=n_results)
+    chunk_ids, chunk_list, metadatas = _retrieve_context(query, sub_queries, n_results, retrieval_mode, where,
+                                                          collections, rerank)
 
     if not chunk_list:
         raise ValueError("⚠️ No relevant documents found in ChromaDB.")
 
-    context = "\n\n".join(chunk_list)
+    cache_key = ("structured" if fast else "structured_agent", DEFAULT_LLM, tuple(colors or ()),
+                 _chunk_keys(chunk_ids, metadatas))
+    if use_cache and (cached := answer_cache.get(cache_key, query)) is not None:
+        return cached.model_copy(deep=True)
+
+    with span("build_context", chunks=len(chunk_list)):
+        context = build_context(chunk_list, metadatas,
+                                budget=context_budget(DEFAULT_LLM, fixed_prompt=query,
+                                                      max_tokens=PLAN_MAX_TOKENS if fast else 512,
+                                                      reserve=AGENT_PROMPT_RESERVE))
+
+    if fast:
+        # Steps 2-3: One generation for the whole section, then the declared visuals in parallel
+        structured = render_plan(generate_plan(query, context, model=DEFAULT_LLM, collections=collections), colors=colors)
+    else:
+        structured = _invoke_agent(query, context, get_agent_executor(), parser, collections=collections)
+
+    if use_cache:
+        answer_cache.put(cache_key, query, structured.model_copy(deep=True))
+
+    return structured
+
+
+def _invoke_agent(query, context, agent_executor, parser, collections=None):
+    """
+    Tool-calling agent path of generate_structured_section
+    (find_kpi_tables searches the tables of the same collections as the retrieval).
+    """
+    from tools import collezioni_tabelle
 
     # Step 2: Compose full input for the agent
     full_input = {
@@ -112,8 +434,10 @@ def generate_structured_section(query: str, n_results: int = 5) -> modelResponse
         "agent_scratchpad": ""
     }
 
-    # Step 3: Call the agent
-    raw_response = agent_executor.invoke(full_input)
+    # Step 3: Call the agent (async: the tool calls of one step render concurrently, see tools.arun_tools)
+    with span("agent_invoke", model=DEFAULT_LLM):
+        with collezioni_tabelle(collections):
+            raw_response = asyncio.run(agent_executor.ainvoke(full_input))
 
     # Step 4: Parse the response using the output parser
     try:
@@ -122,8 +446,7 @@ def generate_structured_section(query: str, n_results: int = 5) -> modelResponse
             # In some LangChain configs, output is a list of steps
             output_text = output_text[0].get("text", "")
 
-        structured = parser.parse(output_text)
-        return structured
+        return parser.parse(output_text)
 
     except Exception as e:
-        raise ValueError(f"❌ Failed to parse structured output:\n{e}\nRaw output:\n{raw_response}")
\ No newline at end of file
+        raise ValueError(f"❌ Failed to parse structured output:\n{e}\nRaw output:\n{raw_response}")
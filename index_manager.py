@@ -0,0 +1,235 @@
+# ========================================
+# 🗄️ MODULE: index_manager.py
+# Per-client / per-year ChromaDB collections: create, list, compact, reset, drop
+# ========================================
+
+import os
+import re
+import threading
+
+import ingestion_manifest
+from bm25_index import drop_bm25_index
+from kpi_tables import drop_tables
+from resources import CHROMA_PATH, COLLECTION_NAME, forget, get_chroma_client, get_or_create
+from vector_store import DEFAULT_HNSW, VECTOR_BACKEND, drop_vector_store, get_vector_store, list_vector_stores
+
+
+# ========================================
+# ⚙️ INDEX PARAMETERS
+# (HNSW defaults of new collections: DEFAULT_HNSW in vector_store.py, overridable with HNSW_* variables)
+# ========================================
+
+# Records copied per batch when compacting a collection
+COPY_BATCH_SIZE = 1000
+
+# Temporary collections of a compaction: the fresh copy, then the original until the copy has taken its name
+COMPACT_SUFFIX = "__compact"
+BACKUP_SUFFIX = "__backup"
+
+# Compactions and their recovery never run at the same time in this process (the only Chroma writer)
+_compaction_lock = threading.RLock()
+
+
+def index_name(client, year=None):
+    """
+    Collection name for a client (and optionally a reporting year), e.g. ("ACME S.p.A.", 2023) -> "esg_acme_s.p.a_2023".
+    Chroma names must be 3-63 characters of [a-zA-Z0-9._-], starting and ending with an alphanumeric character.
+    """
+    slug = re.sub(r"[^a-z0-9._-]+", "_", client.strip().lower()).strip("._-")
+    name = f"esg_{slug}" + (f"_{year}" if year is not None else "")
+    return name[:63].rstrip("._-")
+
+
+# ========================================
+# 🧭 COLLECTION LIFECYCLE
+# ========================================
+
+def create_index(name, hnsw=None, path=CHROMA_PATH):
+    """
+    Creates a collection with its own HNSW parameters (or returns it if it already exists).
+
+    Parameters:
+    - name (str): collection name (see index_name)
+    - hnsw (dict): overrides for DEFAULT_HNSW, e.g. {"hnsw:M": 32}
+    - path (str): ChromaDB directory
+
+    Returns:
+    - chromadb Collection
+    """
+    metadata = {**DEFAULT_HNSW, **(hnsw or {})}
+    return get_or_create(
+        ("collection", path, name),
+        lambda: get_chroma_client(path).get_or_create_collection(name=name, metadata=metadata)
+    )
+
+
+def list_indexes(path=CHROMA_PATH):
+    """
+    Lists the collections with their size and HNSW settings.
+
+    Returns:
+    - List[dict]: {"name", "count", "metadata"} per collection, sorted by name
+    """
+    client = get_chroma_client(path)
+    recover_compactions(path)
+    indexes = {}
+    for name in _collection_names(client):
+        if name.endswith((COMPACT_SUFFIX, BACKUP_SUFFIX)):
+            continue
+        collection = client.get_collection(name=name)
+        indexes[name] = {"name": name, "count": collection.count(), "metadata": collection.metadata or {}}
+
+    # With a compact vector backend the records live outside Chroma
+    if VECTOR_BACKEND != "chroma":
+        for name in list_vector_stores(path=path):
+            metadata = indexes.get(name, {}).get("metadata", {})
+            indexes[name] = {"name": name, "count": get_vector_store(name, path=path).count(),
+                             "metadata": {**metadata, "vector_backend": VECTOR_BACKEND}}
+    return sorted(indexes.values(), key=lambda index: index["name"])
+
+
+def _forget_collection(name, path):
+    forget("collection", path, name)
+
+
+def _collection_names(client):
+    # chromadb >= 0.6 returns names, older versions return Collection objects
+    return [entry if isinstance(entry, str) else entry.name for entry in client.list_collections()]
+
+
+def _compaction_names(name):
+    # Chroma names are limited to 63 characters
+    return f"{name[:54]}{COMPACT_SUFFIX}", f"{name[:54]}{BACKUP_SUFFIX}"
+
+
+def recover_compaction(name, path=CHROMA_PATH):
+    """
+    Repairs a compaction of `name` interrupted by a crash: if the collection is missing, its backup
+    (the untouched original) or else its complete copy takes the name back; leftover temporary
+    collections are then deleted.
+    """
+    with _compaction_lock:
+        client = get_chroma_client(path)
+        names = set(_collection_names(client))
+        tmp_name, backup_name = _compaction_names(name)
+        if name not in names:
+            restored = backup_name if backup_name in names else tmp_name if tmp_name in names else None
+            if restored is None:
+                return
+            client.get_collection(name=restored).modify(name=name)
+            names.discard(restored)
+            _forget_collection(name, path)
+            _forget_collection(restored, path)
+            print(f"♻️ Restored collection {name} from {restored} after an interrupted compaction")
+        for leftover in (tmp_name, backup_name):
+            if leftover in names:
+                client.delete_collection(name=leftover)
+                _forget_collection(leftover, path)
+
+
+def recover_compactions(path=CHROMA_PATH):
+    """
+    Runs recover_compaction for every collection left with compaction temporaries.
+    """
+    client = get_chroma_client(path)
+    names = _collection_names(client)
+    for name in names:
+        for suffix in (COMPACT_SUFFIX, BACKUP_SUFFIX):
+            if name.endswith(suffix):
+                prefix = name[:-len(suffix)]
+                # Names longer than 54 characters were truncated in the temporaries
+                original = next((n for n in names if n[:54] == prefix and not n.endswith((COMPACT_SUFFIX, BACKUP_SUFFIX))), prefix)
+                recover_compaction(original, path)
+
+
+def drop_index(name, path=CHROMA_PATH):
+    """
+    Deletes a collection together with its compact vector stores, ingestion manifest, keyword index
+    and extracted tables.
+    """
+    client = get_chroma_client(path)
+    try:
+        client.delete_collection(name=name)
+    except Exception as e:
+        # Missing collection: nothing left to delete in Chroma
+        print(f"⚠️ Collection {name} not deleted: {e}")
+    _forget_collection(name, path)
+    drop_vector_store(name, path)
+
+    ingestion_manifest.clear_manifest(name)
+    drop_bm25_index(name)
+    drop_tables(name)
+
+
+def reset_index(name=COLLECTION_NAME, path=CHROMA_PATH):
+    """
+    Empties a collection through the Chroma API (keeping its HNSW parameters),
+    and forgets everything indexed in it.
+    """
+    client = get_chroma_client(path)
+    try:
+        metadata = client.get_collection(name=name).metadata or DEFAULT_HNSW
+    except Exception:
+        metadata = DEFAULT_HNSW
+    drop_index(name, path)
+    create_index(name, hnsw=metadata, path=path)
+
+
+def compact_index(name, path=CHROMA_PATH, hnsw=None):
+    """
+    Rebuilds a collection's HNSW graph from its live records only.
+    Deletes and upserts leave tombstones in the graph; copying the records into a fresh
+    collection and swapping names reclaims that space and restores search quality.
+    The original is renamed to a backup until the copy has taken its name; a compaction
+    interrupted in between is repaired by recover_compaction.
+    New HNSW parameters can be applied at the same time.
+
+    With a compact vector backend, its vector file is rewritten without tombstones instead.
+
+    Returns:
+    - int: number of records copied
+    """
+    if VECTOR_BACKEND != "chroma":
+        copied = get_vector_store(name, path=path).compact()
+        ingestion_manifest.bump_revision()
+        print(f"✅ Compacted {name}: {copied} records")
+        return copied
+
+    with _compaction_lock:
+        # A previous compaction cut short by a crash is finished or rolled back first
+        recover_compaction(name, path)
+        client = get_chroma_client(path)
+        source = client.get_collection(name=name)
+        metadata = {**(source.metadata or DEFAULT_HNSW), **(hnsw or {})}
+
+        tmp_name, backup_name = _compaction_names(name)
+        target = client.create_collection(name=tmp_name, metadata=metadata)
+
+        copied = 0
+        while True:
+            page = source.get(include=["embeddings", "documents", "metadatas"], limit=COPY_BATCH_SIZE, offset=copied)
+            if not page["ids"]:
+                break
+            target.add(ids=page["ids"], embeddings=page["embeddings"], documents=page["documents"], metadatas=page["metadatas"])
+            copied += len(page["ids"])
+
+        # The original is only deleted once the copy holds its name, so a crash never loses the collection
+        source.modify(name=backup_name)
+        target.modify(name=name)
+        client.delete_collection(name=backup_name)
+        for stale in (name, tmp_name, backup_name):
+            _forget_collection(stale, path)
+        ingestion_manifest.bump_revision()
+
+    print(f"✅ Compacted {name}: {copied} records")
+    return copied
+
+
+def index_size_on_disk(path=CHROMA_PATH):
+    """
+    Total size in bytes of the ChromaDB directory (all collections).
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
@@ -0,0 +1,569 @@
+# ========================================
+# 🏭 MODULE: ingestion_jobs.py
+# Persistent ingestion job queue: worker processes parse and embed, one writer stores
+# ========================================
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import ingestion_manifest
+from bm25_index import get_bm25_index
+from embedding_cache import encode_cached
+from kpi_tables import drop_tables, store_tables
+from parser import estrai_tabelle, itera_pagine
+from resources import COLLECTION_NAME, get_or_create
+from tracing import trace
+from vector_store import get_vector_store
+from vectorial_db import EMBED_BATCH_SIZE, iter_batches, iter_chunks, make_splitter, store_in_chromadb
+
+
+# ========================================
+# ⚙️ QUEUE CONFIGURATION
+# ========================================
+
+JOBS_DB_PATH = "./cache/ingestion_jobs.sqlite3"
+
+# Page texts of parsed documents, waiting to be stored
+SPOOL_DIR = "./cache/ingestion_jobs"
+
+DEFAULT_WORKERS = 2
+MAX_ATTEMPTS = 3
+
+# Seconds before a failed job is retried (doubled at every attempt)
+RETRY_BACKOFF = 10
+
+# A running job whose heartbeat is older than this is considered orphaned (crashed worker, app restart)
+STALE_AFTER = 120
+
+POLL_INTERVAL = 1.0
+
+# Minimum seconds between two progress writes of the same job
+PROGRESS_EVERY = 0.5
+
+# Job lifecycle:
+#   queued -> parsing -> embedding -> ready -> storing -> done
+# Worker processes own parsing/embedding; the page texts are spooled to disk and the vectors land
+# in the shared embedding cache. Chroma, the keyword index and the manifest are written only by the
+# store thread of the app process (Chroma's persistent client must not be shared across processes),
+# which finds every vector in the cache. Failures go back to queued/ready until MAX_ATTEMPTS.
+ACTIVE_STATUSES = ("queued", "parsing", "embedding", "ready", "storing")
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a running job when its cancellation has been requested.
+    """
+
+
+# ========================================
+# 🗃️ SQLITE JOB STORE
+# ========================================
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    collection_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    estensione TEXT NOT NULL,
+    file_hash TEXT,
+    chunk_size INTEGER NOT NULL,
+    overlap INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    progress_done INTEGER NOT NULL DEFAULT 0,
+    progress_total INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat_at REAL,
+    next_run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, next_run_at);
+"""
+
+
+def _connect(path=JOBS_DB_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # isolation_level=None: transactions are opened explicitly (BEGIN IMMEDIATE) where needed
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _get_conn():
+    """
+    Connection of the current process (one per process: sqlite connections must not cross a fork/spawn).
+    """
+    return get_or_create(("ingestion_jobs_db", JOBS_DB_PATH, os.getpid()), _connect)
+
+
+_write_lock = threading.Lock()
+
+
+def _execute(sql, params=()):
+    """
+    Runs one statement (autocommit) and returns its rows.
+    """
+    with _write_lock:
+        return _get_conn().execute(sql, params).fetchall()
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    _execute(f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), job_id])
+
+
+def _spool_path(job_id):
+    # JSON lines: one page text per line, written and read one page at a time
+    return os.path.join(SPOOL_DIR, f"{job_id}.jsonl")
+
+
+def _remove_spool(job_id):
+    for path in (_spool_path(job_id), _spool_path(job_id) + ".tmp"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _read_spool(job_id):
+    """
+    Page texts of a spooled job, one at a time.
+    """
+    with open(_spool_path(job_id), "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _spool_size(job_id):
+    """
+    Number of spooled pages (raises FileNotFoundError if the spool is lost).
+    """
+    with open(_spool_path(job_id), "rb") as f:
+        return sum(1 for _ in f)
+
+
+def _with_progress(pagine, progress, total):
+    for done, pagina in enumerate(pagine, start=1):
+        progress(done, total)
+        yield pagina
+
+
+# ========================================
+# 📮 PUBLIC API (used by the app)
+# ========================================
+
+def submit_job(file_path, file_hash=None, collection_name=COLLECTION_NAME, chunk_size=500, overlap=50,
+               max_attempts=MAX_ATTEMPTS):
+    """
+    Queues a document for ingestion.
+    A job already recorded for the same file content and collection (running, failed or
+    cancelled) is returned instead of a duplicate; use retry_job to run it again.
+
+    Returns:
+    - str: job ID
+    """
+    nome, estensione = os.path.splitext(os.path.basename(file_path))
+    existing = _execute(
+        "SELECT id FROM jobs WHERE collection_name = ? AND nome = ? AND file_hash IS ? AND status != 'done' "
+        "ORDER BY created_at DESC LIMIT 1",
+        (collection_name, nome, file_hash)
+    )
+    if existing:
+        return existing[0]["id"]
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    _execute(
+        "INSERT INTO jobs (id, collection_name, file_path, nome, estensione, file_hash, chunk_size, overlap, "
+        "status, max_attempts, next_run_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+        (job_id, collection_name, file_path, nome, estensione, file_hash, chunk_size, overlap,
+         max_attempts, now, now, now)
+    )
+    return job_id
+
+
+def get_job(job_id):
+    """
+    Current state of a job as a dict (None if unknown).
+    """
+    rows = _execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    return dict(rows[0]) if rows else None
+
+
+def list_jobs(collection_name=None, limit=50):
+    """
+    Most recent jobs first, optionally for one collection.
+    """
+    if collection_name is None:
+        rows = _execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+    else:
+        rows = _execute("SELECT * FROM jobs WHERE collection_name = ? ORDER BY created_at DESC LIMIT ?",
+                        (collection_name, limit))
+    return [dict(row) for row in rows]
+
+
+def cancel_job(job_id):
+    """
+    Cancels a job: waiting jobs stop immediately, running ones at their next progress checkpoint.
+    """
+    now = time.time()
+    _execute(
+        "UPDATE jobs SET status = 'cancelled', finished_at = ?, updated_at = ? WHERE id = ? AND status IN ('queued', 'ready')",
+        (now, now, job_id)
+    )
+    _execute(
+        "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status IN ('parsing', 'embedding', 'storing')",
+        (now, job_id)
+    )
+    if get_job(job_id)["status"] == "cancelled":
+        _remove_spool(job_id)
+
+
+def retry_job(job_id):
+    """
+    Puts a failed or cancelled job back in the queue, with a fresh attempt budget.
+    """
+    now = time.time()
+    _execute(
+        "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, cancel_requested = 0, progress_done = 0, "
+        "progress_total = 0, finished_at = NULL, next_run_at = ?, updated_at = ? "
+        "WHERE id = ? AND status IN ('failed', 'cancelled')",
+        (now, now, job_id)
+    )
+
+
+def clear_finished_jobs():
+    """
+    Deletes done, failed and cancelled jobs from the queue history.
+    """
+    _execute(f"DELETE FROM jobs WHERE status IN ({','.join('?' * len(FINAL_STATUSES))})", FINAL_STATUSES)
+
+
+# ========================================
+# 🔒 CLAIMING, RETRIES AND RECOVERY
+# ========================================
+
+def _recover_stale_jobs(conn):
+    """
+    Sends jobs whose worker stopped sending heartbeats back to the step they were in.
+    The lost run counts as a failed attempt, so a document that keeps killing its worker
+    (out of memory, crash in PyMuPDF or OCR) ends up failed instead of being retried forever.
+    """
+    stale = conn.execute(
+        "SELECT * FROM jobs WHERE status IN ('parsing', 'embedding', 'storing') AND heartbeat_at < ?",
+        (time.time() - STALE_AFTER,)
+    ).fetchall()
+    for row in stale:
+        job = dict(row)
+        fields = _failure_fields(job, "worker stopped responding (crash or restart)",
+                                 retry_status="ready" if job["status"] == "storing" else "queued")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), job["id"]])
+        _report_failure(job, fields)
+
+
+def _claim(from_status, to_status, worker):
+    """
+    Atomically takes the oldest due job in `from_status` (safe across processes: BEGIN IMMEDIATE
+    holds the database write lock between the SELECT and the UPDATE).
+    """
+    with _write_lock:
+        conn = _get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _recover_stale_jobs(conn)
+            now = time.time()
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND next_run_at <= ? ORDER BY created_at LIMIT 1",
+                (from_status, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, heartbeat_at = ?, updated_at = ?, "
+                    "progress_done = 0, progress_total = 0 WHERE id = ?",
+                    (to_status, worker, now, now, row["id"])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return {**dict(row), "status": to_status, "worker": worker} if row is not None else None
+
+
+def _failure_fields(job, error, retry_status):
+    """
+    Columns of a job after a failed attempt: back to `retry_status` after a backoff, or failed for good.
+    """
+    now = time.time()
+    attempts = job["attempts"] + 1
+    if attempts < job["max_attempts"]:
+        return {"status": retry_status, "attempts": attempts, "error": error, "worker": None,
+                "next_run_at": now + RETRY_BACKOFF * 2 ** (attempts - 1), "updated_at": now}
+    return {"status": "failed", "attempts": attempts, "error": error, "worker": None, "finished_at": now,
+            "updated_at": now}
+
+
+def _report_failure(job, fields):
+    if fields["status"] == "failed":
+        _remove_spool(job["id"])
+        print(f"❌ Ingestion job {job['nome']} failed: {fields['error']}")
+    else:
+        print(f"⚠️ Ingestion job {job['nome']} failed (attempt {fields['attempts']}), retrying: {fields['error']}")
+
+
+def _fail(job, error, retry_status):
+    """
+    Records a failure: the job goes back to `retry_status` after a backoff, or fails for good.
+    """
+    fields = _failure_fields(job, error, retry_status)
+    _update(job["id"], **fields)
+    _report_failure(job, fields)
+
+
+class _Progress:
+    """
+    Throttled progress/heartbeat writer that also checks for cancellation.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.last = 0.0
+
+    def __call__(self, done, total, status=None, force=False):
+        now = time.time()
+        if not force and now - self.last < PROGRESS_EVERY:
+            return
+        self.last = now
+        fields = {"progress_done": done, "progress_total": total, "heartbeat_at": now}
+        if status:
+            fields["status"] = status
+        _update(self.job_id, **fields)
+        if _execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.job_id,))[0][0]:
+            raise JobCancelled()
+
+
+class _Heartbeat:
+    """
+    Keeps the heartbeat of a running job fresh from a side thread, also during steps that
+    report no progress for minutes (table extraction, OCR of scanned pages, the final Chroma
+    writes and deletes of a store), so the job is not taken for orphaned and run a second time.
+    """
+
+    def __init__(self, job_id, interval=STALE_AFTER / 4):
+        self.job_id = job_id
+        self.interval = interval
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"heartbeat-{job_id}")
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            _update(self.job_id, heartbeat_at=time.time())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+
+
+def _cancelled(job):
+    _update(job["id"], status="cancelled", worker=None, finished_at=time.time())
+    _remove_spool(job["id"])
+    print(f"🛑 Ingestion job {job['nome']} cancelled")
+
+
+# ========================================
+# ⚙️ WORKER PROCESSES: PARSE + CHUNK + EMBED
+# ========================================
+
+def prepare_job(job, progress):
+    """
+    Parses the document, spools its page texts, stores its tables and fills the embedding cache with its chunks.
+    """
+    # Pages go to the spool as they are extracted: only one page is held in memory
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    tmp_path = _spool_path(job["id"]) + ".tmp"
+    n_pagine = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for pagina in itera_pagine(job["file_path"], progress_callback=lambda _, done, total: progress(done, total)):
+            f.write(json.dumps(pagina, ensure_ascii=False) + "\n")
+            n_pagine += 1
+    os.replace(tmp_path, _spool_path(job["id"]))
+
+    # Tables go to their own Parquet store (plain files, safe to write from a worker process)
+    store_tables(job["nome"], estrai_tabelle(job["file_path"]), collection_name=job["collection_name"])
+
+    # Same chunks as store_in_chromadb, streamed back from the spool: the store step will find every
+    # vector in the cache (progress counts pages)
+    progress(0, n_pagine, status="embedding", force=True)
+    pagine = _with_progress(_read_spool(job["id"]), progress, n_pagine)
+    for batch in iter_batches(iter_chunks(pagine, make_splitter(job["chunk_size"], job["overlap"])), EMBED_BATCH_SIZE):
+        encode_cached([chunk for chunk, *_ in batch])
+
+    _update(job["id"], status="ready", worker=None, progress_done=n_pagine, progress_total=n_pagine,
+            next_run_at=time.time())
+
+
+def run_worker(parent_pid=None, poll_interval=POLL_INTERVAL):
+    """
+    Worker process loop: claims queued jobs and prepares them until the parent process exits.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"🏭 Ingestion worker {worker} started")
+    while parent_pid is None or os.getppid() == parent_pid:
+        job = _claim("queued", "parsing", worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        progress = _Progress(job["id"])
+        try:
+            with _Heartbeat(job["id"]), trace("ingest_prepare", document=f"{job['nome']}{job['estensione']}"):
+                prepare_job(job, progress)
+        except JobCancelled:
+            _cancelled(job)
+        except Exception as e:
+            _fail(job, str(e), retry_status="queued")
+
+
+def start_workers(n_workers=DEFAULT_WORKERS):
+    """
+    Starts the worker processes once per app process. They stop by themselves when the
+    app process exits; jobs they were running are picked up again after STALE_AFTER seconds.
+    Workers are not daemonic, so long documents can still be parsed with a process pool.
+    """
+    def factory():
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_worker, args=(os.getpid(),), name=f"ingestion-worker-{i}")
+                     for i in range(n_workers)]
+        for process in processes:
+            process.start()
+        return processes
+
+    return get_or_create(("ingestion_workers", n_workers), factory)
+
+
+# ========================================
+# 💾 STORE THREAD (APP PROCESS): WRITE TO CHROMA
+# ========================================
+
+def _discard_partial(job, keep_tables=False):
+    """
+    Removes the chunks and tables written by an interrupted store of a document that was never fully indexed
+    (documents indexed before keep their manifest, and the next run re-upserts what changed).
+    Tables are kept when the store will be retried: they are written by prepare_job, which a retry skips.
+    """
+    if ingestion_manifest.get_entry(job["nome"], collection_name=job["collection_name"]) is not None:
+        return
+    if not keep_tables:
+        drop_tables(job["collection_name"], origine=job["nome"])
+    collection = get_vector_store(job["collection_name"])
+    ids = collection.get(where={"origine": job["nome"]}, include=[])["ids"]
+    if ids:
+        collection.delete(ids=ids)
+        get_bm25_index(job["collection_name"]).delete(ids)
+        ingestion_manifest.bump_revision()
+
+
+def store_job(job, progress):
+    """
+    Indexes a prepared job's spooled pages into its collection (vectors come from the embedding cache).
+    """
+    n_pagine = _spool_size(job["id"])
+    pagine = _with_progress(_read_spool(job["id"]), progress, n_pagine)
+    store_in_chromadb(job["nome"], job["estensione"], pagine, chunk_size=job["chunk_size"],
+                      overlap=job["overlap"], file_hash=job["file_hash"], collection_name=job["collection_name"])
+    _update(job["id"], status="done", worker=None, error=None, finished_at=time.time())
+    _remove_spool(job["id"])
+    print(f"✅ Ingestion job {job['nome']} done")
+
+
+def run_store_loop(stop_event=None, poll_interval=POLL_INTERVAL):
+    """
+    Claims prepared jobs one at a time and stores them. Must run in the process that owns the Chroma client.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}:store"
+    while stop_event is None or not stop_event.is_set():
+        job = _claim("ready", "storing", worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        progress = _Progress(job["id"])
+        try:
+            with _Heartbeat(job["id"]), trace("ingest_store", document=f"{job['nome']}{job['estensione']}"):
+                store_job(job, progress)
+        except JobCancelled:
+            _discard_partial(job)
+            _cancelled(job)
+        except FileNotFoundError as e:
+            # Spool lost: the document has to be parsed again
+            _fail(job, str(e), retry_status="queued")
+        except Exception as e:
+            _discard_partial(job, keep_tables=job["attempts"] + 1 < job["max_attempts"])
+            _fail(job, str(e), retry_status="ready")
+
+
+def start_store_thread():
+    """
+    Starts the store loop on a daemon thread of the current process (once per process).
+    """
+    def factory():
+        thread = threading.Thread(target=run_store_loop, daemon=True, name="ingestion-store")
+        thread.start()
+        return thread
+
+    return get_or_create(("ingestion_store_thread",), factory)
+
+
+# ========================================
+# 🖥️ COMMAND LINE ENTRY POINT
+# ========================================
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Run ingestion workers without the Streamlit app.")
+    arg_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    arg_parser.add_argument("--store", action="store_true",
+                            help="also store prepared jobs into ChromaDB (only when the app is not running)")
+    arg_parser.add_argument("--submit", nargs="*", default=[], help="PDF files to queue before starting")
+    arg_parser.add_argument("--collection", default=COLLECTION_NAME)
+    args = arg_parser.parse_args(argv)
+
+    for file_path in args.submit:
+        job_id = submit_job(file_path, ingestion_manifest.hash_file(file_path), collection_name=args.collection)
+        print(f"📮 Queued {file_path} ({job_id})")
+
+    processes = start_workers(args.workers)
+    try:
+        if args.store:
+            run_store_loop()
+        else:
+            for process in processes:
+                process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# ========================================
+# 🧾 MODULE: ingestion_manifest.py
+# Tracks what has already been indexed, so re-uploads can be skipped
+# ========================================
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+from resources import CHROMA_PATH, COLLECTION_NAME, get_or_create
+
+
+# ========================================
+# ⚙️ MANIFEST LOCATION
+# ========================================
+
+# The manifest lives next to the ChromaDB files it describes: one SQLite row per (collection, document),
+# so checking or updating a document never reads or rewrites the entries of the others
+MANIFEST_DB_PATH = os.path.join(CHROMA_PATH, "ingestion_manifest.sqlite3")
+
+# Token that changes on every write to any collection (used to invalidate answer caches)
+REVISION_PATH = os.path.join(CHROMA_PATH, "collection_revision")
+
+
+def legacy_manifest_path(collection_name=COLLECTION_NAME):
+    """
+    JSON manifest of a collection written by earlier versions (imported into SQLite on first use).
+    """
+    if collection_name == COLLECTION_NAME:
+        return os.path.join(CHROMA_PATH, "ingestion_manifest.json")
+    return os.path.join(CHROMA_PATH, f"ingestion_manifest_{collection_name}.json")
+
+_lock = threading.Lock()
+
+
+# ========================================
+# 🔑 HASHING HELPERS
+# ========================================
+
+def hash_bytes(data):
+    """
+    Returns the SHA-256 hex digest of raw file content.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(file_path, block_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of a file, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_text(text):
+    """
+    Returns the SHA-256 hex digest of a text chunk.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# ========================================
+# 💾 SQLITE STORE
+# ========================================
+
+# Entry fields stored in their own columns; everything else goes in the JSON "entry" column
+_ENTRY_COLUMNS = ("file_hash", "params", "chunks")
+
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Ingestion workers and the app share the file: wait for their write locks instead of failing
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            collection_name TEXT NOT NULL,
+            nome TEXT NOT NULL,
+            file_hash TEXT,
+            params TEXT NOT NULL,
+            chunks TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            PRIMARY KEY (collection_name, nome)
+        )
+        """
+    )
+    conn.commit()
+    return conn
+
+
+# Collections whose legacy JSON manifest was already looked for in this process
+_imported = set()
+
+
+def _get_conn(collection_name, path=MANIFEST_DB_PATH):
+    """
+    Shared connection of the manifest database, importing the collection's legacy JSON manifest on first use.
+    """
+    conn = get_or_create(("ingestion_manifest_db", path), lambda: _connect(path))
+    if (path, collection_name) not in _imported:
+        _import_legacy_json(conn, collection_name)
+        _imported.add((path, collection_name))
+    return conn
+
+
+def _import_legacy_json(conn, collection_name):
+    json_path = legacy_manifest_path(collection_name)
+    if not os.path.exists(json_path):
+        return
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            files = json.load(f).get("files", {})
+    except (OSError, ValueError):
+        print(f"⚠️ Unreadable ingestion manifest at {json_path}, not imported.")
+        return
+    with _lock:
+        conn.executemany(
+            "INSERT OR IGNORE INTO documents (collection_name, nome, file_hash, params, chunks, entry) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(collection_name, nome, *_entry_row(entry)) for nome, entry in files.items()]
+        )
+        conn.commit()
+    try:
+        os.replace(json_path, f"{json_path}.imported")
+    except OSError:
+        pass  # already imported by another process
+    print(f"🧾 Imported {len(files)} entries of the JSON ingestion manifest of '{collection_name}'.")
+
+
+def _entry_row(entry):
+    rest = {key: value for key, value in entry.items() if key not in _ENTRY_COLUMNS}
+    return (entry.get("file_hash"), json.dumps(entry.get("params", {}), sort_keys=True),
+            json.dumps(entry.get("chunks", {})), json.dumps(rest, ensure_ascii=False))
+
+
+# ========================================
+# 📋 PER-FILE ENTRIES
+# ========================================
+
+def get_entry(nome, collection_name=COLLECTION_NAME):
+    """
+    Returns the manifest entry of an indexed document, or None.
+
+    Entry fields:
+    - file_hash (str): SHA-256 of the source file (None if unknown)
+    - params (dict): chunking/embedding parameters used at indexing time
+    - chunks (dict): {chunk_id: text_hash}
+    - preview (str): first characters of the document text
+    """
+    conn = _get_conn(collection_name)
+    with _lock:
+        row = conn.execute(
+            "SELECT file_hash, params, chunks, entry FROM documents WHERE collection_name = ? AND nome = ?",
+            (collection_name, nome)
+        ).fetchone()
+    if row is None:
+        return None
+    file_hash, params, chunks, entry = row
+    return {**json.loads(entry), "file_hash": file_hash, "params": json.loads(params), "chunks": json.loads(chunks)}
+
+
+def list_entries(collection_name=COLLECTION_NAME):
+    """
+    Entries of every document indexed in a collection, without their chunk hashes.
+
+    Returns:
+    - dict: {nome: entry}
+    """
+    conn = _get_conn(collection_name)
+    with _lock:
+        rows = conn.execute(
+            "SELECT nome, file_hash, params, entry FROM documents WHERE collection_name = ? ORDER BY nome",
+            (collection_name,)
+        ).fetchall()
+    return {nome: {**json.loads(entry), "file_hash": file_hash, "params": json.loads(params)}
+            for nome, file_hash, params, entry in rows}
+
+
+def is_unchanged(nome, file_hash, params, collection_name=COLLECTION_NAME):
+    """
+    True if the document was already indexed from the same file content and with the same parameters.
+    """
+    if file_hash is None:
+        return False
+    conn = _get_conn(collection_name)
+    with _lock:
+        row = conn.execute(
+            "SELECT file_hash, params FROM documents WHERE collection_name = ? AND nome = ?",
+            (collection_name, nome)
+        ).fetchone()
+    return row is not None and row[0] == file_hash and json.loads(row[1]) == params
+
+
+def update_entry(nome, entry, collection_name=COLLECTION_NAME):
+    """
+    Creates or replaces the manifest entry of a document.
+    The revision is bumped only if the stored entry actually changed.
+    """
+    row = _entry_row(entry)
+    conn = _get_conn(collection_name)
+    with _lock:
+        previous = conn.execute(
+            "SELECT file_hash, params, chunks, entry FROM documents WHERE collection_name = ? AND nome = ?",
+            (collection_name, nome)
+        ).fetchone()
+        if previous == row:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (collection_name, nome, file_hash, params, chunks, entry) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (collection_name, nome, *row)
+        )
+        conn.commit()
+    bump_revision()
+
+
+def remove_entry(nome, collection_name=COLLECTION_NAME):
+    """
+    Removes a document from the manifest (e.g. when its chunks are dropped from ChromaDB).
+    """
+    conn = _get_conn(collection_name)
+    with _lock:
+        conn.execute("DELETE FROM documents WHERE collection_name = ? AND nome = ?", (collection_name, nome))
+        conn.commit()
+    bump_revision()
+
+
+def clear_manifest(collection_name=COLLECTION_NAME):
+    """
+    Forgets every indexed document of a collection. Must be called whenever the collection is reset.
+    """
+    conn = _get_conn(collection_name)
+    with _lock:
+        conn.execute("DELETE FROM documents WHERE collection_name = ?", (collection_name,))
+        conn.commit()
+    bump_revision()
+
+
+# ========================================
+# 🔄 COLLECTION REVISION
+# ========================================
+
+def bump_revision(path=REVISION_PATH):
+    """
+    Marks the indexed content as changed by writing a fresh random revision token.
+    The token is written to a temp file and renamed into place, so readers in other processes
+    never see an empty or partial token (which would look like a new revision).
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    token = uuid.uuid4().hex
+    tmp_path = f"{path}.{token}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+
+
+def get_revision(path=REVISION_PATH):
+    """
+    Current revision token of the indexed content ("" if nothing was ever indexed).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
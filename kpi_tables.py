@@ -0,0 +1,234 @@
+# ========================================
+# 📋 MODULE: kpi_tables.py
+# Columnar store of the tables extracted from PDFs, indexed by document, page and table
+# ========================================
+
+import json
+import os
+import re
+import shutil
+
+import pandas as pd
+
+from resources import CHROMA_PATH, COLLECTION_NAME
+
+
+# ========================================
+# ⚙️ STORE LOCATION
+# ========================================
+
+# One folder per collection and document: <TABLES_ROOT>/<collection>/<document>/p0012_t0.parquet + catalog.json
+TABLES_ROOT = os.path.join(CHROMA_PATH, "tables")
+
+# Share of non-empty cells that must parse as numbers for a column to be stored as numeric
+NUMERIC_RATIO = 0.6
+
+_ITALIAN_NUMBER = re.compile(r"^-?\d{1,3}(\.\d{3})+(,\d+)?$|^-?\d+,\d+$")
+_ENGLISH_NUMBER = re.compile(r"^-?\d{1,3}(,\d{3})+(\.\d+)?$|^-?\d+(\.\d+)?$")
+
+
+def _safe_name(name):
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("._") or "_"
+
+
+def _document_dir(collection_name, origine):
+    return os.path.join(TABLES_ROOT, _safe_name(collection_name), _safe_name(origine))
+
+
+def table_ref(origine, pagina, tabella, collection_name=COLLECTION_NAME):
+    """
+    Compact reference of a table, e.g. "Report_2023:12:0" (collection prefix if not the default one).
+    """
+    ref = f"{origine}:{pagina}:{tabella}"
+    return ref if collection_name == COLLECTION_NAME else f"{collection_name}/{ref}"
+
+
+def parse_table_ref(ref):
+    """
+    Inverse of table_ref: "collection/origine:pagina:tabella" -> (collection, origine, pagina, tabella).
+    """
+    collection_name, _, rest = ref.rpartition("/")
+    origine, pagina, tabella = rest.rsplit(":", 2)
+    return collection_name or COLLECTION_NAME, origine, int(pagina), int(tabella)
+
+
+# ========================================
+# 🧹 CLEANING
+# ========================================
+
+def _parse_number(value):
+    """
+    Parses ESG figures written the Italian ("1.234,5") or English ("1,234.5") way; "%" and spaces are ignored.
+    Returns None if the value is not a number.
+    """
+    text = str(value).strip().replace("%", "").replace(" ", "").replace(" ", "")
+    if _ITALIAN_NUMBER.match(text):
+        return float(text.replace(".", "").replace(",", "."))
+    if _ENGLISH_NUMBER.match(text):
+        return float(text.replace(",", ""))
+    return None
+
+
+def clean_table(frame):
+    """
+    Normalises an extracted table: unique non-empty column names, empty rows dropped,
+    cell line breaks collapsed, and mostly-numeric columns converted to floats.
+    """
+    frame = frame.copy()
+
+    columns, seen = [], {}
+    for i, column in enumerate(frame.columns):
+        name = " ".join(str(column).split()) if column is not None else ""
+        name = re.sub(r"^Col\d+$", "", name) or f"col_{i}"
+        seen[name] = seen.get(name, 0) + 1
+        columns.append(name if seen[name] == 1 else f"{name}_{seen[name]}")
+    frame.columns = columns
+
+    frame = frame.map(lambda v: " ".join(str(v).split()) if v is not None and not pd.isna(v) else None)
+    frame = frame.dropna(how="all").reset_index(drop=True)
+
+    for column in frame.columns:
+        values = frame[column].dropna()
+        values = values[values != ""]
+        if values.empty:
+            continue
+        numbers = values.map(_parse_number)
+        if numbers.notna().mean() >= NUMERIC_RATIO:
+            frame[column] = frame[column].map(lambda v: _parse_number(v) if v not in (None, "") else None).astype("float64")
+    return frame
+
+
+# ========================================
+# 💾 STORE / LOAD
+# ========================================
+
+def store_tables(origine, tabelle, collection_name=COLLECTION_NAME):
+    """
+    Replaces the stored tables of a document with the ones just extracted.
+
+    Parameters:
+    - origine (str): document name (no extension), as in the chunk metadata
+    - tabelle (list[dict]): output of parser.estrai_tabelle
+    - collection_name (str): collection the document is indexed in
+
+    Returns:
+    - int: number of tables stored
+    """
+    directory = _document_dir(collection_name, origine)
+    tmp_directory = directory + ".tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    catalog = []
+    for tabella in tabelle:
+        frame = clean_table(tabella["dati"])
+        if frame.empty:
+            continue
+        file_name = f"p{tabella['pagina']:04d}_t{tabella['tabella']}.parquet"
+        frame.to_parquet(os.path.join(tmp_directory, file_name), index=False)
+        catalog.append({
+            "origine": origine,
+            "pagina": tabella["pagina"],
+            "tabella": tabella["tabella"],
+            "file": file_name,
+            "bbox": list(tabella.get("bbox") or []),
+            "n_rows": int(frame.shape[0]),
+            "n_cols": int(frame.shape[1]),
+            "columns": list(frame.columns),
+            "numeric_columns": [c for c in frame.columns if pd.api.types.is_float_dtype(frame[c])]
+        })
+
+    with open(os.path.join(tmp_directory, "catalog.json"), "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False, indent=2)
+
+    # Swap the whole folder, so readers never see a half-written document
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+    return len(catalog)
+
+
+def list_tables(collection_name=COLLECTION_NAME, origine=None, pagina=None):
+    """
+    Catalog of the stored tables (one row per table), optionally for one document and/or page.
+
+    Returns:
+    - pd.DataFrame: origine, pagina, tabella, ref, n_rows, n_cols, columns, numeric_columns, ...
+    """
+    root = os.path.join(TABLES_ROOT, _safe_name(collection_name))
+    documents = [_safe_name(origine)] if origine is not None else (sorted(os.listdir(root)) if os.path.isdir(root) else [])
+
+    rows = []
+    for document in documents:
+        catalog_path = os.path.join(root, document, "catalog.json")
+        if not os.path.exists(catalog_path):
+            continue
+        with open(catalog_path, "r", encoding="utf-8") as f:
+            rows.extend(entry for entry in json.load(f) if pagina is None or entry["pagina"] == pagina)
+
+    catalog = pd.DataFrame(rows, columns=["origine", "pagina", "tabella", "file", "bbox", "n_rows", "n_cols",
+                                          "columns", "numeric_columns"])
+    catalog["ref"] = [table_ref(o, p, t, collection_name) for o, p, t in
+                      zip(catalog["origine"], catalog["pagina"], catalog["tabella"])]
+    return catalog
+
+
+def load_table(origine, pagina, tabella, collection_name=COLLECTION_NAME):
+    """
+    Loads one stored table as a DataFrame.
+    """
+    path = os.path.join(_document_dir(collection_name, origine), f"p{int(pagina):04d}_t{int(tabella)}.parquet")
+    if not os.path.exists(path):
+        raise KeyError(f"Table not found: {table_ref(origine, pagina, tabella, collection_name)}")
+    return pd.read_parquet(path)
+
+
+def load_table_ref(ref):
+    """
+    Loads a table from its reference string (see table_ref).
+    """
+    collection_name, origine, pagina, tabella = parse_table_ref(ref)
+    return load_table(origine, pagina, tabella, collection_name)
+
+
+def drop_tables(collection_name=COLLECTION_NAME, origine=None):
+    """
+    Deletes the stored tables of one document, or of a whole collection.
+    """
+    if origine is not None:
+        shutil.rmtree(_document_dir(collection_name, origine), ignore_errors=True)
+    else:
+        shutil.rmtree(os.path.join(TABLES_ROOT, _safe_name(collection_name)), ignore_errors=True)
+
+
+# ========================================
+# 🔍 FINDING KPI TABLES
+# ========================================
+
+def search_tables(query, collection_name=COLLECTION_NAME, n_results=5, origine=None, collections=None):
+    """
+    Ranks stored tables by how many query terms appear in their column names and first column
+    (row labels such as "Scope 1", "Donne", "Energia rinnovabile").
+
+    Parameters:
+    - collections (list[str]): several collections searched together (overrides collection_name),
+      e.g. the per-client/per-year indexes a section is generated from
+
+    Returns:
+    - pd.DataFrame: catalog rows of the best tables, with a "score" column
+    """
+    names = list(dict.fromkeys(collections or [collection_name]))
+    catalog = pd.concat([list_tables(name, origine=origine).assign(collection_name=name) for name in names],
+                        ignore_index=True)
+    terms = set(re.findall(r"\w+", query.lower()))
+    if catalog.empty or not terms:
+        return catalog.head(0).assign(score=[])
+
+    scores = []
+    for row in catalog.itertuples():
+        frame = load_table(row.origine, row.pagina, row.tabella, row.collection_name)
+        labels = " ".join([*row.columns, *frame.iloc[:, 0].astype(str).tolist()]).lower()
+        scores.append(len(terms & set(re.findall(r"\w+", labels))))
+
+    catalog["score"] = scores
+    catalog = catalog[catalog["score"] > 0]
+    return catalog.sort_values(["score", "origine", "pagina"], ascending=[False, True, True]).head(n_results)
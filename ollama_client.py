@@ -0,0 +1,174 @@
+# ========================================
+# 🦙 MODULE: ollama_client.py
+# Pooled HTTP client for the local Ollama server
+# ========================================
+
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from resources import get_or_create
+
+
+# ========================================
+# ⚙️ CLIENT CONFIGURATION
+# ========================================
+
+OLLAMA_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+
+# Seconds to open the TCP connection / to wait between two bytes of the response.
+# With streaming the read timeout is the maximum gap between tokens; without it,
+# it must cover the whole generation (30-90 s per section on CPU-only boxes).
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 300
+
+# Bounded retries with exponential backoff (connection errors and 5xx only)
+MAX_RETRIES = 2
+BACKOFF_FACTOR = 1.0
+
+# How long Ollama keeps the model loaded after a request
+KEEP_ALIVE = "30m"
+
+POOL_SIZE = 8
+
+_RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class OllamaError(Exception):
+    """
+    Raised when Ollama answers with an error or cannot be reached after all retries.
+    """
+
+
+# ========================================
+# 🔌 POOLED CLIENT
+# ========================================
+
+class OllamaClient:
+    """
+    Thin client around Ollama's /api/generate endpoint.
+
+    - one requests.Session with a connection pool, so calls reuse TCP connections
+    - connect/read timeouts, so a hung server cannot block the caller forever
+    - bounded retries with backoff before any token has been received
+    - real generation limits (options.num_predict) and keep_alive control
+    """
+
+    def __init__(self, base_url=OLLAMA_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, keep_alive=KEEP_ALIVE,
+                 pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.keep_alive = keep_alive
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _payload(self, prompt, model, temperature, max_tokens, stream, options=None, **extra):
+        return {
+            "model": model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": {"temperature": temperature, "num_predict": max_tokens, **(options or {})},
+            **extra
+        }
+
+    def _post(self, path, payload, stream=False, read_timeout=None):
+        """
+        POSTs with retries on connection errors, timeouts while connecting, and 5xx answers.
+        read_timeout overrides the client's read timeout for this request.
+        """
+        url = f"{self.base_url}{path}"
+        timeout = (self.timeout[0], read_timeout) if read_timeout is not None else self.timeout
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(url, json=payload, stream=stream, timeout=timeout)
+            except (requests.ConnectionError, requests.ConnectTimeout) as e:
+                error = OllamaError(f"Ollama unreachable at {self.base_url}: {e}")
+            else:
+                if response.status_code == 200:
+                    return response
+                error = OllamaError(f"Error during generation: {response.text}")
+                response.close()
+                if response.status_code not in _RETRY_STATUSES:
+                    raise error
+
+            if attempt < self.max_retries:
+                time.sleep(self.backoff_factor * 2 ** attempt)
+        raise error
+
+    def generate(self, prompt, model="mistral", temperature=0.7, max_tokens=512, options=None, **extra):
+        """
+        Non-streaming generation.
+
+        Parameters:
+        - prompt (str): input prompt
+        - model (str): Ollama model name
+        - temperature (float): sampling temperature
+        - max_tokens (int): maximum number of generated tokens (sent as options.num_predict)
+        - options (dict): additional Ollama model options (num_ctx, top_p, ...)
+        - extra: additional top-level request fields (e.g. format="json")
+
+        Returns:
+        - dict: Ollama's response message ("response", "eval_count", "eval_duration", ...)
+        """
+        payload = self._payload(prompt, model, temperature, max_tokens, False, options, **extra)
+        try:
+            response = self._post("/api/generate", payload)
+        except requests.ReadTimeout as e:
+            raise OllamaError(f"Ollama did not answer within {self.timeout[1]}s: {e}") from e
+        message = response.json()
+        if "error" in message:
+            raise OllamaError(f"Error during generation: {message['error']}")
+        return message
+
+    def stream_generate(self, prompt, model="mistral", temperature=0.7, max_tokens=512, options=None,
+                        read_timeout=None, **extra):
+        """
+        Streaming generation: yields Ollama's JSON messages one by one, the last one having done=True.
+        Same parameters as generate(), plus read_timeout: maximum wait for the first and each
+        following token (None = the client's READ_TIMEOUT), e.g. the time left before a deadline.
+        """
+        payload = self._payload(prompt, model, temperature, max_tokens, True, options, **extra)
+        try:
+            response = self._post("/api/generate", payload, stream=True, read_timeout=read_timeout)
+        except requests.ReadTimeout as e:
+            raise OllamaError(f"Ollama did not start answering within {read_timeout or self.timeout[1]}s: {e}") from e
+        with response:
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise OllamaError(f"Error during generation: {message['error']}")
+                    yield message
+                    if message.get("done"):
+                        return
+            except requests.exceptions.ConnectionError as e:
+                # urllib3 reports a read timeout in the middle of a stream as a connection error
+                raise OllamaError(f"Ollama stream interrupted: {e}") from e
+
+    def preload(self, model="mistral"):
+        """
+        Loads the model into memory (empty prompt) so the first real request does not pay for it.
+        """
+        self._post("/api/generate", {"model": model, "keep_alive": self.keep_alive}).close()
+
+    def close(self):
+        self.session.close()
+
+
+def get_ollama_client(base_url=OLLAMA_URL):
+    """
+    Shared OllamaClient for the given server (one connection pool per process).
+    """
+    return get_or_create(("ollama_client", base_url), lambda: OllamaClient(base_url))
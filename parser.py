@@ -1,62 +1,443 @@
 import fitz # PyMuPDF
 import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 
-def parse_pdf(file_path):
+from ingestion_manifest import hash_file
+from resources import get_or_create
+from tracing import span, timed_iter
+
+# Numero di pagine estratte da ogni task del pool di processi
+PAGINE_PER_BLOCCO = 32
+
+# Sotto questa soglia di pagine il costo di avvio dei processi supera il guadagno
+SOGLIA_PARALLELO = 64
+
+# OCR (Tesseract tramite PyMuPDF) delle pagine scansionate: solo le pagine con meno di
+# SOGLIA_CARATTERI_OCR caratteri nativi e immagini su almeno COPERTURA_IMMAGINI_OCR della pagina
+OCR_ABILITATO = os.environ.get("OCR_ENABLED", "1") != "0"
+LINGUE_OCR = os.environ.get("OCR_LANGUAGE", "ita+eng")
+DPI_OCR = 300
+SOGLIA_CARATTERI_OCR = 20
+COPERTURA_IMMAGINI_OCR = 0.5
+
+# Testo OCR già calcolato, per (hash del file, pagina, lingue): una pagina non viene mai riletta due volte
+CACHE_OCR_PATH = "./cache/ocr_cache.sqlite3"
+
+
+def _pagina_scansionata(pagina, testo):
+    """
+    True se la pagina è un'immagine (scansione) senza testo nativo utile.
+    """
+    if len(testo) >= SOGLIA_CARATTERI_OCR:
+        return False
+    area_immagini = sum(abs(fitz.Rect(info["bbox"]) & pagina.rect) for info in pagina.get_image_info())
+    return area_immagini >= COPERTURA_IMMAGINI_OCR * abs(pagina.rect)
+
+
+def _estrai_blocco(file_path, inizio, fine):
+    """
+    Estrae il testo delle pagine [inizio, fine) di un PDF. Eseguita nei processi del pool.
+
+    Ritorna:
+    - (file_path, inizio, lista di testi puliti per pagina, indici delle pagine scansionate da passare all'OCR)
+    """
+    testi, scansionate = [], []
+    with fitz.open(file_path) as doc:
+        for n in range(inizio, fine):
+            pagina = doc[n]
+            testo = pagina.get_text().strip()
+            if OCR_ABILITATO and _pagina_scansionata(pagina, testo):
+                scansionate.append(n)
+            testi.append(testo)
+    return file_path, inizio, testi, scansionate
+
+
+def _conta_pagine(file_path):
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+def _blocchi(n_pagine, pagine_per_blocco):
+    return [(i, min(i + pagine_per_blocco, n_pagine)) for i in range(0, n_pagine, pagine_per_blocco)]
+
+
+def _risultato(file_path, testo_per_pagina):
+    """
+    Compone la tupla (nome_origine, estensione, testo_intero, testo_per_pagina).
+    """
+    base_name = os.path.basename(file_path)
+    nome_origine, estensione = os.path.splitext(base_name)
+
+    # Unione di tutte le pagine in una stringa unica
+    testo_intero = "\n\n".join(testo_per_pagina)
+
+    return nome_origine, estensione, testo_intero, testo_per_pagina
+
+
+# ========================================
+# 🔎 OCR DELLE PAGINE SCANSIONATE
+# ========================================
+
+_cache_ocr_lock = threading.Lock()
+
+
+def _cache_ocr(path=CACHE_OCR_PATH):
+    def factory():
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Condivisa con i processi di ingestione: si attendono i loro lock di scrittura
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ocr (
+                file_hash TEXT NOT NULL,
+                pagina INTEGER NOT NULL,
+                lingue TEXT NOT NULL,
+                testo TEXT NOT NULL,
+                PRIMARY KEY (file_hash, pagina, lingue)
+            )
+            """
+        )
+        conn.commit()
+        return conn
+
+    return get_or_create(("ocr_cache", path), factory)
+
+
+@lru_cache(maxsize=64)
+def _hash_documento(file_path, mtime, dimensione):
+    return hash_file(file_path)
+
+
+def _leggi_cache_ocr(file_hash, pagine):
+    conn = _cache_ocr()
+    with _cache_ocr_lock:
+        righe = conn.execute(
+            f"SELECT pagina, testo FROM ocr WHERE file_hash = ? AND lingue = ? AND pagina IN ({','.join('?' * len(pagine))})",
+            [file_hash, LINGUE_OCR, *pagine]
+        ).fetchall()
+    return dict(righe)
+
+
+def _salva_cache_ocr(file_hash, testi):
+    conn = _cache_ocr()
+    with _cache_ocr_lock:
+        conn.executemany(
+            "INSERT OR REPLACE INTO ocr (file_hash, pagina, lingue, testo) VALUES (?, ?, ?, ?)",
+            [(file_hash, n, LINGUE_OCR, testo) for n, testo in testi.items()]
+        )
+        conn.commit()
+
+
+def _ocr_pagina(file_path, n):
+    """
+    OCR di una pagina con Tesseract (tramite PyMuPDF). Eseguita nei processi del pool.
+
+    Ritorna:
+    - (n, testo), con testo None se l'OCR non è disponibile o fallisce (il risultato non va in cache)
+    """
+    try:
+        with fitz.open(file_path) as doc:
+            pagina = doc[n]
+            textpage = pagina.get_textpage_ocr(language=LINGUE_OCR, dpi=DPI_OCR, full=True)
+            return n, pagina.get_text(textpage=textpage).strip()
+    except Exception as e:
+        print(f"⚠️ OCR non riuscito per pagina {n + 1} di {os.path.basename(file_path)}: {e}")
+        return n, None
+
+
+class _PoolOCR:
+    """
+    Processi che eseguono l'OCR delle pagine scansionate di un documento (o di un parse_folder).
+    Nei percorsi paralleli riusa il pool dell'estrazione, così l'OCR non compete con altri processi;
+    altrimenti crea un proprio pool alla prima pagina da leggere e lo tiene fino alla fine del documento.
+    """
+
+    def __init__(self, n_workers=None, pool=None):
+        self.n_workers = n_workers
+        self.pool = pool
+        self.proprio = False
+
+    def map(self, file_path, pagine):
+        if self.n_workers == 1 or (self.pool is None and len(pagine) == 1):
+            return [_ocr_pagina(file_path, n) for n in pagine]
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+            self.proprio = True
+        return list(self.pool.map(_ocr_pagina, [file_path] * len(pagine), pagine))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.proprio:
+            self.pool.shutdown()
+            self.pool, self.proprio = None, False
+
+
+def _applica_ocr(file_path, inizio, testi, scansionate, ocr):
+    """
+    Sostituisce il testo (vuoto) delle pagine scansionate con il loro testo OCR:
+    prima dalla cache, poi con Tesseract nei processi di `ocr` per le sole pagine mancanti.
+
+    Parametri:
+    - file_path (str): percorso al file PDF
+    - inizio (int): indice della pagina corrispondente a testi[0]
+    - testi (list): testi nativi delle pagine, modificati sul posto
+    - scansionate (list): indici assoluti delle pagine da passare all'OCR
+    - ocr (_PoolOCR): processi OCR del documento
+
+    Ritorna:
+    - testi
+    """
+    if not scansionate:
+        return testi
+
+    with span("ocr", pagine=len(scansionate)) as attributi:
+        file_hash = _hash_documento(file_path, os.path.getmtime(file_path), os.path.getsize(file_path))
+        risultati = _leggi_cache_ocr(file_hash, scansionate)
+        mancanti = [n for n in scansionate if n not in risultati]
+        attributi["da_cache"] = len(scansionate) - len(mancanti)
+
+        if mancanti:
+            nuovi = dict(ocr.map(file_path, mancanti))
+            nuovi = {n: testo for n, testo in nuovi.items() if testo is not None}
+            if nuovi:
+                _salva_cache_ocr(file_hash, nuovi)
+            risultati.update(nuovi)
+
+    for n in scansionate:
+        if risultati.get(n):
+            testi[n - inizio] = risultati[n]
+    return testi
+
+
+def _parse_in_pool(file_paths, n_workers, progress_callback, pagine_per_blocco):
+    """
+    Distribuisce i blocchi di pagine di tutti i documenti su un pool di processi
+    e ricompone il testo di ogni documento nell'ordine originale delle pagine.
+    """
+    totali = {path: _conta_pagine(path) for path in file_paths}
+    pagine = {path: [None] * n for path, n in totali.items()}
+    scansionate = {path: [] for path in file_paths}
+    completate = dict.fromkeys(file_paths, 0)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(_estrai_blocco, path, inizio, fine)
+            for path in file_paths
+            for inizio, fine in _blocchi(totali[path], pagine_per_blocco)
+        ]
+        for future in as_completed(futures):
+            path, inizio, testi, da_ocr = future.result()
+            pagine[path][inizio:inizio + len(testi)] = testi
+            scansionate[path].extend(da_ocr)
+            completate[path] += len(testi)
+            if progress_callback:
+                nome_origine = os.path.splitext(os.path.basename(path))[0]
+                progress_callback(nome_origine, completate[path], totali[path])
+
+        # Le pagine scansionate di ogni documento vanno all'OCR tutte insieme, negli stessi processi
+        ocr = _PoolOCR(n_workers, pool=pool)
+        for path in file_paths:
+            _applica_ocr(path, 0, pagine[path], sorted(scansionate[path]), ocr)
+
+    return [_risultato(path, pagine[path]) for path in file_paths]
+
+
+def parse_pdf(file_path, n_workers=None, progress_callback=None, pagine_per_blocco=PAGINE_PER_BLOCCO):
     """
     Estrae il testo da un file PDF pagina per pagina, restituendo anche nome e estensione del file.
-    
+    I documenti lunghi vengono suddivisi in blocchi di pagine estratti in parallelo da un pool di processi.
+
     Parametri:
     - file_path (str): percorso al file PDF
-    
+    - n_workers (int): numero di processi (None = numero di CPU, 1 = estrazione sequenziale)
+    - progress_callback (callable): chiamata come callback(nome_origine, pagine_completate, pagine_totali)
+    - pagine_per_blocco (int): pagine estratte da ogni task del pool
+
     Ritorna:
     - nome_origine (str): nome del file (senza estensione)
     - estensione (str): estensione del file originale
     - testo_intero (str): tutto il testo estratto, unito
     - testo_per_pagina (list): lista di testi divisi per pagina
     """
-    # Recupera nome file ed estensione
-    base_name = os.path.basename(file_path)
-    nome_origine, estensione = os.path.splitext(base_name)
+    n_pagine = _conta_pagine(file_path)
 
-    # Apriamo il file PDF
-    doc = fitz.open(file_path)
+    with span("parse_pdf", pagine=n_pagine):
+        if n_workers == 1 or n_pagine < SOGLIA_PARALLELO:
+            # Documento breve: estrazione sequenziale nel processo corrente
+            nome_origine = os.path.splitext(os.path.basename(file_path))[0]
+            testo_per_pagina, scansionate = [], []
+            for inizio, fine in _blocchi(n_pagine, pagine_per_blocco):
+                _, _, testi, da_ocr = _estrai_blocco(file_path, inizio, fine)
+                testo_per_pagina.extend(testi)
+                scansionate.extend(da_ocr)
+                if progress_callback:
+                    progress_callback(nome_origine, len(testo_per_pagina), n_pagine)
+            with _PoolOCR(n_workers) as ocr:
+                _applica_ocr(file_path, 0, testo_per_pagina, scansionate, ocr)
+            risultato = _risultato(file_path, testo_per_pagina)
+        else:
+            risultato = _parse_in_pool([file_path], n_workers, progress_callback, pagine_per_blocco)[0]
 
-    testo_per_pagina = []
+    print(f"[{risultato[0]}] Estratte {n_pagine} pagine, {len(risultato[2])} caratteri")
 
-    # Estraiamo il testo da ogni pagina
-    for page_num, page in enumerate(doc):
-        testo = page.get_text()
-        testo_pulito = testo.strip()
-        testo_per_pagina.append(testo_pulito)
+    return risultato
 
-        print(f"[{nome_origine} - Pagina {page_num + 1}] Estratti {len(testo_pulito)} caratteri")
 
-    # Unione di tutte le pagine in una stringa unica
-    testo_intero = "\n\n".join(testo_per_pagina)
+def itera_pagine(file_path, n_workers=None, progress_callback=None, pagine_per_blocco=PAGINE_PER_BLOCCO):
+    """
+    Generatore che restituisce il testo di un PDF una pagina alla volta, in ordine.
+    A differenza di parse_pdf non tiene in memoria l'intero documento: nel caso parallelo
+    restano in volo al massimo 2 blocchi per processo, e il pool si ferma finché il
+    consumatore non legge le pagine già estratte (backpressure).
 
-    return nome_origine, estensione, testo_intero, testo_per_pagina
+    Parametri:
+    - file_path (str): percorso al file PDF
+    - n_workers (int): numero di processi (None = numero di CPU, 1 = estrazione sequenziale)
+    - progress_callback (callable): chiamata come callback(nome_origine, pagine_completate, pagine_totali)
+    - pagine_per_blocco (int): pagine estratte da ogni task del pool
+
+    Ritorna:
+    - generatore di str: testo pulito di ogni pagina
+    """
+    # Nel tracing conta solo il tempo di estrazione, non quello del consumatore tra una pagina e l'altra
+    return timed_iter("parse_pdf", _itera_pagine(file_path, n_workers, progress_callback, pagine_per_blocco))
+
+
+def _itera_pagine(file_path, n_workers, progress_callback, pagine_per_blocco):
+    nome_origine = os.path.splitext(os.path.basename(file_path))[0]
+    n_pagine = _conta_pagine(file_path)
+    blocchi = _blocchi(n_pagine, pagine_per_blocco)
+    completate = 0
+
+    if n_workers == 1 or n_pagine < SOGLIA_PARALLELO:
+        with _PoolOCR(n_workers) as ocr:
+            for inizio, fine in blocchi:
+                _, _, testi, da_ocr = _estrai_blocco(file_path, inizio, fine)
+                for testo in _applica_ocr(file_path, inizio, testi, da_ocr, ocr):
+                    completate += 1
+                    if progress_callback:
+                        progress_callback(nome_origine, completate, n_pagine)
+                    yield testo
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        ocr = _PoolOCR(n_workers, pool=pool)
+        max_in_volo = 2 * (n_workers or os.cpu_count() or 1)
+        da_inviare = iter(blocchi)
+        in_volo = deque()
+
+        for inizio, fine in da_inviare:
+            in_volo.append(pool.submit(_estrai_blocco, file_path, inizio, fine))
+            if len(in_volo) >= max_in_volo:
+                break
+
+        while in_volo:
+            _, inizio, testi, da_ocr = in_volo.popleft().result()
+            prossimo = next(da_inviare, None)
+            if prossimo is not None:
+                in_volo.append(pool.submit(_estrai_blocco, file_path, *prossimo))
+            for testo in _applica_ocr(file_path, inizio, testi, da_ocr, ocr):
+                completate += 1
+                if progress_callback:
+                    progress_callback(nome_origine, completate, n_pagine)
+                yield testo
+
+
+# ========================================
+# 📋 ESTRAZIONE DELLE TABELLE
+# ========================================
+
+def _estrai_tabelle_blocco(file_path, inizio, fine):
+    """
+    Estrae le tabelle delle pagine [inizio, fine) con il riconoscimento di layout di PyMuPDF
+    (linee e allineamento del testo). Eseguita nei processi del pool.
+
+    Ritorna:
+    - lista di dict {"pagina", "tabella", "bbox", "dati": DataFrame}
+    """
+    tabelle = []
+    with fitz.open(file_path) as doc:
+        for n in range(inizio, fine):
+            try:
+                trovate = doc[n].find_tables().tables
+            except Exception as e:
+                print(f"⚠️ Tabelle non estratte da pagina {n + 1}: {e}")
+                continue
+            for indice, tabella in enumerate(trovate):
+                dati = tabella.to_pandas()
+                if dati.empty or dati.shape[1] < 2:
+                    continue
+                tabelle.append({"pagina": n + 1, "tabella": indice, "bbox": tuple(tabella.bbox), "dati": dati})
+    return tabelle
 
 
-def parse_folder(folder_path):
+def estrai_tabelle(file_path, n_workers=None, pagine_per_blocco=PAGINE_PER_BLOCCO):
+    """
+    Estrae le tabelle di dati ESG (emissioni per scope, organico per genere, mix energetico, ...)
+    come DataFrame, invece di appiattirle nel testo come get_text().
+
+    Parametri:
+    - file_path (str): percorso al file PDF
+    - n_workers (int): numero di processi (None = numero di CPU, 1 = estrazione sequenziale)
+    - pagine_per_blocco (int): pagine analizzate da ogni task del pool
+
+    Ritorna:
+    - lista di dict {"pagina" (1-based), "tabella" (indice nella pagina), "bbox", "dati": DataFrame},
+      in ordine di pagina
+    """
+    n_pagine = _conta_pagine(file_path)
+    blocchi = _blocchi(n_pagine, pagine_per_blocco)
+
+    with span("extract_tables", pagine=n_pagine) as attributi:
+        if n_workers == 1 or n_pagine < SOGLIA_PARALLELO:
+            risultati = [_estrai_tabelle_blocco(file_path, inizio, fine) for inizio, fine in blocchi]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                risultati = list(pool.map(_estrai_tabelle_blocco, *zip(*[(file_path, i, f) for i, f in blocchi])))
+        tabelle = [tabella for blocco in risultati for tabella in blocco]
+        attributi["tabelle"] = len(tabelle)
+
+    return tabelle
+
+
+def parse_folder(folder_path, n_workers=None, progress_callback=None, pagine_per_blocco=PAGINE_PER_BLOCCO):
     """
     Estrae il testo da tutti i file PDF in una cartella.
-    
+    Le pagine di tutti i documenti condividono un unico pool di processi; l'ordine dei
+    risultati (alfabetico per nome file) e delle pagine è deterministico.
+
     Parametri:
     - folder_path (str): percorso della cartella
-    
+    - n_workers (int): numero di processi (None = numero di CPU, 1 = estrazione sequenziale)
+    - progress_callback (callable): chiamata come callback(nome_origine, pagine_completate, pagine_totali)
+    - pagine_per_blocco (int): pagine estratte da ogni task del pool
+
     Ritorna:
     - lista_risultati (list): lista di tuple (nome_origine, estensione, testo_intero, testo_per_pagina)
     """
-    lista_risultati = []
+    file_paths = [
+        os.path.join(folder_path, file_name)
+        for file_name in sorted(os.listdir(folder_path))
+        if file_name.endswith(".pdf")
+    ]
+
+    if not file_paths:
+        return []
 
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith(".pdf"):
-            file_path = os.path.join(folder_path, file_name)
+    if n_workers == 1:
+        return [parse_pdf(path, n_workers=1, progress_callback=progress_callback,
+                          pagine_per_blocco=pagine_per_blocco) for path in file_paths]
 
-            # Chiamiamo la funzione di parsing per ogni PDF
-            risultato = parse_pdf(file_path)
+    lista_risultati = _parse_in_pool(file_paths, n_workers, progress_callback, pagine_per_blocco)
 
-            # Aggiungiamo il risultato alla lista
-            lista_risultati.append(risultato)
+    for nome_origine, _, testo_intero, testo_per_pagina in lista_risultati:
+        print(f"[{nome_origine}] Estratte {len(testo_per_pagina)} pagine, {len(testo_intero)} caratteri")
 
-    return lista_risultati
\ No newline at end of file
+    return lista_risultati
@@ -0,0 +1,141 @@
+# ========================================
+# 🎯 MODULE: reranker.py
+# Cross-encoder re-ranking of retrieved chunks, within a latency budget
+# ========================================
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from resources import get_or_create
+from tracing import span
+
+
+# ========================================
+# ⚙️ RE-RANKER CONFIGURATION
+# ========================================
+
+# Small CPU-friendly cross-encoder trained on MS MARCO passage ranking
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Candidates fetched per requested result before re-ranking
+RERANK_CANDIDATES_FACTOR = 4
+
+# (query, chunk) pairs scored per forward pass
+RERANK_BATCH_SIZE = 16
+
+# Seconds allowed for scoring; beyond that the vector/hybrid order is kept
+RERANK_LATENCY_BUDGET = 2.0
+
+# Maximum number of cached (query, chunk) scores
+SCORE_CACHE_SIZE = 20_000
+
+
+def get_cross_encoder(model_name=CROSS_ENCODER_MODEL):
+    """
+    Local cross-encoder (loaded once per process).
+    """
+    def factory():
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(model_name, device="cpu")
+
+    return get_or_create(("cross_encoder", model_name), factory)
+
+
+# ========================================
+# 💾 SCORE CACHE
+# ========================================
+
+_score_cache = OrderedDict()
+_score_cache_lock = threading.Lock()
+
+
+def _pair_key(model_name, query, document):
+    digest = hashlib.sha256()
+    for part in (model_name, query, document):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _cached_scores(keys):
+    with _score_cache_lock:
+        found = {}
+        for key in keys:
+            if key in _score_cache:
+                _score_cache.move_to_end(key)
+                found[key] = _score_cache[key]
+        return found
+
+
+def _store_scores(scores):
+    with _score_cache_lock:
+        _score_cache.update(scores)
+        while len(_score_cache) > SCORE_CACHE_SIZE:
+            _score_cache.popitem(last=False)
+
+
+# ========================================
+# 🔁 RE-RANKING
+# ========================================
+
+def rerank(query, documents, top_k, latency_budget=RERANK_LATENCY_BUDGET, batch_size=RERANK_BATCH_SIZE,
+           model_name=CROSS_ENCODER_MODEL):
+    """
+    Re-orders retrieved chunks by cross-encoder relevance to the query.
+
+    Pairs are scored in batches; if scoring runs past the latency budget with batches left,
+    the original (vector or hybrid) order is kept, so re-ranking exceeds the budget by at most
+    one batch. Overruns are recorded on the "rerank" span (over_budget, fallback, scoring_time).
+    Scores are cached per (model, query, chunk).
+
+    Parameters:
+    - query (str): user prompt/question
+    - documents (list[str]): candidate chunks, in retrieval order
+    - top_k (int): number of chunks to keep
+    - latency_budget (float): seconds allowed for scoring (None = unlimited)
+    - batch_size (int): pairs scored per forward pass
+    - model_name (str): cross-encoder model
+
+    Returns:
+    - List[int]: indices into `documents` of the chunks to keep, best first
+    """
+    if not documents:
+        return []
+
+    with span("rerank", candidates=len(documents)) as attrs:
+        return _rerank(query, documents, top_k, latency_budget, batch_size, model_name, attrs)
+
+
+def _rerank(query, documents, top_k, latency_budget, batch_size, model_name, attrs):
+    keys = [_pair_key(model_name, query, document) for document in documents]
+    scores = _cached_scores(keys)
+    to_score = [i for i, key in enumerate(keys) if key not in scores]
+
+    if to_score:
+        cross_encoder = get_cross_encoder(model_name)
+        started = time.perf_counter()
+        new_scores = {}
+        for start in range(0, len(to_score), batch_size):
+            batch = to_score[start:start + batch_size]
+            predictions = cross_encoder.predict([(query, documents[i]) for i in batch], batch_size=batch_size)
+            new_scores.update((keys[i], float(score)) for i, score in zip(batch, predictions))
+
+            # Checked after every batch, the last one included: an overrun is never silent
+            elapsed = time.perf_counter() - started
+            if latency_budget is not None and elapsed > latency_budget:
+                attrs.update(over_budget=True, scoring_time=round(elapsed, 3))
+                if start + batch_size < len(to_score):
+                    _store_scores(new_scores)
+                    attrs["fallback"] = True
+                    print(f"⏱️ Re-ranking over budget ({latency_budget:.1f}s): keeping retrieval order.")
+                    return list(range(min(top_k, len(documents))))
+                print(f"⏱️ Re-ranking finished over budget ({elapsed:.2f}s > {latency_budget:.1f}s).")
+
+        _store_scores(new_scores)
+        scores.update(new_scores)
+
+    # Stable sort: ties keep retrieval order
+    ranked = sorted(range(len(documents)), key=lambda i: scores[keys[i]], reverse=True)
+    return ranked[:top_k]
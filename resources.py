@@ -0,0 +1,160 @@
+# ========================================
+# 🧰 MODULE: resources.py
+# Shared, lazily-initialised heavy objects (embedder, ChromaDB, LLM, agent)
+# ========================================
+
+import threading
+
+# ========================================
+# ⚙️ SHARED CONFIGURATION
+# ========================================
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CHROMA_PATH = "./chroma_db"
+COLLECTION_NAME = "report_sostenibilita"
+DEFAULT_LLM = "mistral"
+
+# Context window (num_ctx) requested from Ollama per model; prompts are budgeted against it,
+# so Ollama never has to truncate them silently
+MODEL_CONTEXT_WINDOWS = {
+    "mistral": 8192,
+    "deepseek-coder": 8192
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+def context_window(model=DEFAULT_LLM):
+    """
+    Context window (in tokens) used for a model.
+    """
+    return MODEL_CONTEXT_WINDOWS.get(model.split(":")[0], DEFAULT_CONTEXT_WINDOW)
+
+
+# ========================================
+# 🗂️ RESOURCE REGISTRY
+# ========================================
+
+# Objects live at module level, so they survive Streamlit reruns and are shared by all sessions of the process
+_registry = {}
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def get_or_create(key, factory):
+    """
+    Returns the resource registered under `key`, creating it with `factory()` on first use.
+    Creation is guarded by a per-key lock: concurrent callers wait for a single initialisation
+    instead of building duplicate copies.
+    """
+    resource = _registry.get(key)
+    if resource is not None:
+        return resource
+
+    with _registry_lock:
+        lock = _locks.setdefault(key, threading.Lock())
+
+    with lock:
+        if key not in _registry:
+            _registry[key] = factory()
+        return _registry[key]
+
+
+def forget(*prefix):
+    """
+    Drops cached resources whose key starts with `prefix` (all of them if empty),
+    so the next access recreates them (e.g. forget("collection", path, name) after a collection is deleted).
+    """
+    with _registry_lock:
+        for key in list(_registry):
+            if key[:len(prefix)] == prefix:
+                _registry.pop(key, None)
+
+
+# ========================================
+# 🔌 RESOURCE ACCESSORS
+# ========================================
+
+def get_embedder(model_name=EMBEDDING_MODEL_NAME, backend=None):
+    """
+    Local embedding model (loaded once per process), on the backend selected by
+    EMBEDDING_BACKEND: "torch", "onnx" or "onnx-int8" (see embedding_backends.py).
+    """
+    from embedding_backends import EMBEDDING_BACKEND, create_backend
+
+    backend = backend or EMBEDDING_BACKEND
+    return get_or_create(("embedder", model_name, backend), lambda: create_backend(model_name, backend=backend))
+
+
+def get_chroma_client(path=CHROMA_PATH):
+    """
+    Persistent ChromaDB client for the given path (opened once per process).
+    """
+    def factory():
+        import chromadb
+        return chromadb.PersistentClient(path=path)
+
+    return get_or_create(("chroma_client", path), factory)
+
+
+def get_collection(name=COLLECTION_NAME, path=CHROMA_PATH):
+    """
+    ChromaDB collection handle, created if missing.
+    """
+    return get_or_create(
+        ("collection", path, name),
+        lambda: get_chroma_client(path).get_or_create_collection(name=name)
+    )
+
+
+def get_llm(model=DEFAULT_LLM):
+    """
+    LangChain ChatOllama model used by the tool-calling agent.
+    """
+    def factory():
+        from langchain_ollama import ChatOllama
+        try:
+            return ChatOllama(model=model, num_ctx=context_window(model))  # ✅ supporta bind_tools()
+        except Exception as e:
+            print("💥 Ollama init failed:", e)
+            raise RuntimeError("❌ Could not initialize the Ollama model. Make sure Ollama is running and the model is available.") from e
+
+    return get_or_create(("llm", model), factory)
+
+
+# ========================================
+# 🔥 WARM-UP
+# ========================================
+
+def warm_up(background=True, include_llm=False):
+    """
+    Loads the heavy resources ahead of the first request.
+
+    Parameters:
+    - background (bool): run on a daemon thread and return immediately
+    - include_llm (bool): also build the agent LLM client and ask Ollama to load the default model
+
+    Returns:
+    - threading.Thread if background, else None
+    """
+    def load():
+        try:
+            get_embedder()
+            get_collection()
+            if include_llm:
+                from ollama_client import get_ollama_client
+                get_llm()
+                get_ollama_client().preload(DEFAULT_LLM)
+        except Exception as e:
+            print(f"⚠️ Resource warm-up failed: {e}")
+
+    if not background:
+        load()
+        return None
+
+    return get_or_create(("warm_up",), lambda: _start_thread(load))
+
+
+def _start_thread(target):
+    thread = threading.Thread(target=target, name="resource-warm-up", daemon=True)
+    thread.start()
+    return thread
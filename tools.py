@@ -3,13 +3,197 @@
 # Funzioni per generare grafici e tabelle ESG personalizzati
 # ========================================
 
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import asyncio
+import contextvars
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from io import BytesIO
 import base64
+
+import pandas as pd
+import seaborn as sns
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from langchain.tools import Tool
 
+from kpi_tables import load_table_ref, search_tables
+from resources import forget, get_or_create
+
+# ========================================
+# ⚙️ MOTORE DI RENDERING
+# Ogni grafico usa una Figure propria (API a oggetti + backend Agg): nessuno stato
+# globale di pyplot, nessuna figura dimenticata aperta. Matplotlib non è thread-safe:
+# il disegno avviene in un pool di processi, la cache resta nel processo dell'app.
+# ========================================
+
+# Numero massimo di grafici renderizzati tenuti in cache (LRU)
+RENDER_CACHE_SIZE = 256
+
+# Processi dedicati al rendering (i grafici di una sezione vengono disegnati in parallelo)
+RENDER_PROCESSES = min(4, os.cpu_count() or 1)
+
+# Secondi concessi a ogni tool prima di rinunciare al grafico/tabella
+TOOL_TIMEOUTS = {"bar": 30, "line": 30, "pie": 30, "table": 10}
+
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+
+def _new_figure(figsize):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _data_fingerprint(value):
+    """
+    Rappresentazione stabile dei dati di un grafico, usata per la chiave della cache.
+    """
+    if isinstance(value, pd.DataFrame):
+        hashed = pd.util.hash_pandas_object(value, index=True).values.tobytes()
+        return {"columns": [str(c) for c in value.columns], "hash": hashlib.sha256(hashed).hexdigest()}
+    if isinstance(value, pd.Series):
+        return list(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return [_data_fingerprint(v) for v in value]
+    return value
+
+
+def _cache_key(kind, fmt, **params):
+    payload = json.dumps({"kind": kind, "fmt": fmt, **{k: _data_fingerprint(v) for k, v in params.items()}},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def fig_to_bytes(fig, fmt="png"):
+    """
+    Serializza una Figure in PNG (raster) o SVG/PDF (vettoriale).
+    """
+    buf = BytesIO()
+    fig.savefig(buf, format=fmt)
+    return buf.getvalue()
+
+
+def _render_bytes(kind, fmt, params):
+    """
+    Disegna e serializza un grafico. Eseguita nei processi del pool di rendering.
+    """
+    return fig_to_bytes(_DRAW[kind](**params), fmt)
+
+
+def get_render_pool():
+    """
+    Pool di processi condiviso per il rendering (avviato con "spawn": sicuro anche da un'app multi-thread).
+    """
+    return get_or_create(
+        ("render_pool", RENDER_PROCESSES),
+        lambda: ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    )
+
+
+_render_pool_lock = threading.Lock()
+
+
+def _abbandona_rendering(pool, future):
+    """
+    Dopo un timeout: annulla il rendering se non è ancora partito; se è già in esecuzione
+    sostituisce il pool, così un disegno bloccato non occupa i processi delle richieste successive.
+    """
+    if future.cancel() or future.done():
+        return
+    with _render_pool_lock:
+        if get_render_pool() is pool:
+            forget("render_pool")
+    # I rendering già in esecuzione nel vecchio pool terminano da soli, quelli in coda vengono annullati
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _cache_get(key):
+    with _render_cache_lock:
+        if key in _render_cache:
+            _render_cache.move_to_end(key)
+            return _render_cache[key]
+    return None
+
+
+def _cache_put(key, image):
+    with _render_cache_lock:
+        _render_cache[key] = image
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+
+def render_chart(kind, fmt="png", timeout=None, **params):
+    """
+    Renderizza un grafico ESG e restituisce i byte dell'immagine.
+    Il risultato è messo in cache con chiave (tipo di grafico, hash dei dati, colori, formato):
+    i KPI identici di una rigenerazione del report non vengono ridisegnati.
+
+    Parametri:
+    - kind (str): "bar", "line" o "pie"
+    - fmt (str): "png", "svg" o "pdf"
+    - timeout (float): secondi massimi di attesa (default TOOL_TIMEOUTS[kind])
+    - params: argomenti della funzione di disegno corrispondente
+
+    Ritorna:
+    - bytes: immagine renderizzata
+    """
+    key = _cache_key(kind, fmt, **params)
+    if (image := _cache_get(key)) is not None:
+        return image
+
+    pool = get_render_pool()
+    future = pool.submit(_render_bytes, kind, fmt, params)
+    try:
+        image = future.result(timeout=timeout or TOOL_TIMEOUTS[kind])
+    except FutureTimeoutError:
+        _abbandona_rendering(pool, future)
+        raise
+    _cache_put(key, image)
+    return image
+
+
+async def arender_chart(kind, fmt="png", timeout=None, **params):
+    """
+    Versione asincrona di render_chart: più grafici attesi insieme vengono disegnati in parallelo.
+    Allo scadere del timeout solleva asyncio.TimeoutError; il rendering viene annullato
+    o, se già in esecuzione, il pool viene sostituito (vedi _abbandona_rendering).
+    """
+    key = _cache_key(kind, fmt, **params)
+    if (image := _cache_get(key)) is not None:
+        return image
+
+    pool = get_render_pool()
+    future = pool.submit(_render_bytes, kind, fmt, params)
+    try:
+        image = await asyncio.wait_for(asyncio.wrap_future(future), timeout or TOOL_TIMEOUTS[kind])
+    except asyncio.TimeoutError:
+        _abbandona_rendering(pool, future)
+        raise
+    _cache_put(key, image)
+    return image
+
+
+def _encode(image, as_base64):
+    return base64.b64encode(image).decode() if as_base64 else image
+
+
+def _risolvi_dati(data):
+    """
+    Accetta un DataFrame oppure il riferimento a una tabella estratta dai PDF
+    ("documento:pagina:tabella", vedi find_kpi_tables) e restituisce il DataFrame.
+    """
+    if isinstance(data, str):
+        return load_table_ref(data)
+    return data
+
+
 # ========================================
 # 🎨 UTILITÀ: Funzione per applicare colori brand
 # ========================================
@@ -26,19 +210,29 @@ def apply_brand_colors(ax, colors):
 # 📊 BAR CHART ESG
 # ========================================
 
-def generate_bar_chart(data, x_col, y_col, title, colors):
-    plt.figure(figsize=(8, 5))
-    ax = sns.barplot(data=data, x=x_col, y=y_col)
+def _draw_bar_chart(data, x_col, y_col, title, colors):
+    fig = _new_figure((8, 5))
+    ax = fig.add_subplot()
+    sns.barplot(data=data, x=x_col, y=y_col, ax=ax)
     apply_brand_colors(ax, colors)
     ax.set_title(title)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
+    ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    return fig
+
 
-    return fig_to_base64(plt)
+def generate_bar_chart(data, x_col, y_col, title, colors, fmt="png", as_base64=True):
+    image = render_chart("bar", fmt=fmt, data=_risolvi_dati(data), x_col=x_col, y_col=y_col, title=title, colors=colors)
+    return _encode(image, as_base64)
+
+async def agenerate_bar_chart(data, x_col, y_col, title, colors, fmt="png", as_base64=True):
+    image = await arender_chart("bar", fmt=fmt, data=_risolvi_dati(data), x_col=x_col, y_col=y_col, title=title, colors=colors)
+    return _encode(image, as_base64)
 
 plot_bar_chart = Tool(
     name="plot_bar_chart",
     func=generate_bar_chart,
+    coroutine=agenerate_bar_chart,
     description="Genera un grafico a barre che mostri l'andamento delle metriche o KPIs per il report ESG."
 )
 
@@ -46,22 +240,32 @@ plot_bar_chart = Tool(
 # 📈 LINE CHART ESG
 # ========================================
 
-def generate_line_chart(data, x_col, y_col, title, colors):
-    plt.figure(figsize=(8, 5))
+def _draw_line_chart(data, x_col, y_col, title, colors):
+    fig = _new_figure((8, 5))
+    ax = fig.add_subplot()
     for i, column in enumerate(y_col):
-        plt.plot(data[x_col], data[column], label=column, color=colors[i % len(colors)])
+        ax.plot(data[x_col], data[column], label=column, color=colors[i % len(colors)])
+
+    ax.set_title(title)
+    ax.set_xlabel(x_col)
+    ax.set_ylabel("Valore")
+    ax.legend()
+    fig.tight_layout()
+    return fig
 
-    plt.title(title)
-    plt.xlabel(x_col)
-    plt.ylabel("Valore")
-    plt.legend()
-    plt.tight_layout()
 
-    return fig_to_base64(plt)
+def generate_line_chart(data, x_col, y_col, title, colors, fmt="png", as_base64=True):
+    image = render_chart("line", fmt=fmt, data=_risolvi_dati(data), x_col=x_col, y_col=y_col, title=title, colors=colors)
+    return _encode(image, as_base64)
+
+async def agenerate_line_chart(data, x_col, y_col, title, colors, fmt="png", as_base64=True):
+    image = await arender_chart("line", fmt=fmt, data=_risolvi_dati(data), x_col=x_col, y_col=y_col, title=title, colors=colors)
+    return _encode(image, as_base64)
 
 plot_line_chart = Tool(
     name="plot_line_chart",
     func=generate_line_chart,
+    coroutine=agenerate_line_chart,
     description="Genera un grafico a linee che mostri l'andamento delle metriche o KPIs per il report ESG."
 )
 
@@ -69,20 +273,32 @@ plot_line_chart = Tool(
 # 🥧 PIE CHART ESG
 # ========================================
 
-def generate_pie_chart(labels, values, title, colors):
-    plt.figure(figsize=(6, 6))
-    plt.pie(values, labels=labels, colors=colors, autopct='%1.1f%%', startangle=140)
-    plt.title(title)
-    plt.axis('equal')
+def _draw_pie_chart(labels, values, title, colors):
+    fig = _new_figure((6, 6))
+    ax = fig.add_subplot()
+    ax.pie(values, labels=labels, colors=colors, autopct='%1.1f%%', startangle=140)
+    ax.set_title(title)
+    ax.axis('equal')
+    return fig
+
+
+def generate_pie_chart(labels, values, title, colors, fmt="png", as_base64=True):
+    image = render_chart("pie", fmt=fmt, labels=labels, values=values, title=title, colors=colors)
+    return _encode(image, as_base64)
 
-    return fig_to_base64(plt)
+async def agenerate_pie_chart(labels, values, title, colors, fmt="png", as_base64=True):
+    image = await arender_chart("pie", fmt=fmt, labels=labels, values=values, title=title, colors=colors)
+    return _encode(image, as_base64)
 
 plot_pie_chart = Tool(
-    name="plot_line_chart",
-    func=generate_line_chart,
+    name="plot_pie_chart",
+    func=generate_pie_chart,
+    coroutine=agenerate_pie_chart,
     description="Genera un grafico a torta che mostri le metriche o KPIs per il report ESG."
 )
 
+_DRAW = {"bar": _draw_bar_chart, "line": _draw_line_chart, "pie": _draw_pie_chart}
+
 # ========================================
 # 📋 TABELLA ESG
 # ========================================
@@ -91,23 +307,103 @@ def generate_table(data, title):
     """
     Genera una tabella in HTML a partire da un DataFrame.
     """
-    table_html = f"<h4>{title}</h4>" + data.to_html(classes='esg-table', index=False)
+    table_html = f"<h4>{title}</h4>" + _risolvi_dati(data).to_html(classes='esg-table', index=False)
     return table_html
 
+async def agenerate_table(data, title):
+    # Solo pandas (niente matplotlib): basta un thread, con lo stesso limite di tempo degli altri tool
+    return await asyncio.wait_for(asyncio.to_thread(generate_table, data, title), TOOL_TIMEOUTS["table"])
+
 plot_table = Tool(
     name="plot_table",
     func=generate_table,
+    coroutine=agenerate_table,
     description="Genera una tabella che mostri le metriche o KPIs per il report ESG."
 )
 
+# ========================================
+# ⚡ ESECUZIONE CONCORRENTE DEI TOOL
+# ========================================
+
+async def arun_tools(calls):
+    """
+    Esegue insieme più tool asincroni (es. tutti i grafici e le tabelle di una sezione).
+
+    Parametri:
+    - calls (list[tuple]): coppie (coroutine function, kwargs), es. (agenerate_bar_chart, {...})
+
+    Ritorna:
+    - list: un risultato per chiamata, nello stesso ordine di calls; l'eccezione sollevata
+      (timeout compreso) al posto del risultato per le chiamate fallite
+    """
+    return await asyncio.gather(*(func(**kwargs) for func, kwargs in calls), return_exceptions=True)
+
+
+def run_tools(calls):
+    """
+    Versione sincrona di arun_tools (da non chiamare dentro un event loop già attivo).
+    """
+    return asyncio.run(arun_tools(calls))
+
+# ========================================
+# 🔍 RICERCA DELLE TABELLE KPI ESTRATTE DAI PDF
+# ========================================
+
+# Collezioni (indici per cliente/anno) in cui il tool cerca le tabelle: le imposta chi invoca l'agente
+_collezioni_tabelle = contextvars.ContextVar("collezioni_tabelle", default=None)
+
+
+@contextmanager
+def collezioni_tabelle(collections):
+    """
+    Limita find_kpi_tables alle collezioni indicate per la durata del blocco
+    (None = collezione predefinita).
+    """
+    token = _collezioni_tabelle.set(collections)
+    try:
+        yield
+    finally:
+        _collezioni_tabelle.reset(token)
+
+
+def find_tables(query, n_results=5, collections=None):
+    """
+    Cerca tra le tabelle estratte dai documenti quelle che contengono i KPI richiesti
+    (es. "emissioni scope 1 2 3", "dipendenti per genere").
+
+    Parametri:
+    - collections (list[str]): collezioni in cui cercare (None = quelle impostate con collezioni_tabelle)
+
+    Ritorna:
+    - str: JSON con riferimento, pagina, colonne e prime righe di ogni tabella trovata
+    """
+    collections = collections or _collezioni_tabelle.get()
+    risultati = []
+    for tabella in search_tables(query, n_results=n_results, collections=collections).itertuples():
+        dati = load_table_ref(tabella.ref)
+        risultati.append({
+            "ref": tabella.ref,
+            "origine": tabella.origine,
+            "pagina": int(tabella.pagina),
+            "colonne": list(tabella.columns),
+            "righe": int(tabella.n_rows),
+            "anteprima": dati.head(5).to_dict(orient="records")
+        })
+    return json.dumps(risultati, ensure_ascii=False, default=str)
+
+find_kpi_tables = Tool(
+    name="find_kpi_tables",
+    func=find_tables,
+    description="Cerca le tabelle di KPI estratte dai documenti caricati e restituisce il loro riferimento "
+                "(\"documento:pagina:tabella\"), utilizzabile come data nei grafici e nelle tabelle."
+)
+
 # ========================================
 # 💾 CONVERSIONE GRAFICO IN BASE64 PER STREAMLIT
 # ========================================
 
-def fig_to_base64(plt_obj):
-    buf = BytesIO()
-    plt_obj.savefig(buf, format="png")
-    buf.seek(0)
-    image_base64 = base64.b64encode(buf.read()).decode()
-    plt_obj.close()
-    return image_base64
\ No newline at end of file
+def fig_to_base64(fig, fmt="png"):
+    """
+    Serializza una Figure e la codifica in base64 (per l'inclusione in HTML/Streamlit).
+    """
+    return base64.b64encode(fig_to_bytes(fig, fmt)).decode()
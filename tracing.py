@@ -0,0 +1,325 @@
+# ========================================
+# 🧭 MODULE: tracing.py
+# Lightweight spans around the hot path, recent-request timings and metrics export
+# ========================================
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from resources import get_or_create
+
+
+# ========================================
+# ⚙️ TRACING CONFIGURATION
+# ========================================
+
+# One JSON line per finished request (append-only, safe to tail or load with pandas)
+METRICS_PATH = "./cache/metrics.jsonl"
+
+# Port of the Prometheus text endpoint (0 = disabled)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Finished requests kept in memory for the dashboard
+RECENT_TRACES = 50
+
+# Individual spans stored per request (per-stage totals are always complete)
+MAX_SPANS_PER_TRACE = 200
+
+# Histogram buckets (seconds) for stage and request durations
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Fields of Ollama's final message recorded on generation spans
+OLLAMA_FIELDS = ("eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration",
+                 "load_duration", "total_duration")
+
+
+# ========================================
+# 🧾 TRACES AND SPANS
+# ========================================
+
+class Trace:
+    """
+    One user-facing request (e.g. "generate_section"): its spans and per-stage totals.
+    Spans may be recorded from worker threads, hence the lock.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+        self.spans = []
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, duration, attrs):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + duration, count + 1)
+            if len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append({"name": name, "duration": duration, **attrs})
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration": self.duration,
+                "status": self.status,
+                "attrs": self.attrs,
+                "stages": {name: {"total": total, "count": count} for name, (total, count) in self.stages.items()},
+                "spans": list(self.spans)
+            }
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_recent = deque(maxlen=RECENT_TRACES)
+_metrics_lock = threading.Lock()
+
+# Prometheus aggregates: {(metric, labels): value} and {(metric, labels): [bucket counts..., sum, count]}
+_counters = {}
+_histograms = {}
+
+
+def _observe(metric, labels, value):
+    key = (metric, labels)
+    with _metrics_lock:
+        histogram = _histograms.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def _increment(metric, labels, value):
+    with _metrics_lock:
+        _counters[(metric, labels)] = _counters.get((metric, labels), 0) + value
+
+
+def record_span(name, duration, **attrs):
+    """
+    Records a span that was timed by the caller (e.g. across the iterations of a generator).
+    """
+    _observe("esg_stage_duration_seconds", (("stage", name),), duration)
+    if "eval_count" in attrs:
+        model = (("model", str(attrs.get("model", ""))),)
+        _increment("esg_ollama_eval_tokens_total", model, attrs.get("eval_count") or 0)
+        _increment("esg_ollama_eval_seconds_total", model, (attrs.get("eval_duration") or 0) / 1e9)
+        _increment("esg_ollama_prompt_tokens_total", model, attrs.get("prompt_eval_count") or 0)
+
+    current = _current_trace.get()
+    if current is not None:
+        current.add(name, duration, attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Times a block of code as one stage of the current request:
+
+        with span("collection_query", n_results=5) as attrs:
+            ...
+            attrs["n_found"] = len(ids)   # attributes can be added while the span is open
+    """
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        record_span(name, time.perf_counter() - started, **attrs)
+
+
+def traced(name):
+    """
+    Decorator form of span().
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(name, iterable, **attrs):
+    """
+    Wraps a generator and records, as one span, only the time spent producing its items
+    (time spent by the consumer between two items is excluded). attrs["items"] is the item count.
+    """
+    elapsed = 0.0
+    items = 0
+    iterator = iter(iterable)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                return
+            elapsed += time.perf_counter() - started
+            items += 1
+            yield item
+    finally:
+        record_span(name, elapsed, items=items, **attrs)
+
+
+def ollama_attrs(message, model=None):
+    """
+    Timing fields of Ollama's final message, for a generation span.
+    """
+    attrs = {field: message[field] for field in OLLAMA_FIELDS if field in message}
+    if model:
+        attrs["model"] = model
+    if attrs.get("eval_count") and attrs.get("eval_duration"):
+        attrs["tokens_per_s"] = attrs["eval_count"] / (attrs["eval_duration"] / 1e9)
+    return attrs
+
+
+@contextmanager
+def trace(name, **attrs):
+    """
+    Opens a request-level trace: every span recorded inside it (in this thread, or in
+    threads started with contextvars.copy_context()) is attached to it. When the block ends,
+    the trace is kept for the dashboard and appended to METRICS_PATH.
+    Nested calls reuse the outer trace.
+    """
+    if _current_trace.get() is not None:
+        yield _current_trace.get()
+        return
+
+    current = Trace(name, attrs)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        current.duration = time.perf_counter() - current.started
+        _observe("esg_request_duration_seconds", (("request", name),), current.duration)
+        _recent.append(current)
+        _export(current)
+
+
+def _export(current):
+    try:
+        os.makedirs(os.path.dirname(METRICS_PATH) or ".", exist_ok=True)
+        with _metrics_lock, open(METRICS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(current.to_dict(), default=str) + "\n")
+    except OSError as e:
+        print(f"⚠️ Could not write metrics: {e}")
+
+
+# ========================================
+# 📊 DASHBOARD DATA
+# ========================================
+
+def recent_traces(n=10):
+    """
+    The last `n` finished requests, most recent first, as dicts (see Trace.to_dict).
+    """
+    return [t.to_dict() for t in list(_recent)[-n:][::-1]]
+
+
+def stage_table(n=10):
+    """
+    One row per recent request with its total and per-stage latency (seconds),
+    plus Ollama's generation speed when available.
+    """
+    rows = []
+    for current in recent_traces(n):
+        row = {
+            "request": current["name"],
+            "time": time.strftime("%H:%M:%S", time.localtime(current["started_at"])),
+            "status": current["status"],
+            "total_s": round(current["duration"], 3)
+        }
+        for stage, totals in current["stages"].items():
+            row[f"{stage}_s"] = round(totals["total"], 3)
+        speeds = [s["tokens_per_s"] for s in current["spans"] if "tokens_per_s" in s]
+        if speeds:
+            row["tokens_per_s"] = round(sum(speeds) / len(speeds), 1)
+        rows.append(row)
+    return rows
+
+
+# ========================================
+# 📡 PROMETHEUS TEXT EXPORT
+# ========================================
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+
+def prometheus_text():
+    """
+    Current metrics in the Prometheus text exposition format.
+    """
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+
+    lines = []
+    for metric in sorted({m for m, _ in counters}):
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(f"{metric}{_labels(labels)} {value}" for (m, labels), value in sorted(counters.items()) if m == metric)
+
+    for metric in sorted({m for m, _ in histograms}):
+        lines.append(f"# TYPE {metric} histogram")
+        for (m, labels), values in sorted(histograms.items()):
+            if m != metric:
+                continue
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f"{metric}_bucket{_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{metric}_bucket{_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{metric}_sum{_labels(labels)} {values[-2]}")
+            lines.append(f"{metric}_count{_labels(labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """
+    Serves prometheus_text() on http://localhost:<port>/metrics (once per process).
+    Does nothing if the port is 0.
+    """
+    if not port:
+        return None
+
+    def factory():
+        server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        print(f"📡 Metrics available on http://127.0.0.1:{port}/metrics")
+        return server
+
+    return get_or_create(("metrics_server", port), factory)
@@ -0,0 +1,762 @@
+# ========================================
+# 🧮 MODULE: vector_store.py
+# Vector store backends behind store_in_chromadb / query_chromadb:
+# Chroma HNSW, compact memory-mapped float16 / int8 files, FAISS IVF-PQ,
+# and a recall-vs-latency evaluation against exact search
+# ========================================
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from resources import CHROMA_PATH, COLLECTION_NAME, forget, get_chroma_client, get_or_create
+
+
+# ========================================
+# ⚙️ BACKEND CONFIGURATION
+# ========================================
+
+# "chroma" (HNSW graph, float32 vectors in memory), "float16" / "int8" (memory-mapped vector file,
+# exact scan: 2x / ~4x less space, nothing held in RAM but the page cache) or "faiss-ivfpq"
+# (inverted lists of product-quantized codes, re-scored on the float16 file)
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma")
+
+# Distance metric and graph parameters applied to new Chroma collections ("hnsw:*" metadata).
+# l2 is Chroma's own default, the space existing collections (report_sostenibilita) were created with:
+# get_or_create_collection never changes the space of an existing collection, and distances of
+# different spaces cannot be compared or merged across collections
+DEFAULT_HNSW = {
+    "hnsw:space": os.environ.get("HNSW_SPACE", "l2"),
+    "hnsw:M": int(os.environ.get("HNSW_M", "16")),
+    "hnsw:construction_ef": int(os.environ.get("HNSW_CONSTRUCTION_EF", "100")),
+    "hnsw:search_ef": int(os.environ.get("HNSW_SEARCH_EF", "50"))
+}
+
+# Rows decoded per step of an exact scan (float16 x 384 dims: ~48 MB of float32 per block)
+SCAN_BLOCK_ROWS = 32_768
+
+# IVF-PQ: inverted lists (0 = 4 * sqrt(n)), lists probed per query, PQ sub-quantizers and bits per code
+IVF_NLIST = int(os.environ.get("IVF_NLIST", "0"))
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", "16"))
+PQ_M = int(os.environ.get("PQ_M", "48"))
+PQ_NBITS = 8
+
+# Below IVF_TRAIN_MIN vectors the IVF-PQ backend scans the float16 file exactly (nothing to train on yet)
+IVF_TRAIN_MIN = 10_000
+IVF_TRAIN_SAMPLE = 100_000
+
+# IVF-PQ candidates per requested result, re-scored exactly on the float16 vectors
+# (PQ distances are coarse: the re-scoring, not nprobe, is what brings recall close to 1)
+IVF_OVERFETCH = int(os.environ.get("IVF_OVERFETCH", "10"))
+
+
+def store_directory(collection_name, backend, path=CHROMA_PATH):
+    """
+    Folder of a compact vector store: <path>/vectors_<backend>/<collection>.
+    """
+    return os.path.join(path, f"vectors_{backend}", collection_name)
+
+
+# ========================================
+# 🔎 CHROMA WHERE FILTERS ON SQLITE
+# ========================================
+
+_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def where_to_sql(where):
+    """
+    Translates a Chroma `where` filter (see vectorial_db.build_where) into an SQL condition
+    over the JSON metadata column of the compact stores.
+
+    Returns:
+    - (str, list): condition and its parameters
+    """
+    if not where:
+        return "1", []
+
+    clauses, params = [], []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(condition) for condition in value]
+            clauses.append("(" + f" {key[1:].upper()} ".join(sql for sql, _ in parts) + ")")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        if not re.fullmatch(r"\w+", key):
+            raise ValueError(f"Unsupported metadata field in where filter: {key}")
+
+        field = f"json_extract(metadata, '$.{key}')"
+        for operator, operand in (value.items() if isinstance(value, dict) else [("$eq", value)]):
+            if operator in ("$in", "$nin"):
+                negation = "NOT " if operator == "$nin" else ""
+                clauses.append(f"{field} {negation}IN ({','.join('?' * len(operand))})")
+                params.extend(operand)
+            elif operator in _OPERATORS:
+                clauses.append(f"{field} {_OPERATORS[operator]} ?")
+                params.append(operand)
+            else:
+                raise ValueError(f"Unsupported where operator: {operator}")
+    return " AND ".join(clauses), params
+
+
+# ========================================
+# 🔌 BACKENDS
+# ========================================
+
+class ChromaStore:
+    """
+    The Chroma collection itself (HNSW index). Collections are created with DEFAULT_HNSW.
+    """
+
+    name = "chroma"
+
+    def __init__(self, collection_name=COLLECTION_NAME, path=CHROMA_PATH, hnsw=None):
+        self.collection_name = collection_name
+        self.path = path
+        self.hnsw = {**DEFAULT_HNSW, **(hnsw or {})}
+
+    @property
+    def collection(self):
+        # Looked up on every access: dropping or compacting an index replaces the handle
+        return get_or_create(
+            ("collection", self.path, self.collection_name),
+            lambda: get_chroma_client(self.path).get_or_create_collection(name=self.collection_name,
+                                                                          metadata=self.hnsw)
+        )
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def update_metadata(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def query(self, query_embeddings, n_results, where=None, include=("documents", "metadatas", "distances")):
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where,
+                                     include=list(include))
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        return self.collection.get(ids=ids, where=where, include=list(include), limit=limit, offset=offset)
+
+    def count(self):
+        return self.collection.count()
+
+    def flush(self):
+        pass
+
+
+class Float16Store:
+    """
+    Compact store: vectors appended to a memory-mapped file (L2-normalised, float16),
+    ids / documents / metadata in SQLite, exact cosine scan block by block.
+    Upserts and deletes leave tombstones (alive = 0) until compact().
+    Same query/get/upsert/delete interface (and result format) as a Chroma collection.
+    """
+
+    name = "float16"
+    dtype = np.float16
+
+    def __init__(self, collection_name=COLLECTION_NAME, path=CHROMA_PATH):
+        self.collection_name = collection_name
+        self.directory = store_directory(collection_name, self.name, path)
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, "vectors.bin")
+        self.lock = threading.RLock()
+        self.version = 0
+        self._view = None
+        self._alive = None
+
+        self.conn = sqlite3.connect(os.path.join(self.directory, "records.sqlite3"), check_same_thread=False,
+                                    timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                row INTEGER PRIMARY KEY,
+                id TEXT NOT NULL,
+                document TEXT,
+                metadata TEXT NOT NULL,
+                alive INTEGER NOT NULL DEFAULT 1
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_records_id ON records (id) WHERE alive = 1")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # The distance space is fixed when the store is created, like a Chroma collection's metadata
+        self.space = self._info("space")
+        if self.space is None:
+            self.space = DEFAULT_HNSW["hnsw:space"]
+            self._info("space", self.space)
+        self.conn.commit()
+        self.dim = self._info("dim")
+
+    # ---------- on-disk layout ----------
+
+    def _info(self, key, value=None):
+        if value is None:
+            row = self.conn.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row else None
+        self.conn.execute("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _row_shape(self):
+        return (self.dim,)
+
+    def _encode(self, vectors):
+        return vectors.astype(self.dtype)
+
+    def _decode(self, rows):
+        return np.asarray(rows, dtype=np.float32)
+
+    def _n_rows(self):
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        row_bytes = int(np.prod(self._row_shape())) * np.dtype(self.dtype).itemsize
+        return os.path.getsize(self.vectors_path) // row_bytes
+
+    def _matrix(self):
+        """
+        Read-only memory map of the vector file (re-opened when it grows).
+        """
+        n_rows = self._n_rows()
+        if self._view is None or self._view.shape[0] != n_rows:
+            self._view = (np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(n_rows, *self._row_shape()))
+                          if n_rows else np.empty((0, *self._row_shape()), dtype=self.dtype))
+        return self._view
+
+    def _alive_mask(self, where=None):
+        """
+        Boolean mask over the vector rows: live records accepted by the filter.
+        """
+        if where is None and self._alive is not None and self._alive[0] == self.version:
+            return self._alive[1]
+        condition, params = where_to_sql(where)
+        rows = [row for (row,) in self.conn.execute(f"SELECT row FROM records WHERE alive = 1 AND {condition}", params)]
+        mask = np.zeros(self._n_rows(), dtype=bool)
+        mask[rows] = True
+        if where is None:
+            self._alive = (self.version, mask)
+        return mask
+
+    # ---------- writes ----------
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(ids):
+            raise ValueError("upsert needs one embedding per id")
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [{}] * len(ids)
+
+        with self.lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._info("dim", self.dim)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store ({self.dim})")
+
+            # Vectors first: rows without a committed record are never returned
+            start = self._n_rows()
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(self._encode(vectors)).tobytes())
+
+            self.conn.executemany("UPDATE records SET alive = 0 WHERE id = ? AND alive = 1", [(i,) for i in ids])
+            self.conn.executemany(
+                "INSERT INTO records (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                [(start + i, chunk_id, document, json.dumps(metadata or {}, ensure_ascii=False))
+                 for i, (chunk_id, document, metadata) in enumerate(zip(ids, documents, metadatas))]
+            )
+            self.conn.commit()
+            self.version += 1
+        return start, vectors
+
+    def update_metadata(self, ids, metadatas):
+        """
+        Replaces the metadata of existing records in place (vector and row unchanged).
+        """
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE records SET metadata = ? WHERE id = ? AND alive = 1",
+                [(json.dumps(metadata or {}, ensure_ascii=False), chunk_id) for chunk_id, metadata in zip(ids, metadatas)]
+            )
+            self.conn.commit()
+
+    def delete(self, ids):
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                self.conn.execute(f"UPDATE records SET alive = 0 WHERE alive = 1 AND id IN ({','.join('?' * len(batch))})",
+                                  batch)
+            self.conn.commit()
+            self.version += 1
+
+    def flush(self):
+        pass
+
+    def compact(self):
+        """
+        Rewrites the vector file without deleted / replaced rows.
+
+        Returns:
+        - int: live records kept
+        """
+        with self.lock:
+            rows = [row for (row,) in self.conn.execute("SELECT row FROM records WHERE alive = 1 ORDER BY row")]
+            matrix = self._matrix()
+            tmp_path = self.vectors_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(matrix[rows[start:start + SCAN_BLOCK_ROWS]]).tobytes())
+
+            self.conn.execute("DELETE FROM records WHERE alive = 0")
+            # Ascending renumbering never collides: every new row number is <= the old one
+            self.conn.executemany("UPDATE records SET row = ? WHERE row = ?",
+                                  [(new, old) for new, old in enumerate(rows) if new != old])
+            self._view = None
+            os.replace(tmp_path, self.vectors_path)
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+            self.version += 1
+            return len(rows)
+
+    # ---------- reads ----------
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records WHERE alive = 1").fetchone()[0]
+
+    def _exact_search(self, queries, n_results, mask):
+        """
+        Exact cosine scan: per query, (rows, scores) of the best live rows, best first.
+        """
+        matrix = self._matrix()
+        scores = np.full((len(mask), len(queries)), -np.inf, dtype=np.float32)
+        for start in range(0, len(mask), SCAN_BLOCK_ROWS):
+            end = start + SCAN_BLOCK_ROWS
+            if mask[start:end].any():
+                scores[start:end] = self._decode(matrix[start:end]) @ queries.T
+        scores[~mask] = -np.inf
+
+        k = min(n_results, int(mask.sum()))
+        if k == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        top = np.argpartition(-scores, k - 1, axis=0)[:k]
+        results = []
+        for q in range(len(queries)):
+            rows = top[:, q][np.argsort(-scores[top[:, q], q], kind="stable")]
+            results.append((rows, scores[rows, q]))
+        return results
+
+    def _search(self, queries, n_results, mask):
+        return self._exact_search(queries, n_results, mask)
+
+    def _records(self, rows):
+        found = {}
+        rows = [int(row) for row in rows]
+        for start in range(0, len(rows), 500):
+            batch = rows[start:start + 500]
+            found.update(
+                (row, (chunk_id, document, json.loads(metadata))) for row, chunk_id, document, metadata in
+                self.conn.execute(f"SELECT row, id, document, metadata FROM records WHERE row IN ({','.join('?' * len(batch))})",
+                                  batch)
+            )
+        return found
+
+    def _embeddings(self, rows):
+        if not len(rows):
+            return []
+        order = np.argsort(rows)
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        vectors[order] = self._decode(self._matrix()[np.asarray(rows)[order]])
+        return vectors.tolist()
+
+    def query(self, query_embeddings, n_results, where=None, include=("documents", "metadatas", "distances")):
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = queries / np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)
+
+        with self.lock:
+            if self.dim is None:
+                hits = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+            else:
+                hits = self._search(queries, n_results, self._alive_mask(where))
+            records = self._records(np.concatenate([rows for rows, _ in hits]))
+
+            results = {"ids": [[records[row][0] for row in rows] for rows, _ in hits]}
+            if "documents" in include:
+                results["documents"] = [[records[row][1] for row in rows] for rows, _ in hits]
+            if "metadatas" in include:
+                results["metadatas"] = [[records[row][2] for row in rows] for rows, _ in hits]
+            if "distances" in include:
+                # Same scale as a Chroma collection of the store's space (vectors are unit length:
+                # squared L2 = 2 - 2 * cosine similarity; cosine / ip = 1 - cosine similarity)
+                scale = 2.0 if self.space == "l2" else 1.0
+                results["distances"] = [(scale * (1.0 - scores)).tolist() for _, scores in hits]
+            if "embeddings" in include:
+                results["embeddings"] = [self._embeddings(rows) for rows, _ in hits]
+        return results
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        condition, params = where_to_sql(where)
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                condition = "0"
+            else:
+                condition += f" AND id IN ({','.join('?' * len(ids))})"
+                params = [*params, *ids]
+        sql = f"SELECT row, id, document, metadata FROM records WHERE alive = 1 AND {condition} ORDER BY row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params = [*params, -1 if limit is None else limit, offset or 0]
+
+        with self.lock:
+            found = self.conn.execute(sql, params).fetchall()
+            results = {"ids": [chunk_id for _, chunk_id, _, _ in found]}
+            if "documents" in include:
+                results["documents"] = [document for _, _, document, _ in found]
+            if "metadatas" in include:
+                results["metadatas"] = [json.loads(metadata) for _, _, _, metadata in found]
+            if "embeddings" in include:
+                results["embeddings"] = self._embeddings([row for row, _, _, _ in found])
+        return results
+
+
+class Int8Store(Float16Store):
+    """
+    Compact store with int8 vectors and one float32 scale per vector (dim + 4 bytes per row).
+    """
+
+    name = "int8"
+    dtype = np.int8
+
+    def _row_shape(self):
+        return (self.dim + 4,)
+
+    def _encode(self, vectors):
+        scales = np.clip(np.abs(vectors).max(axis=1, keepdims=True), 1e-12, None).astype(np.float32) / 127
+        codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+        return np.hstack([codes, scales.view(np.int8)])
+
+    def _decode(self, rows):
+        rows = np.asarray(rows)
+        scales = np.ascontiguousarray(rows[:, self.dim:]).view(np.float32)
+        return rows[:, :self.dim].astype(np.float32) * scales
+
+
+class FaissIVFPQStore(Float16Store):
+    """
+    FAISS IVF-PQ index over the float16 store: each query probes `nprobe` inverted lists of
+    product-quantized codes (PQ_M bytes per vector in memory), and the candidates are re-scored
+    exactly against the memory-mapped float16 vectors. Trained once IVF_TRAIN_MIN vectors exist;
+    rebuilt by compact().
+    """
+
+    name = "faiss-ivfpq"
+
+    def __init__(self, collection_name=COLLECTION_NAME, path=CHROMA_PATH, nprobe=IVF_NPROBE, nlist=IVF_NLIST,
+                 pq_m=PQ_M, train_min=IVF_TRAIN_MIN, overfetch=IVF_OVERFETCH):
+        try:
+            import faiss
+        except ImportError as e:
+            raise RuntimeError("❌ The faiss-ivfpq vector backend needs faiss-cpu.") from e
+        super().__init__(collection_name, path)
+        self.faiss = faiss
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.train_min = train_min
+        self.overfetch = overfetch
+        self.index_path = os.path.join(self.directory, "ivfpq.faiss")
+        self.index = None
+        self.dirty = False
+
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+            self.index.nprobe = nprobe
+            # Rows written after the last flush are added again from the vector file
+            indexed = self._info("indexed_rows") or 0
+            rows = np.flatnonzero(self._alive_mask()[indexed:]) + indexed
+            self._add(rows)
+
+    def _add(self, rows):
+        for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+            batch = rows[start:start + SCAN_BLOCK_ROWS]
+            self.index.add_with_ids(self._decode(self._matrix()[batch]), batch.astype(np.int64))
+            self.dirty = True
+
+    def _build(self):
+        """
+        Trains the coarse quantizer and the PQ codebooks on a sample of the live vectors, then indexes them all.
+        """
+        rows = np.flatnonzero(self._alive_mask())
+        sample = np.sort(np.random.default_rng(0).choice(rows, min(len(rows), IVF_TRAIN_SAMPLE), replace=False))
+        nlist = self.nlist or int(4 * np.sqrt(len(rows)))
+        nlist = max(1, min(nlist, len(sample) // 39))  # FAISS wants ~39 training points per list
+        pq_m = max(m for m in range(1, min(self.pq_m, self.dim) + 1) if self.dim % m == 0)
+
+        quantizer = self.faiss.IndexFlatIP(self.dim)
+        index = self.faiss.IndexIVFPQ(quantizer, self.dim, nlist, pq_m, PQ_NBITS, self.faiss.METRIC_INNER_PRODUCT)
+        index.train(self._decode(self._matrix()[sample]))
+        index.nprobe = self.nprobe
+        self.index = index
+        self._add(rows)
+        print(f"🧮 Trained IVF-PQ index of {self.collection_name}: {len(rows)} vectors, nlist={nlist}, m={pq_m}")
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        with self.lock:
+            start, vectors = super().upsert(ids, embeddings, documents, metadatas)
+            if self.index is not None:
+                self.index.add_with_ids(vectors, np.arange(start, start + len(vectors), dtype=np.int64))
+                self.dirty = True
+            elif self.count() >= self.train_min:
+                self._build()
+        return start, vectors
+
+    def flush(self):
+        with self.lock:
+            if self.index is not None and self.dirty:
+                self.faiss.write_index(self.index, self.index_path)
+                self._info("indexed_rows", int(self._n_rows()))
+                self.conn.commit()
+                self.dirty = False
+
+    def compact(self):
+        with self.lock:
+            kept = super().compact()
+            self.index = None
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            if kept >= self.train_min:
+                self._build()
+            self.flush()
+            return kept
+
+    def _search(self, queries, n_results, mask):
+        if self.index is None:
+            return self._exact_search(queries, n_results, mask)
+
+        matrix = self._matrix()
+        n_live = int(mask.sum())
+        _, candidates = self.index.search(queries, n_results * self.overfetch)
+        results = []
+        for q, rows in enumerate(candidates):
+            rows = rows[(rows >= 0) & (rows < len(mask))]
+            rows = np.unique(rows[mask[rows]])
+            if len(rows) < min(n_results, n_live):
+                # Too few candidates survive the filter: exact scan for this query
+                results.extend(self._exact_search(queries[q:q + 1], n_results, mask))
+                continue
+            scores = self._decode(matrix[rows]) @ queries[q]
+            best = np.argsort(-scores, kind="stable")[:n_results]
+            results.append((rows[best], scores[best]))
+        return results
+
+
+BACKENDS = {backend.name: backend for backend in (ChromaStore, Float16Store, Int8Store, FaissIVFPQStore)}
+
+
+def get_vector_store(collection_name=COLLECTION_NAME, backend=None, path=CHROMA_PATH):
+    """
+    Shared vector store of a collection on the backend selected by VECTOR_BACKEND.
+    """
+    backend = backend or VECTOR_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown vector backend: {backend} (choose among {', '.join(BACKENDS)})")
+    return get_or_create(("vector_store", path, collection_name, backend),
+                         lambda: BACKENDS[backend](collection_name, path=path))
+
+
+def list_vector_stores(backend=None, path=CHROMA_PATH):
+    """
+    Collections that have a compact store on the given backend (Chroma collections are listed by Chroma).
+    """
+    root = os.path.join(path, f"vectors_{backend or VECTOR_BACKEND}")
+    return sorted(os.listdir(root)) if os.path.isdir(root) else []
+
+
+def drop_vector_store(collection_name, path=CHROMA_PATH):
+    """
+    Deletes the compact stores of a collection (every backend) and forgets their handles.
+    """
+    for backend in BACKENDS:
+        forget("vector_store", path, collection_name, backend)
+        if backend != ChromaStore.name:
+            shutil.rmtree(store_directory(collection_name, backend, path), ignore_errors=True)
+
+
+# ========================================
+# 🧪 RECALL VS LATENCY EVALUATION
+# ========================================
+
+# Configurations compared by default: "backend" or "backend:param=value,..."
+EVAL_CONFIGS = [
+    "chroma:search_ef=10", "chroma:search_ef=50", "chroma:search_ef=200",
+    "float16", "int8",
+    "faiss-ivfpq:nprobe=4,overfetch=4", "faiss-ivfpq:nprobe=16", "faiss-ivfpq:nprobe=64"
+]
+
+
+def parse_config(config):
+    """
+    "faiss-ivfpq:nprobe=16" -> ("faiss-ivfpq", {"nprobe": 16}).
+    """
+    backend, _, params = config.partition(":")
+    values = {}
+    for pair in filter(None, params.split(",")):
+        key, value = pair.split("=", 1)
+        values[key.strip()] = int(value) if value.strip().lstrip("-").isdigit() else value.strip()
+    return backend, values
+
+
+def synthetic_vectors(n, dim=384, n_clusters=256, seed=0):
+    """
+    Unit vectors drawn around random cluster centres: closer to real chunk embeddings
+    (topics, documents) than uniform noise, which is the worst case for every ANN index.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, n_clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def collection_vectors(collection_name, n, backend=None):
+    """
+    Up to n stored embeddings of an existing collection.
+    """
+    store = get_vector_store(collection_name, backend=backend)
+    vectors = []
+    while len(vectors) < n:
+        page = store.get(include=["embeddings"], limit=min(5000, n - len(vectors)), offset=len(vectors))
+        if not len(page["ids"]):
+            break
+        vectors.extend(page["embeddings"])
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def exact_neighbours(corpus, queries, k):
+    """
+    Ground truth: indices of the k most cosine-similar corpus vectors of each query.
+    """
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def evaluate_config(config, corpus, queries, truth, k, workdir, write_batch=1000):
+    """
+    Builds one backend configuration on the corpus and measures recall@k and per-query latency.
+    """
+    backend, params = parse_config(config)
+    path = tempfile.mkdtemp(prefix="vector_eval_", dir=workdir)
+    name = "vector_eval"
+    store = None
+    try:
+        if backend == ChromaStore.name:
+            store = ChromaStore(name, path=path, hnsw={f"hnsw:{key}": value for key, value in params.items()})
+        elif backend == FaissIVFPQStore.name:
+            store = FaissIVFPQStore(name, path=path, train_min=min(IVF_TRAIN_MIN, len(corpus)), **params)
+        else:
+            store = BACKENDS[backend](name, path=path, **params)
+
+        started = time.perf_counter()
+        for start in range(0, len(corpus), write_batch):
+            end = min(start + write_batch, len(corpus))
+            store.upsert(ids=[str(i) for i in range(start, end)], embeddings=corpus[start:end],
+                         documents=[""] * (end - start), metadatas=[{"n": i} for i in range(start, end)])
+        store.flush()
+        build_time = time.perf_counter() - started
+
+        store.query(queries[:1].tolist(), n_results=k, include=[])  # warm-up
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = store.query([query.tolist()], n_results=k, include=[])["ids"][0]
+            latencies.append(time.perf_counter() - started)
+            hits += len(expected & {int(i) for i in found})
+
+        return {
+            "config": config,
+            "build_s": build_time,
+            f"recall@{k}": hits / (k * len(queries)),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p95_ms": float(np.percentile(latencies, 95) * 1000),
+            "disk_mb": _directory_size(path) / 1e6
+        }
+    finally:
+        if backend == ChromaStore.name:
+            forget("collection", path)
+            forget("chroma_client", path)
+        elif store is not None:
+            store.conn.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def evaluate(configs=EVAL_CONFIGS, n_vectors=50_000, n_queries=200, k=10, collection_name=None, seed=0,
+             workdir=None):
+    """
+    Recall@k (against exact search) and latency of each backend configuration on the same vectors:
+    a sample of an existing collection, or synthetic clustered vectors.
+
+    Returns:
+    - List[dict]: one row per configuration
+    """
+    if collection_name:
+        vectors = collection_vectors(collection_name, n_vectors + n_queries)
+        rng = np.random.default_rng(seed)
+        vectors = vectors[rng.permutation(len(vectors))]
+    else:
+        vectors = synthetic_vectors(n_vectors + n_queries, seed=seed)
+    corpus, queries = vectors[n_queries:], vectors[:n_queries]
+    if len(corpus) < k:
+        raise ValueError(f"Not enough vectors to evaluate: {len(corpus)}")
+
+    truth = exact_neighbours(corpus, queries, k)
+    print(f"🧪 {len(corpus)} vectors, {len(queries)} queries, recall@{k} against exact search")
+
+    results = []
+    for config in configs:
+        try:
+            row = evaluate_config(config, corpus, queries, truth, k, workdir)
+        except (RuntimeError, ValueError) as e:
+            print(f"⚠️ {config} skipped: {e}")
+            continue
+        results.append(row)
+        print(f"  {config:<24} recall {row[f'recall@{k}']:.3f}  p50 {row['p50_ms']:7.2f} ms  "
+              f"p95 {row['p95_ms']:7.2f} ms  build {row['build_s']:6.1f}s  disk {row['disk_mb']:7.1f} MB")
+    return results
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Recall vs latency of the vector store backends.")
+    arg_parser.add_argument("--configs", nargs="+", default=EVAL_CONFIGS,
+                            help='e.g. "chroma:search_ef=100,M=32" "int8" "faiss-ivfpq:nprobe=32"')
+    arg_parser.add_argument("--vectors", type=int, default=50_000)
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("-k", type=int, default=10)
+    arg_parser.add_argument("--collection", help="sample vectors from this collection instead of synthetic ones")
+    arg_parser.add_argument("--output", help="write the results as JSON")
+    args = arg_parser.parse_args(argv)
+
+    results = evaluate(args.configs, n_vectors=args.vectors, n_queries=args.queries, k=args.k,
+                       collection_name=args.collection)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,110 +2,653 @@
 # 📦 LIBRARY IMPORTS
 # ========================================
 
-import chromadb
+import contextvars
+import json
+import re
+import threading
+from dataclasses import dataclass, field
+from itertools import islice
+from queue import Queue
+
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
+
+import ingestion_manifest
+from bm25_index import ensure_bm25_index, get_bm25_index, reciprocal_rank_fusion
+from embedding_cache import encode_cached
+from reranker import RERANK_CANDIDATES_FACTOR, RERANK_LATENCY_BUDGET, rerank as cross_encoder_rerank
+from resources import COLLECTION_NAME, EMBEDDING_MODEL_NAME, get_chroma_client
+from tracing import span
+from vector_store import get_vector_store
+
+# The local, CPU-compatible embedding model and the ChromaDB client are loaded
+# on first use by resources.py and shared across calls, reruns and sessions.
+# Embeddings go through the persistent cache in embedding_cache.py, so boilerplate
+# repeated across reports and years is encoded only once.
 
 
 # ========================================
-# ⚙️ INITIALIZE EMBEDDING MODEL
+# 🧾 INCREMENTAL INGESTION HELPERS
 # ========================================
 
-# Loads a local, CPU-compatible embedding model
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+def ingestion_params(chunk_size=500, overlap=50):
+    """
+    Parameters that, together with the file content, determine the indexed chunks.
+    A change in any of them invalidates the previous ingestion of a document.
+    """
+    return {"chunk_size": chunk_size, "overlap": overlap, "embedding_model": EMBEDDING_MODEL_NAME, "chunking": "page"}
+
+
+def is_already_indexed(nome, file_hash, chunk_size=500, overlap=50, collection_name=COLLECTION_NAME):
+    """
+    True if the document was already indexed in the collection from identical content with the
+    same parameters, so parsing, chunking and embedding can be skipped entirely.
+    """
+    return ingestion_manifest.is_unchanged(nome, file_hash, ingestion_params(chunk_size, overlap),
+                                           collection_name=collection_name)
+
+
+_YEAR_RE = re.compile(r"(?<!\d)(?:19|20)\d{2}(?!\d)")
+
+
+def infer_year(nome):
+    """
+    Reporting year of a document, taken from the last 4-digit year in its file name
+    (e.g. "Sustainability_Report_2023" -> 2023). None if the name contains no year.
+    """
+    years = _YEAR_RE.findall(nome)
+    return int(years[-1]) if years else None
+
+
+def chunk_signature(chunk, metadata):
+    """
+    Hash of a chunk's text and provenance metadata: a chunk is rewritten if either changes.
+    """
+    return ingestion_manifest.hash_text(json.dumps(metadata, sort_keys=True) + chunk)
+
+
+def chunk_id(nome, text_hash, occurrence=0):
+    """
+    Content-derived ID of a chunk (text_hash: ingestion_manifest.hash_text of its text): the same text
+    keeps its ID when an edit elsewhere shifts its position, so only new text is embedded and written.
+    occurrence (0 for the first copy in the document) keeps repeated texts distinct.
+    """
+    base = f"{nome}_{text_hash[:16]}"
+    return base if occurrence == 0 else f"{base}_{occurrence}"
+
+
+# ========================================
+# 🌊 STREAMING HELPERS (BOUNDED MEMORY)
+# ========================================
+
+# Number of chunks embedded per batch
+EMBED_BATCH_SIZE = 64
+
+# Upper bound on records per Chroma write (clamped to the client's own max batch size)
+WRITE_BATCH_SIZE = 1000
+
+# Embedded batches waiting to be written before the embedding loop blocks
+MAX_PENDING_WRITES = 2
+
+
+def make_splitter(chunk_size=500, overlap=50):
+    """
+    Text splitter used for indexing (shared with the ingestion workers, which must cut identical chunks).
+    """
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=overlap,
+        separators=["\n\n", "\n", ".", " "],  # priority of split: paragraph > line > sentence > word
+        add_start_index=True  # character offsets for provenance metadata
+    )
+
+
+def iter_chunks(pagine, splitter):
+    """
+    Streams page-aware chunks out of an iterable of page texts.
+    Each page is split on its own, so a chunk never spans two pages and can be cited
+    by page number; only one page is held in memory at a time.
+
+    Yields:
+    - (chunk, pagina, char_start, char_end): text, 1-based page number and character
+      offsets of the chunk within the page text
+    """
+    for pagina, testo_pagina in enumerate(pagine, start=1):
+        if not testo_pagina:
+            continue
+        with span("split"):
+            documents = splitter.create_documents([testo_pagina])
+        for document in documents:
+            char_start = document.metadata.get("start_index", -1)
+            if char_start < 0:
+                char_start = testo_pagina.find(document.page_content)
+            yield document.page_content, pagina, char_start, char_start + len(document.page_content)
+
+
+def iter_batches(iterable, size):
+    """
+    Groups an iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class _ChromaBatchWriter:
+    """
+    Writes upsert batches to a vector store (see vector_store.py) on a background thread.
+    The bounded queue gives backpressure: embedding blocks when writes fall behind,
+    so at most MAX_PENDING_WRITES batches are held in memory.
+    """
+
+    def __init__(self, collection, max_pending=MAX_PENDING_WRITES, max_batch=WRITE_BATCH_SIZE):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+        # The writer thread records its spans in the caller's trace
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while (records := self.queue.get()) is not None:
+            if self.error is not None:
+                continue  # drain the queue after a failure so put() never blocks forever
+            try:
+                for start in range(0, len(records["ids"]), self.max_batch):
+                    batch = {key: values[start:start + self.max_batch] for key, values in records.items()}
+                    with span("collection_add", records=len(batch["ids"])):
+                        self.collection.upsert(**batch)
+            except Exception as e:
+                self.error = e
+
+    def put(self, ids, documents, embeddings, metadatas):
+        if self.error is not None:
+            raise self.error
+        self.queue.put({"ids": ids, "documents": documents, "embeddings": embeddings, "metadatas": metadatas})
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _max_write_batch(client):
+    """
+    Largest write batch accepted by the Chroma client, capped by WRITE_BATCH_SIZE.
+    """
+    get_max = getattr(client, "get_max_batch_size", None)
+    limit = get_max() if callable(get_max) else getattr(client, "max_batch_size", None)
+    return min(WRITE_BATCH_SIZE, limit) if limit else WRITE_BATCH_SIZE
 
 
 # ========================================
 # 📥 STORE DOCUMENT CHUNKS INTO CHROMADB
 # ========================================
 
-def store_in_chromadb(nome, estensione, testo, chunk_size=500, overlap=50):
+def store_in_chromadb(nome, estensione, testo, chunk_size=500, overlap=50, file_hash=None,
+                      batch_size=EMBED_BATCH_SIZE, anno=None, collection_name=COLLECTION_NAME):
     """
     Splits the text into chunks, generates local embeddings, and stores them in ChromaDB.
+    Indexing is incremental: chunk IDs derive from the chunk text, so only new text is
+    embedded and upserted, text that moved gets a metadata update, and chunks that no
+    longer exist are deleted.
+    Work is streamed (pages -> chunks -> embedding batches -> bounded Chroma writes),
+    so peak memory does not grow with the size of the document.
 
     Parameters:
     - nome (str): source file name (no extension)
     - estensione (str): file extension (.pdf, .txt, etc.)
-    - testo (str): full text extracted from document
+    - testo (str | Iterable[str]): iterable of page texts (e.g. parser.itera_pagine or the
+      testo_per_pagina list of parse_pdf), consumed lazily; a plain string is indexed as a single page
     - chunk_size (int): max characters per chunk
     - overlap (int): character overlap between chunks
+    - file_hash (str): optional SHA-256 of the source file, recorded in the ingestion manifest
+    - batch_size (int): number of chunks embedded per encode call
+    - anno (int): reporting year of the document (inferred from the file name if None)
+    - collection_name (str): target collection (see index_manager for per-client/per-year indexes)
 
     Output:
-    - Indexed chunks saved into ChromaDB collection
+    - Indexed chunks saved into ChromaDB collection, with provenance metadata:
+      origine, estensione, chunk, pagina, char_start, char_end and (if known) anno
     """
 
+    params = ingestion_params(chunk_size, overlap)
+    if ingestion_manifest.is_unchanged(nome, file_hash, params, collection_name=collection_name):
+        print(f"⏭️ Skipped {nome}{estensione}: already indexed and unchanged.")
+        return
+
     print(f"📥 Indexing started for: {nome}{estensione}")
 
     # 1. Text splitting configuration
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=overlap,
-        separators=["\n\n", "\n", ".", " "]  # priority of split: paragraph > line > sentence > word
-    )
+    splitter = make_splitter(chunk_size, overlap)
+    anno = anno if anno is not None else infer_year(nome)
 
-    # 2. Split text into chunks
-    chunks = splitter.split_text(testo)
+    # 2. Shared ChromaDB client and the collection's vector store (Chroma HNSW or a compact backend)
+    client = get_chroma_client()
+    collection = get_vector_store(collection_name)
 
-    # ❗ Skip empty documents or failed parsing
-    if not chunks:
-        print(f"⚠️ Skipped {nome}{estensione}: no content extracted.")
-        return
+    # 3. Previous ingestion of the same document, used to skip unchanged chunks
+    entry = ingestion_manifest.get_entry(nome, collection_name=collection_name) or {}
+    previous_chunks = entry.get("chunks", {})
+    if entry.get("params", {}).get("embedding_model") != EMBEDDING_MODEL_NAME:
+        unchanged_candidates = {}  # vectors from another model cannot be kept
+    else:
+        unchanged_candidates = previous_chunks
 
-    # 3. Generate embeddings for each chunk
-    embeddings = embedder.encode(chunks).tolist()
+    # 4. Stream pages -> chunks, counting pages and keeping a short preview on the way
+    pagine = [testo] if isinstance(testo, str) else testo
+    n_pagine = 0
+    preview = ""
 
-    # ❗ Safety check to avoid crash with empty embeddings
-    if not embeddings:
-        print(f"⚠️ Skipped {nome}{estensione}: empty embeddings list.")
-        return
+    def pagine_contate():
+        nonlocal n_pagine, preview
+        for pagina in pagine:
+            n_pagine += 1
+            if len(preview) < 1000:
+                preview = (f"{preview}\n\n{pagina}" if preview else pagina)[:1000]
+            yield pagina
 
-    # 4. Initialize ChromaDB client and collection
-    client = chromadb.PersistentClient(path="./chroma_db")
-    collection = client.get_or_create_collection(name="report_sostenibilita")
+    chunk_stream = iter_chunks(pagine_contate(), splitter)
 
-    # 5. Generate unique IDs and metadata
-    ids = [f"{nome}_{i}" for i in range(len(chunks))]
-    metadatas = [{"origine": nome, "estensione": estensione, "chunk": i} for i in range(len(chunks))]
+    # 5. Embed new chunks batch by batch and hand them to the background writer;
+    #    unchanged text that only moved (new page / offsets / position) gets a metadata update
+    chunk_hashes = {}
+    occurrences = {}
+    moved = []
+    n_changed = 0
+    n_chunks = 0
+    keyword_index = get_bm25_index(collection_name)
+    writer = _ChromaBatchWriter(collection, max_batch=_max_write_batch(client))
 
-    # 6. Add records to the collection
-    collection.add(
-        ids=ids,
-        documents=chunks,
-        embeddings=embeddings,
-        metadatas=metadatas
-    )
+    try:
+        for batch in iter_batches(chunk_stream, batch_size):
+            ids, documents, metadatas = [], [], []
+            for chunk, pagina, char_start, char_end in batch:
+                text_hash = ingestion_manifest.hash_text(chunk)
+                occurrence = occurrences[text_hash] = occurrences.get(text_hash, -1) + 1
+                record_id = chunk_id(nome, text_hash, occurrence)
+                metadata = {
+                    "origine": nome,
+                    "estensione": estensione,
+                    "chunk": n_chunks,
+                    "pagina": pagina,
+                    "char_start": char_start,
+                    "char_end": char_end
+                }
+                if anno is not None:
+                    metadata["anno"] = anno
+                n_chunks += 1
 
-    print(f"✅ Indexed {len(chunks)} chunks from '{nome}{estensione}' using local embeddings.")
+                signature = chunk_signature(chunk, metadata)
+                chunk_hashes[record_id] = signature
+                if unchanged_candidates.get(record_id) == signature:
+                    continue
+                if record_id in unchanged_candidates:
+                    moved.append((record_id, metadata))
+                    continue
+
+                ids.append(record_id)
+                documents.append(chunk)
+                metadatas.append(metadata)
+
+            if not ids:
+                continue
+
+            writer.put(
+                ids=ids,
+                documents=documents,
+                embeddings=encode_cached(documents).tolist(),
+                metadatas=metadatas
+            )
+            keyword_index.add_documents(ids, documents)
+            n_changed += len(ids)
+        for batch in iter_batches(moved, WRITE_BATCH_SIZE):
+            with span("collection_update", records=len(batch)):
+                collection.update_metadata(ids=[record_id for record_id, _ in batch],
+                                           metadatas=[metadata for _, metadata in batch])
+    finally:
+        if n_changed or moved:
+            ingestion_manifest.bump_revision()
+        writer.close()
+        collection.flush()
+
+    # ❗ Empty documents or failed parsing (e.g. scanned pages without OCR) are still recorded in the
+    #    manifest, so an unchanged re-upload is skipped instead of being queued again and again
+    if not chunk_hashes:
+        print(f"⚠️ No content extracted from {nome}{estensione}.")
+
+    # 6. Drop the orphaned chunks of the previous ingestion
+    orphans = [record_id for record_id in previous_chunks if record_id not in chunk_hashes]
+    for batch in iter_batches(orphans, WRITE_BATCH_SIZE):
+        collection.delete(ids=batch)
+        keyword_index.delete(batch)
+
+    # 7. Record the ingestion in the manifest
+    ingestion_manifest.update_entry(nome, collection_name=collection_name, entry={
+        "estensione": estensione,
+        "file_hash": file_hash,
+        "params": params,
+        "chunks": chunk_hashes,
+        "n_pagine": n_pagine,
+        "anno": anno,
+        "preview": preview
+    })
+
+    print(
+        f"✅ Indexed '{nome}{estensione}': {n_changed} chunks upserted, {len(moved)} moved, "
+        f"{len(chunk_hashes) - n_changed - len(moved)} unchanged, {len(orphans)} removed."
+    )
 
 
 # ========================================
 # 🔍 QUERY CHROMADB FOR RELEVANT CHUNKS
 # ========================================
 
-def query_chromadb(prompt, n_results=20):
+# Candidates taken from each retriever before fusion, per requested result
+HYBRID_CANDIDATES_FACTOR = 4
+
+
+def build_where(origine=None, anno=None, pagina_da=None, pagina_a=None):
+    """
+    Builds a Chroma metadata filter, so candidates are pre-filtered inside Chroma.
+
+    Parameters:
+    - origine (str | list[str]): document name(s) to search in
+    - anno (int | list[int]): reporting year(s) to search in
+    - pagina_da (int): first page (inclusive)
+    - pagina_a (int): last page (inclusive)
+
+    Returns:
+    - dict | None: Chroma `where` filter, or None if no constraint is given
+    """
+    conditions = []
+    for field, value in (("origine", origine), ("anno", anno)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            conditions.append({field: {"$in": list(value)}})
+        else:
+            conditions.append({field: value})
+    if pagina_da is not None:
+        conditions.append({"pagina": {"$gte": pagina_da}})
+    if pagina_a is not None:
+        conditions.append({"pagina": {"$lte": pagina_a}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def format_source(metadata):
+    """
+    Human-readable citation of a chunk, e.g. "Report_2023.pdf, p. 12".
+    """
+    source = f"{metadata.get('origine', '?')}{metadata.get('estensione', '')}"
+    if metadata.get("pagina") is not None:
+        source += f", p. {metadata['pagina']}"
+    return source
+
+
+def query_chromadb(prompt, n_results=20, mode="vector", with_details=False, where=None, collections=None,
+                   rerank=False, rerank_budget=RERANK_LATENCY_BUDGET):
     """
     Searches for the most relevant document chunks in ChromaDB based on a user prompt.
 
     Parameters:
     - prompt (str): user input prompt/question
     - n_results (int): number of top matching chunks to retrieve
+    - mode (str): "vector" for dense MiniLM search only, "hybrid" to fuse dense and
+      BM25 keyword rankings with reciprocal-rank fusion (catches exact terms such as
+      "Scope 3", "tCO2e" or GRI codes, so fewer chunks are needed for the same recall)
+    - with_details (bool): also return the IDs and metadata of the retrieved chunks
+    - where (dict): Chroma metadata filter, e.g. build_where(anno=2023, pagina_da=10, pagina_a=40)
+    - collections (str | list[str]): collection(s) to search (default: the main collection)
+    - rerank (bool): fetch a wider candidate set and re-order it with a local cross-encoder
+    - rerank_budget (float): seconds allowed for re-ranking before falling back to retrieval order
 
     Returns:
     - List[str]: list of retrieved text chunks
+      (or a tuple (ids, chunks, metadatas) if with_details is True;
+      each metadata dict carries the name of its collection under "collection")
     """
+    return query_chromadb_many([prompt], n_results=n_results, mode=mode, with_details=with_details,
+                               where=where, collections=collections, rerank=rerank,
+                               rerank_budget=rerank_budget)[0]
 
-    # 1. Generate embedding for the user prompt
-    query_embedding = embedder.encode([prompt]).tolist()[0]
 
-    # 2. Connect to ChromaDB and access the collection
-    client = chromadb.PersistentClient(path="./chroma_db")
-    collection = client.get_or_create_collection(name="report_sostenibilita")
+def _search_collection(collection_name, prompts, query_embeddings, n_results, mode, where):
+    """
+    Runs the vector or hybrid search of several prompts against one collection.
 
-    # 3. Perform vector search
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=n_results
-    )
+    Returns:
+    - List[List[tuple]]: per prompt, (score, chunk_id, document, metadata) tuples, best first.
+      Scores are comparable across collections searched in the same mode
+      (negative distance for "vector", fused RRF score for "hybrid").
+    """
+    collection = get_vector_store(collection_name)
+
+    def empty():
+        return [[] for _ in prompts]
+
+    def with_collection(meta):
+        return {**(meta or {}), "collection": collection_name}
+
+    if mode == "vector":
+        # Vector search, pre-filtered by metadata inside Chroma
+        with span("collection_query", collection=collection_name, queries=len(prompts)):
+            results = collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=where,
+                include=["documents", "metadatas", "distances"]
+            )
+        return [
+            [(-dist, chunk_id, doc, with_collection(meta)) for chunk_id, doc, meta, dist in zip(ids, docs, metas, dists)]
+            for ids, docs, metas, dists in zip(results.get("ids") or empty(), results.get("documents") or empty(),
+                                               results.get("metadatas") or empty(), results.get("distances") or empty())
+        ]
+
+    # Retrieve a wider candidate set from both retrievers
+    n_candidates = max(n_results * HYBRID_CANDIDATES_FACTOR, 20)
+    with span("collection_query", collection=collection_name, queries=len(prompts)):
+        dense = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_candidates,
+            where=where,
+            include=["documents", "metadatas"]
+        )
+    dense_ids = dense.get("ids") or empty()
+    records = {}
+    for ids, docs, metas in zip(dense_ids, dense.get("documents") or empty(), dense.get("metadatas") or empty()):
+        records.update((chunk_id, (doc, meta)) for chunk_id, doc, meta in zip(ids, docs, metas))
+
+    # The keyword index has no metadata: over-fetch when filtering, then keep only chunks Chroma accepts
+    keyword_index = ensure_bm25_index(collection_name, collection)
+    keyword_limit = n_candidates * (HYBRID_CANDIDATES_FACTOR if where else 1)
+    with span("bm25_search", collection=collection_name, queries=len(prompts)):
+        keyword_ids = [[chunk_id for chunk_id, _ in keyword_index.search(prompt, n_results=keyword_limit)]
+                       for prompt in prompts]
+
+    # Fetch text and metadata of keyword-only candidates in one (filtered) call
+    missing = list({chunk_id for ids in keyword_ids for chunk_id in ids if chunk_id not in records})
+    if missing:
+        with span("collection_get", collection=collection_name, ids=len(missing)):
+            fetched = collection.get(ids=missing, where=where, include=["documents", "metadatas"])
+        records.update((chunk_id, (doc, meta)) for chunk_id, doc, meta in
+                       zip(fetched["ids"], fetched["documents"], fetched["metadatas"]))
+
+    # Fuse the two rankings of each prompt
+    results = []
+    for ids, kw_ids in zip(dense_ids, keyword_ids):
+        kw_ids = [chunk_id for chunk_id in kw_ids if chunk_id in records][:n_candidates]
+        fused = reciprocal_rank_fusion([ids, kw_ids], with_scores=True)[:n_results]
+        results.append([(score, chunk_id, records[chunk_id][0], with_collection(records[chunk_id][1]))
+                        for chunk_id, score in fused])
+    return results
+
+
+def _retrieve(prompts, n_results, mode, where, collections, rerank, rerank_budget):
+    """
+    Shared body of the batched retrieval functions.
+
+    Returns:
+    - List[List[tuple]]: per prompt, (score, chunk_id, document, metadata) tuples, best first
+    """
+    if mode not in ("vector", "hybrid"):
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+    if not prompts:
+        return []
+
+    if collections is None:
+        collections = [COLLECTION_NAME]
+    elif isinstance(collections, str):
+        collections = [collections]
+
+    # 1. Generate embeddings for all prompts at once
+    query_embeddings = encode_cached(list(prompts)).tolist()
+
+    # 2. Search each collection and merge the per-prompt results by score
+    n_candidates = n_results * RERANK_CANDIDATES_FACTOR if rerank else n_results
+    merged = [[] for _ in prompts]
+    for collection_name in collections:
+        for hits, found in zip(merged, _search_collection(collection_name, prompts, query_embeddings,
+                                                          n_candidates, mode, where)):
+            hits.extend(found)
+
+    results = []
+    for prompt, hits in zip(prompts, merged):
+        best = sorted(hits, key=lambda hit: hit[0], reverse=True)[:n_candidates]
+        if rerank:
+            # 3. Optional cross-encoder pass over the wider candidate set
+            order = cross_encoder_rerank(prompt, [h[2] for h in best], n_results, latency_budget=rerank_budget)
+            best = [best[i] for i in order]
+        results.append(best)
+    return results
+
+
+def query_chromadb_many(prompts, n_results=20, mode="vector", with_details=False, where=None, collections=None,
+                        rerank=False, rerank_budget=RERANK_LATENCY_BUDGET):
+    """
+    Batched version of query_chromadb: all prompts are embedded in one vectorised call
+    and searched with a single multi-embedding Chroma query per collection.
+
+    Parameters:
+    - prompts (list[str]): user prompts/questions
+    - n_results (int): number of top matching chunks to retrieve per prompt
+    - mode (str): "vector" or "hybrid" (see query_chromadb)
+    - with_details (bool): return (ids, chunks, metadatas) tuples instead of chunk lists
+    - where (dict): Chroma metadata filter applied to every prompt (see build_where)
+    - collections (str | list[str]): collection(s) to search; results are merged by score
+    - rerank (bool): re-order RERANK_CANDIDATES_FACTOR x n_results candidates per prompt with a
+      local cross-encoder and keep the best n_results
+    - rerank_budget (float): seconds allowed for re-ranking each prompt before keeping retrieval order
+
+    Returns:
+    - List[List[str]]: retrieved text chunks for each prompt, in input order
+    """
+    results = []
+    for best in _retrieve(prompts, n_results, mode, where, collections, rerank, rerank_budget):
+        if with_details:
+            results.append(([h[1] for h in best], [h[2] for h in best], [h[3] for h in best]))
+        else:
+            results.append([h[2] for h in best])
+    return results
+
+
+# ========================================
+# 🧾 TYPED BATCHED RETRIEVAL
+# ========================================
+
+@dataclass(frozen=True)
+class RetrievedChunk:
+    """
+    One retrieved chunk.
+
+    - score: higher is better (negative distance in "vector" mode, RRF score in "hybrid" mode
+      and in merged results); after re-ranking, list order is the cross-encoder's
+    - queries: indices of the queries that retrieved the chunk
+    """
+    id: str
+    document: str
+    metadata: dict
+    score: float
+    queries: tuple[int, ...] = ()
+
+    @property
+    def collection(self) -> str | None:
+        return self.metadata.get("collection")
+
+    @property
+    def source(self) -> str:
+        return format_source(self.metadata)
+
+
+@dataclass
+class RetrievalResult:
+    """
+    Chunks retrieved for one query (or for several queries merged), best first.
+    """
+    queries: list[str]
+    chunks: list[RetrievedChunk] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    @property
+    def ids(self) -> list[str]:
+        return [chunk.id for chunk in self.chunks]
+
+    @property
+    def documents(self) -> list[str]:
+        return [chunk.document for chunk in self.chunks]
+
+    @property
+    def metadatas(self) -> list[dict]:
+        return [chunk.metadata for chunk in self.chunks]
+
+    @property
+    def scores(self) -> list[float]:
+        return [chunk.score for chunk in self.chunks]
+
+
+def retrieve(queries, n_results=20, mode="vector", where=None, collections=None, rerank=False,
+             rerank_budget=RERANK_LATENCY_BUDGET, merge=False, max_merged=None):
+    """
+    Batched retrieval with typed results: every query is embedded in the same encode call and
+    searched with one multi-embedding query per collection (see query_chromadb_many).
+
+    Parameters:
+    - queries (str | list[str]): queries, e.g. a section prompt and its sub-questions per ESG pillar
+    - n_results, mode, where, collections, rerank, rerank_budget: as in query_chromadb_many (per query)
+    - merge (bool): return a single result with the chunks of all queries, deduplicated
+      (same collection and id) and ranked by reciprocal-rank fusion of the per-query rankings
+    - max_merged (int): chunks kept in the merged result (default: all of them)
+
+    Returns:
+    - List[RetrievalResult]: one per query, in input order (a single RetrievalResult if merge is True)
+    """
+    queries = [queries] if isinstance(queries, str) else list(queries)
+    per_query = _retrieve(queries, n_results, mode, where, collections, rerank, rerank_budget)
+
+    if not merge:
+        return [RetrievalResult([query], [RetrievedChunk(h[1], h[2], h[3], h[0], (i,)) for h in hits])
+                for i, (query, hits) in enumerate(zip(queries, per_query))]
+
+    # The same id can exist in two collections: they are different chunks
+    def key(hit):
+        return (hit[3].get("collection"), hit[1])
+
+    records, matched = {}, {}
+    for i, hits in enumerate(per_query):
+        for hit in hits:
+            records.setdefault(key(hit), hit)
+            matched.setdefault(key(hit), []).append(i)
 
-    # 4. Return retrieved text chunks
-    return results.get("documents", [[]])[0]
\ No newline at end of file
+    fused = reciprocal_rank_fusion([[key(hit) for hit in hits] for hits in per_query], with_scores=True)
+    chunks = [RetrievedChunk(records[k][1], records[k][2], records[k][3], score, tuple(matched[k]))
+              for k, score in fused[:max_merged]]
+    return RetrievalResult(queries, chunks)